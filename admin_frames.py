@@ -4,7 +4,6 @@ from tkinter import messagebox
 import json
 from gui import BG_COLOR, GREEN_COLOR, TAG_COLOR
 import sys
-import time
 import os
 
 class AdminOptionsFrame(tk.Frame):
@@ -1328,65 +1327,56 @@ class LightingModeFrame(tk.Frame):
     def on_mode1(self):
         """Handle selecting Mode1."""
         self.chosen_mode = 1
-        self.spi_handler.set_led_color(255, 0, 0, 0, 1)
+        self.spi_handler.apply_lighting_scene(mode=1)
         self.reset_timeout()
         print("Mode1 selected.")
 
     def on_mode2(self):
         """Handle selecting Mode2."""
         self.chosen_mode = 2
-        self.spi_handler.set_led_color(255, 0, 0, 0, 2)
+        self.spi_handler.apply_lighting_scene(mode=2)
         self.reset_timeout()
         print("Mode2 selected.")
 
     def on_mode3(self):
         """Handle selecting Mode3."""
         self.chosen_mode = 3
-        self.spi_handler.set_led_color(255, 0, 0, 0, 3)
+        self.spi_handler.apply_lighting_scene(mode=3)
         self.reset_timeout()
         print("Mode3 selected.")
 
     def on_mode4(self):
         """Handle selecting Mode4."""
         self.chosen_mode = 4
-        self.spi_handler.set_led_color(255, 0, 0, 0, 4)
+        self.spi_handler.apply_lighting_scene(mode=4)
         self.reset_timeout()
         print("Mode4 selected.")
 
     def on_mode5(self):
         """Handle selecting Mode5."""
         self.chosen_mode = 5
-        self.spi_handler.set_led_color(255, 0, 0, 0, 5)
+        self.spi_handler.apply_lighting_scene(mode=5)
         self.reset_timeout()
         print("Mode5 selected.")
 
     def on_cancel(self):
         """
         Cancel the change:
-         - Check lockers.json for the original LED color values
-         - Reapply those values to all lockers
+         - Take the saved LED colours from the app's locker data
+         - Queue them as one lighting scene (returns immediately)
          - Close the frame.
         """
-        try:
-            with open("lockers.json", "r") as file:
-                lockers = json.load(file)
-        except Exception as e:
-            print(f"Error reading lockers.json: {e}")
-            self.hide()
-            return
-
-        # For each locker, reapply the stored RGB values with full mode (0xFF)
-        for locker_id, locker in lockers.items():
-            red = locker.get("red", 125)
-            green = locker.get("green", 125)
-            blue = locker.get("blue", 125)
+        colors = {}
+        for locker_id, locker in getattr(self.master, "locker_data", {}).items():
             try:
                 locker_number = int(locker_id)
             except ValueError:
                 continue
-            self.spi_handler.set_led_color(locker_number, red, green, blue, 0xFF)
-            time.sleep(0.05)
-        print("Reverted to original colors for all lockers from lockers.json.")
+            colors[locker_number] = (locker.get("red", 125), locker.get("green", 125),
+                                     locker.get("blue", 125), 0xFF)
+        if self.spi_handler and colors:
+            self.spi_handler.apply_lighting_scene(colors)
+        print("Reverted to the saved colors for all lockers (app locker data).")
         self.hide()
 
     def on_save(self):
@@ -1696,7 +1686,7 @@ class VentilationFrame(tk.Frame):
         print(f"[VentilationFrame] mode = {mode}")
 
         if self.spi_handler:
-            self.spi_handler.send_command(0x04, [mode, 0xFF, 0xFF, 0xFF, 0xFF])
+            self.spi_handler.set_fan_mode(mode)
 
         self._write_fan_file(mode)
         self.hide()
@@ -1710,7 +1700,7 @@ class VentilationFrame(tk.Frame):
         print(f"[VentilationFrame] Toggled => mode = {mode}")
 
         if self.spi_handler:
-            self.spi_handler.send_command(0x04, [mode, 0xFF, 0xFF, 0xFF, 0xFF])
+            self.spi_handler.set_fan_mode(mode)
 
         self._write_fan_file(mode)
 
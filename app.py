@@ -5,9 +5,11 @@ import time
 import os
 from admin_frames import AdminOptionsFrame, PriceEntryFrame, InformationFrame, RGBEntryFrame, PaymentPopupFrame, PinEntryFrame, SetPinFrame, LightingModeFrame, VentilationFrame
 from utils import load_locker_data, save_locker_data, send_command, log_event
-from spi_handler import SPIHandler
+from spi_boards import SPIBoardRegistry
 from scheduler import Scheduler
-from mdb_handler import MDBHandler
+from mdb_handler import MDBHandler, ReaderSupervisor
+from mdb_async import AsyncMDBClient, SpeculativeVend
+import concurrent.futures
 import threading
 from gui import (
     size, 
@@ -96,31 +98,43 @@ class VendingMachineApp(tk.Tk):
 
         self.protocol("WM_DELETE_WINDOW", self.on_close)  # Ensure SPI is closed on exit
 
-        self.mdb_handler = MDBHandler(port="/dev/ttyACM0", debug=True)
+        self.mdb_handler = MDBHandler(port=os.environ.get("MDB_PORT", "/dev/ttyACM0"), debug=True)
         try:
             self.mdb_handler.init_serial()
             self.mdb_handler.init_devices()
         except Exception as e:
             #messagebox.showerror("Error", f"MDB Initialization Failed: {e}")
             self.mdb_handler = None
+        self.mdb_client = AsyncMDBClient(self.mdb_handler) if self.mdb_handler else None
+        self._vend_future = None
+        # Keeps the reader warm so payments can skip the D,STATUS preflight
+        self.reader_supervisor = None
+        if self.mdb_handler:
+            self.reader_supervisor = ReaderSupervisor(self.mdb_handler,
+                                                      busy=lambda: self.mdb_client.busy)
+            self.reader_supervisor.start(ready=True)
+        # Optional: open the vend as soon as a locker is selected, before PAY
+        self.speculative_vend = False
+        self._speculation = None
 
 
 
         # SPIHandler initialization with error handling
         try:
-            self.spi_handler = SPIHandler(app=self, bot_queue = self.bot_queue, bus=0, device=0, speed_hz=500000)
+            # One SPIHandler per STM32 board (boards.json); a single board by default.
+            # The clock is calibrated per board; 500 kHz stays if echo is unsupported.
+            self.spi_handler = SPIBoardRegistry(app=self, bot_queue=self.bot_queue,
+                                                speed_hz=500000, clock="auto")
             self.spi_enabled = True
             print("SPI initialized successfully.")
-            self.transfer_rgb_to_stm32()
-            self.transfer_prices_to_stm32()
-            self.transfer_fan_mode_from_file()
+            self.resync_stm32()
 
             # Assign SPI handler to RGBEntryFrame and AdminOptionsFrame
             self.rgb_entry_frame.spi_handler = self.spi_handler
             self.admin_options_frame.spi_handler = self.spi_handler
             self.lighting_mode_frame.spi_handler = self.spi_handler
 
-        except (ImportError, FileNotFoundError, AttributeError) as e:
+        except (ImportError, FileNotFoundError, AttributeError, ValueError, KeyError) as e:
             self.spi_handler = None
             self.spi_enabled = False
             print(f"SPI not available on this system: {e}")
@@ -158,6 +172,7 @@ class VendingMachineApp(tk.Tk):
         if not button or button['state'] == 'disabled':
             print(f"Locker {locker_id} is unavailable.")
             self.selected_locker = None
+            self._drop_speculation()
             
             # Instead of blindly setting ALL buttons to BG_COLOR,
             # check for locker_pin != -1. Preserve TAG_COLOR if so.
@@ -178,6 +193,41 @@ class VendingMachineApp(tk.Tk):
         self.pay_button.config(image=self.reserved_image if selected_pin != -1 else self.pay_image)
 
         print(f"Locker {locker_id} has been selected.")
+        self._start_speculation(locker_id)
+
+    def _start_speculation(self, locker_id):
+        """Open the vend for *locker_id* ahead of PAY (speculative_vend mode)."""
+        spec = self._speculation
+        locker = self.locker_data[str(locker_id)]
+        if (spec and spec.product == locker_id and spec.amount == str(locker["price"])
+                and spec.usable()):
+            return
+        self._drop_speculation()
+        if not (self.speculative_vend and self.mdb_client):
+            return
+        if locker.get("locker_pin", -1) != -1 or not locker["price"]:
+            return  # reserved lockers ask for the PIN first, free ones skip the reader
+        print(f"Preparing the card reader for Locker {locker_id}...")
+        self._speculation = SpeculativeVend(
+            self.mdb_client, str(locker["price"]), locker_id, self.mdb_handler.VEND_TIMEOUT,
+            prepare=self.reader_supervisor.ensure_ready,
+            on_paid=lambda s: self.after(0, lambda: self._complete_speculation(s)))
+
+    def _drop_speculation(self):
+        spec, self._speculation = self._speculation, None
+        if spec and spec.cancel():
+            print(f"Card reader preparation for Locker {spec.product} torn down.")
+
+    def _complete_speculation(self, spec):
+        """The reader approved a speculative vend before PAY: finish the purchase."""
+        if spec.adopted:
+            return
+        if self._speculation is not spec:
+            self._drop_speculation()
+            self._speculation = spec
+        print(f"Locker {spec.product} paid at the reader before PAY.")
+        self.selected_locker = spec.product
+        self.process_payment()
         
 
     def process_payment(self):
@@ -228,7 +278,6 @@ class VendingMachineApp(tk.Tk):
 
             # Also set price to 10
             self.save_price_and_update_spi(locker_id, 50.0)
-            time.sleep(0.05)
 
             self.unlock_locker(locker_id)
             log_event(locker_id, price)
@@ -253,6 +302,18 @@ class VendingMachineApp(tk.Tk):
             return
         # ================= END ZERO-PRICE LOGIC ===========================
 
+        # A vend opened on selection (speculative_vend) is taken over if it asks
+        # for the current price, or if the reader already approved it
+        spec, self._speculation = self._speculation, None
+        self._vend_future = None
+        if spec and spec.product == locker_id and spec.usable() and (
+                spec.amount == str(price) or spec.future.done()):
+            self._vend_future = spec.adopt()
+        elif spec and not spec.cancel() and spec.product == locker_id and spec.usable():
+            # Approved at the old price just now – take it rather than charge twice
+            self._vend_future = spec.adopt()
+        # otherwise payment_logic opens a fresh vend for the current price
+
         # Step 1: Create the popup in the main thread
         self.payment_popup_frame.show()
 
@@ -263,50 +324,34 @@ class VendingMachineApp(tk.Tk):
                 if not self.mdb_handler:
                     raise ConnectionError("MDB Handler is not initialized.")
 
-                try:
-                    self.mdb_handler.write2Serial("D,STATUS")
-                    response = self.mdb_handler.readNWait()
-                    if not response or "RESET" in response:
-                        print("Card reader is resetting. Attempting reinitialization...")
-                        self.mdb_handler.initserial()
-                        self.mdb_handler.init_devices()
-                        print("Card reader reinitialized successfully.")
-                except Exception as reinit_error:
-                    print(f"Failed to reinitialize card reader: {reinit_error}")
-                    return  # Exit early if reinitialization fails
-
-                print(f"Requesting payment for Locker {locker_id} with Price {price}€...")
-
-                # Attempt Direct Vend
-                direct_vend = self.mdb_handler.detect_direct_vend(str(price), str(product_code))
-                if direct_vend:
-                    print("Direct Vend detected. Waiting for transaction confirmation...")
-                    for i in range(self.mdb_handler.VEND_TIMEOUT):
+                # The supervisor's lock keeps its probes off the wire during the vend
+                with self.reader_supervisor.lock:
+                    if self._vend_future is not None:
+                        print(f"Completing the vend opened when Locker {locker_id} was selected...")
+                    else:
+                        # Preflight only if the reader was not confirmed healthy moments ago
+                        if not self.reader_supervisor.ensure_ready():
+                            print("Card reader is not ready. Payment aborted.")
+                            return
+
                         if self.payment_canceled:
                             print("Payment process canceled.")
                             return
+                        print(f"Requesting payment for Locker {locker_id} with Price {price}€...")
 
-                        res = self.mdb_handler.readNWait()
-                        print(res)
-                        if "d,STATUS,RESULT,1" in res:  # Success confirmation
-                            self.payment_success = True
-                            self.mdb_handler.endTransaction(str(price), str(product_code), res)
-                            break
-                        elif "d,STATUS,RESULT,-1" in res:  # Canceled by customer
-                            print("Payment canceled by the customer.")
-                            self.mdb_handler.cancelTransaction()
-                            return
-                        elif i == self.mdb_handler.VEND_TIMEOUT - 1:
-                            self.mdb_handler.cancelTransaction()
-                            raise TimeoutError("Transaction timed out.")
-                        else:
-                            time.sleep(1)
-                else:
-                    print("Direct Vend not supported. Proceeding with Normal Vend...")
-                    if self.mdb_handler.normal_vend(str(price), str(product_code)):
-                        self.payment_success = True
-                    else:
-                        raise ValueError("Normal Vend failed or insufficient funds.")
+                        # Direct vend (or normal vend as fallback) on the asyncio client;
+                        # cancel_transaction() cancels this future
+                        deadline = time.monotonic() + self.mdb_handler.VEND_TIMEOUT
+                        self._vend_future = self.mdb_client.submit(
+                            self.mdb_client.vend(str(price), str(product_code), deadline))
+                    try:
+                        approved = self._vend_future.result()
+                    except concurrent.futures.CancelledError:
+                        print("Payment process canceled.")
+                        return
+                if not approved:
+                    raise ValueError("Payment declined or canceled at the card reader.")
+                self.payment_success = True
 
                 if self.payment_success:
                     print("Payment successful. Updating locker status...")
@@ -317,7 +362,7 @@ class VendingMachineApp(tk.Tk):
                     self.selected_locker = None
                     self.buttons[locker_id].config(bg=BG_COLOR, activebackground=BG_COLOR)
 
-                    self.unlock_locker(locker_id)
+                    self.unlock_locker(locker_id, paid=True)
                     log_event(locker_id, price)
 
                     # NEW: If pinned, revert pin => set pay button image
@@ -356,8 +401,14 @@ class VendingMachineApp(tk.Tk):
         """Handle cancellation of the payment process."""
         print("cancel_transaction called")  # Debugging statement
 
-        # Cancel the transaction with the MDB handler
-        if self.mdb_handler:
+        # Signal the payment thread first so it does not start a vend
+        self.payment_canceled = True
+
+        # A running vend is cancelled on the asyncio client (sends D,REQ,-1 at once)
+        vend = self._vend_future
+        if vend is not None and vend.cancel():
+            print("Vend cancelled in MDB client.")
+        elif self.mdb_handler:
             try:
                 self.mdb_handler.cancelTransaction()
                 print("Transaction safely canceled in MDB handler.")
@@ -367,53 +418,65 @@ class VendingMachineApp(tk.Tk):
         # Close the popup
         self.after(0, self.payment_popup_frame.hide)
 
-        # Signal the payment thread to stop (if running in a thread)
-        self.payment_canceled = True
         print("Payment process marked as canceled.")
 
 
 
     def check_reader_status_and_reinitialize(self):
         """
-        Sends a status command to the reader, checks for 'RESET' in the response,
-        and reinitializes the reader if necessary. Runs in a separate thread.
+        Ask the reader supervisor for an immediate status probe; it
+        reinitializes the reader in its own thread if it reports RESET.
         """
-        def status_thread():
-            try:
-                print("Checking reader status...")
-                self.mdb_handler.write2Serial("D,STATUS")  # Send the status command
-                response = self.mdb_handler.readNWait()
-
-                if "RESET" in response:
-                    print("Reader reset detected. Attempting reinitialization...")
-                    try:
-                        self.mdb_handler.initserial()
-                        self.mdb_handler.init_devices()
-                        print("Reader reinitialized successfully.")
-                    except Exception as e:
-                        print(f"Failed to reinitialize the reader: {e}")
-                        #messagebox.showerror("Reader Error", "Failed to reinitialize the card reader.")
-                else:
-                    print("Reader status is normal or no reset detected.")
+        if self.reader_supervisor:
+            print("Checking reader status...")
+            self.reader_supervisor.wake()
 
-            except Exception as e:
-                print(f"Error while checking reader status: {e}")
-            finally:
-                print("Status check thread finished.")
-
-        # Start the thread to run the status check
-        thread = threading.Thread(target=status_thread, daemon=True)
-        thread.start()
 
 
 
-
-    def unlock_locker(self, locker_id):
+    def unlock_locker(self, locker_id, paid=False):
+        """
+        Send the unlock command and return the SPI Future (None if SPI is off).
+        The result is reported by _report_unlock_result once the STM32 answers;
+        a *paid* unlock that fails is sent once more before the alert.
+        """
         send_command(f"UNLOCK:{locker_id}")
         if self.spi_enabled:
-            self.spi_handler.open_locker(locker_id)  # Example SPI command
+            return self._send_unlock(locker_id, paid, retry=paid)
         else:
             print("SPI is disabled, skipping SPI commands.")
+            return None
+
+    def _send_unlock(self, locker_id, paid, retry):
+        future = self.spi_handler.open_locker(locker_id)
+        future.add_done_callback(
+            lambda f: self._report_unlock_result(locker_id, f, paid, retry))
+        return future
+
+    def _report_unlock_result(self, locker_id, future, paid=False, retry=False):
+        """
+        Runs on an SPI thread. With the framed protocol the Future carries the
+        STM32 status byte; legacy commands can only be reported as sent.
+        """
+        try:
+            result = future.result()
+        except Exception as e:
+            result = e
+        framed = getattr(self.spi_handler, "protocol", "legacy") == "framed"
+        if not isinstance(result, Exception) and (not framed or result == 0):
+            print(f"Unlock of Locker {locker_id} {'confirmed' if framed else 'sent (unconfirmed)'}.")
+            return
+        print(f"Unlock of Locker {locker_id} NOT confirmed by STM32: {result}")
+        if retry:
+            print(f"Retrying the unlock of paid Locker {locker_id}...")
+            self._send_unlock(locker_id, paid, retry=False)
+            return
+        if paid:
+            text = (f"❗️ Locker {locker_id} was paid but did not open ({result}). "
+                    "Please open it for the customer.")
+        else:
+            text = f"❗️ Unlock of Locker {locker_id} was not confirmed ({result})."
+        self.bot_queue.put({"chat_id": None, "text": text})
 
     def on_button_press(self, event):
         locker_id = int(event.widget["text"])
@@ -525,7 +588,6 @@ class VendingMachineApp(tk.Tk):
         if locker_pin != -1:
             if price == 0:
                 self.save_price_and_update_spi(locker_id, 50.0)
-                time.sleep(0.05)
             self.locker_data[str(locker_id)]["locker_pin"] = -1
             save_locker_data(self.locker_data)
             self.pay_button.config(image=self.pay_image)
@@ -544,10 +606,9 @@ class VendingMachineApp(tk.Tk):
         self.locker_data[str(locker_id)]["price"] = new_price
         save_locker_data(self.locker_data)
 
-        # Send the new price to STM32
+        # Send the new price to STM32 (queued, the writer thread paces frames)
         if self.spi_enabled:
             self.spi_handler.set_price(locker_number=locker_id, price=new_price)
-            time.sleep(0.05)
         else:
             print("SPI is disabled, skipping SPI commands.")
 
@@ -580,25 +641,25 @@ class VendingMachineApp(tk.Tk):
 
 
 
-    def transfer_prices_to_stm32(self):
+    def transfer_prices_to_stm32(self, force=False):
         """
-        Transfer price information from JSON to STM32 via SPI, repeated twice for each locker.
+        Transfer price information from JSON to STM32 via SPI.
+        Lockers whose price matches the SPI shadow copy are skipped unless force is set.
         """
         if self.spi_enabled:
             for locker_id, data in self.locker_data.items():
                 price = data["price"]
                 locker_number = int(locker_id)
-                for _ in range(2):  # Send the same data twice
-                    self.spi_handler.set_price(locker_number, price)
-                    print(f"Price for Locker {locker_number} set to {price:.2f}€")
-                    time.sleep(0.05)
+                self.spi_handler.set_price(locker_number, price, force=force)
+                print(f"Price for Locker {locker_number} set to {price:.2f}€")
         else:
             print("SPI is disabled, skipping price transfer.")
 
 
-    def transfer_rgb_to_stm32(self):
+    def transfer_rgb_to_stm32(self, force=False):
         """
-        Transfer RGB color information from JSON to STM32 via SPI, repeated twice for each locker.
+        Transfer RGB color information from JSON to STM32 via SPI.
+        Lockers whose colour matches the SPI shadow copy are skipped unless force is set.
         """
         if self.spi_enabled:
             for locker_id, data in self.locker_data.items():
@@ -606,14 +667,32 @@ class VendingMachineApp(tk.Tk):
                 green = data.get("green", 0)
                 blue = data.get("blue", 0)
                 locker_number = int(locker_id)
-                for _ in range(2):  # Send the same data twice
-                    self.spi_handler.set_led_color(locker_number, red, green, blue, 0xFF)
-                    print(f"LED color for Locker {locker_number} set to RGB({red}, {green}, {blue})")
-                    time.sleep(0.05)
+                self.spi_handler.set_led_color(locker_number, red, green, blue, 0xFF, force=force)
+                print(f"LED color for Locker {locker_number} set to RGB({red}, {green}, {blue})")
         else:
             print("SPI is disabled, skipping RGB transfer.")
 
 
+    def resync_stm32(self, force=False):
+        """
+        Push the full price and RGB tables plus the fan mode to the STM32.
+        Uses the bulk table upload when the firmware acknowledges it; the
+        SPI handler falls back to per-locker frames on its own otherwise.
+        """
+        if not self.spi_enabled:
+            print("SPI is disabled, skipping STM32 resync.")
+            return
+        prices = {}
+        colors = {}
+        for locker_id, data in self.locker_data.items():
+            prices[int(locker_id)] = data["price"]
+            colors[int(locker_id)] = (data.get("red", 0), data.get("green", 0), data.get("blue", 0))
+        self.spi_handler.upload_colors(colors, force=force)
+        self.spi_handler.upload_prices(prices, force=force)
+        self.transfer_fan_mode_from_file()
+        print(f"[App] Queued STM32 resync for {len(prices)} lockers.")
+
+
     def transfer_fan_mode_from_file(self):
         """Reads logs/fan.txt, if missing => create with '0', 
         then sends that value via SPI command 0x04.
@@ -634,7 +713,7 @@ class VendingMachineApp(tk.Tk):
 
         print(f"[App] Sending fan mode {mode} from file 'fan.txt' via SPI")
         if self.spi_handler:
-            self.spi_handler.send_command(0x04, [mode, 0xFF, 0xFF, 0xFF, 0xFF])
+            self.spi_handler.set_fan_mode(mode)
 
 
 
@@ -678,6 +757,9 @@ class VendingMachineApp(tk.Tk):
         if hasattr(self, 'mdb_handler') and self.mdb_handler:
             try:
                 print("Ending communication with MDB reader...")
+                self._drop_speculation()
+                self.reader_supervisor.close()
+                self.mdb_client.close()
                 self.mdb_handler.end_comunication()
             except Exception as e:
                 print(f"Error during MDBHandler cleanup: {e}")
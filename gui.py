@@ -1,5 +1,6 @@
 #gui.py
 import tkinter as tk
+import math
 import os
 
 BG_COLOR = "#8bcbb9"
@@ -38,16 +39,33 @@ def create_locker_buttons(self):
         {"size": (170, 170), "pos": (1105, 745)}
     ]
 
+    locker_ids = sorted(int(k) for k in self.locker_data)
+    # The artwork layout covers lockers 1-14; larger walls get a plain grid
+    use_layout = all(1 <= i <= len(button_specs) for i in locker_ids)
+    if not use_layout:
+        button_specs = grid_button_specs(len(locker_ids))
+
     self.buttons = {}
-    for i, spec in enumerate(button_specs, start=1):
+    for index, i in enumerate(locker_ids):
         locker_id = str(i)
+        spec = button_specs[i-1] if use_layout else button_specs[index]
+        image = self.button_images[i-1] if use_layout else ""
         status = self.locker_data[locker_id]["status"]
-        button = tk.Button(self, image=self.button_images[i-1], text=str(i), font=("Arial", 18, "bold"), bg="#8bcbb9", activebackground="#8bcbb9", state="disabled" if not status else "normal", borderwidth=0, fg="black", highlightthickness=0)
+        button = tk.Button(self, image=image, text=str(i), font=("Arial", 18, "bold"), bg="#8bcbb9", activebackground="#8bcbb9", state="disabled" if not status else "normal", borderwidth=0, fg="black", highlightthickness=0)
         button.place(x=spec["pos"][0], y=spec["pos"][1], width=spec["size"][0], height=spec["size"][1])
         button.bind("<ButtonPress-1>", self.on_button_press)
         button.bind("<ButtonRelease-1>", self.on_button_release)
         self.buttons[i] = button
 
+def grid_button_specs(count, left=185, top=55, width=1550, height=860, gap=20):
+    """Evenly sized button slots for *count* lockers inside the locker area."""
+    cols = max(1, math.ceil(math.sqrt(count * width / height)))
+    rows = max(1, math.ceil(count / cols))
+    w = (width - gap * (cols - 1)) // cols
+    h = (height - gap * (rows - 1)) // rows
+    return [{"size": (w, h), "pos": (left + (n % cols) * (w + gap), top + (n // cols) * (h + gap))}
+            for n in range(count)]
+
 def create_pay_button(self, tk):
     self.pay_button = tk.Button(self, image=self.pay_image, command=self.process_payment, borderwidth=0, bg="#8bcbb9", activebackground="#8bcbb9", highlightthickness=0)
     self.pay_button.place(x=195, y=985, width=1530, height=150)
@@ -0,0 +1,229 @@
+# mdb_async.py
+#
+# asyncio front end for the MDB cashless master
+# -----------------------------------------------------------------------------
+# AsyncMDBClient runs an event loop on its own thread and rides on an
+# MDBHandler: commands go out through write2Serial, replies come in through
+# a handler listener. Every protocol wait is an awaitable with a deadline,
+# so several waits can be in flight on the one loop.
+#
+# Usage (from any thread):
+#   client = AsyncMDBClient(mdb_handler)
+#   future = client.submit(client.vend(price, product, time.monotonic() + 10))
+#   future.cancel()      # Cancel button – D,REQ,-1 goes out within ms
+#   future.result()      # True approved, False declined / cancelled at the reader
+#
+# SpeculativeVend opens a vend when a locker is selected, before PAY: PAY
+# adopts the running vend, a selection change or the hold timeout tears it
+# down with D,REQ,-1. Vends run one at a time, so a new D,REQ never
+# overtakes the D,REQ,-1 of the session it replaces.
+#
+# While a vend runs the client claims every reader event. The one reply owed
+# to each closing D,END / D,REQ,-1 (for at most _QUIET_SEC) is claimed and
+# dropped, even if the next vend has already started, so a late reply from
+# an old session neither ends the new one nor lands in MDBHandler's queue.
+# -----------------------------------------------------------------------------
+
+import asyncio
+import collections
+import threading
+import time
+
+
+class AsyncMDBClient:
+    _QUIET_SEC = 1.0        # longest wait for the reply to a closing command
+    _BACKLOG = 32           # unclaimed events kept for the next wait_for()
+
+    def __init__(self, handler):
+        self.handler = handler
+        self.loop = asyncio.new_event_loop()
+        self._waiters = []              # [(kinds, asyncio.Future)] – loop thread only
+        self._backlog = collections.deque(maxlen=self._BACKLOG)
+        self._active = 0                # vends in progress
+        self._closing = 0               # replies still owed to D,END / D,REQ,-1
+        self._quiet_until = 0.0
+        self._claim_lock = threading.Lock()
+        self._session_lock = None       # asyncio.Lock, made on the loop thread
+        self._thread = threading.Thread(target=self.loop.run_forever,
+                                        daemon=True, name="MDBAsync")
+        self._thread.start()
+        handler.add_listener(self._on_event)
+
+    @property
+    def busy(self):
+        """True while a vend runs or its late replies are still expected."""
+        return bool(self._active) or (bool(self._closing) and time.monotonic() < self._quiet_until)
+
+    def submit(self, coro):
+        """Schedule *coro* on the client loop; returns a concurrent Future."""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def close(self):
+        if self._on_event in self.handler.listeners:
+            self.handler.listeners.remove(self._on_event)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join(timeout=2)
+        if not self._thread.is_alive():
+            self.loop.close()
+
+    # ------------------------------------------------------------------
+    # Event plumbing
+    # ------------------------------------------------------------------
+    def _on_event(self, event):
+        """MDBHandler listener (reader thread): claim events while vending."""
+        with self._claim_lock:
+            if self._closing and time.monotonic() < self._quiet_until:
+                self._closing -= 1
+                return True             # reply to a closed session – drop it
+            self._closing = 0
+            if not self._active:
+                return False
+        self.loop.call_soon_threadsafe(self._dispatch, event)
+        return True
+
+    def _close_session(self, message):
+        """Send a closing command whose reply nobody waits for."""
+        with self._claim_lock:
+            self._closing += 1
+            self._quiet_until = time.monotonic() + self._QUIET_SEC
+        self.handler.write2Serial(message)
+
+    def _dispatch(self, event):
+        matched = False
+        for kinds, future in self._waiters:
+            if not future.done() and (kinds is None or event.kind in kinds):
+                future.set_result(event)
+                matched = True
+        if not matched:
+            self._backlog.append(event)
+
+    async def wait_for(self, kinds, deadline):
+        """
+        Next event whose kind is in *kinds* (any if None); TimeoutError once
+        the time.monotonic() *deadline* passes.
+        """
+        for event in self._backlog:
+            if kinds is None or event.kind in kinds:
+                self._backlog.remove(event)
+                return event
+        entry = (kinds, self.loop.create_future())
+        self._waiters.append(entry)
+        try:
+            return await asyncio.wait_for(entry[1], max(0.0, deadline - time.monotonic()))
+        except asyncio.TimeoutError:
+            raise TimeoutError(f"No {'/'.join(kinds or ('reply',))} from the card reader in time")
+        finally:
+            self._waiters.remove(entry)
+
+    async def request(self, message, kinds, deadline):
+        """Send *message* and wait for its reply (see wait_for)."""
+        self.handler.write2Serial(message)
+        return await self.wait_for(kinds, deadline)
+
+    # ------------------------------------------------------------------
+    # Vend
+    # ------------------------------------------------------------------
+    async def vend(self, amount, product, deadline):
+        """
+        One vend of *amount* for *product*, bounded by the time.monotonic()
+        *deadline*. Returns True if the reader approved it, False if it was
+        declined or cancelled at the reader. Cancelling the task, or missing
+        the deadline (TimeoutError), sends D,REQ,-1 right away. A vend that
+        is still being torn down sends its D,REQ,-1 before this D,REQ goes out.
+        """
+        if self._session_lock is None:
+            self._session_lock = asyncio.Lock()
+        async with self._session_lock:
+            return await self._vend(amount, product, deadline)
+
+    async def _vend(self, amount, product, deadline):
+        self._backlog.clear()           # nothing received before D,REQ answers it
+        self._active += 1
+        try:
+            reply = await self.request(f"D,REQ,{amount},{product}", ("STATUS", "ERR"), deadline)
+            if reply.kind == "STATUS" and reply.value == "VEND":
+                # Direct vend: the reader reports the outcome on its own
+                result = await self.wait_for(("RESULT",), deadline)
+                if result.value != 1:
+                    print("Payment canceled by the customer.")
+                    self._close_session("D,REQ,-1")
+                    return False
+                print(f"Transaction SUCCESS: {amount}€ for product {product}")
+                self._close_session("D,END")
+                return True
+
+            # Normal vend: wait for payment media, then request again
+            print("Please insert payment media...")
+            credit = await self.wait_for(("CREDIT",), deadline)
+            if credit.value < float(amount):
+                print("Insufficient credit.")
+                self._close_session("D,REQ,-1")   # end the session, return the media
+                return False
+            reply = await self.request(f"D,REQ,{amount},{product}", ("STATUS", "ERR"), deadline)
+            return reply.kind == "STATUS" and reply.value == "VEND"
+
+        except (asyncio.CancelledError, TimeoutError):
+            self._close_session("D,REQ,-1")
+            raise
+        finally:
+            self._active -= 1
+
+    async def speculative_vend(self, amount, product, deadline, prepare=None):
+        """
+        vend() started ahead of PAY. *prepare()* (e.g. ReaderSupervisor.
+        ensure_ready) runs first in a worker thread; ConnectionError if it
+        reports the reader unusable.
+        """
+        if prepare is not None and not await self.loop.run_in_executor(None, prepare):
+            raise ConnectionError("Card reader is not ready")
+        return await self.vend(amount, product, deadline)
+
+
+class SpeculativeVend:
+    """
+    A vend opened on locker selection. adopt() hands it to the PAY flow;
+    cancel() or the hold timeout tears it down. If the reader approves
+    before PAY, *on_paid(spec)* runs on the client thread.
+    """
+
+    HOLD_SEC = 30           # selection → teardown unless PAY adopts it
+
+    def __init__(self, client, amount, product, vend_timeout, prepare=None,
+                 on_paid=None, hold_sec=None):
+        hold = self.HOLD_SEC if hold_sec is None else hold_sec
+        self.amount = amount            # what D,REQ asks the reader for
+        self.product = product
+        self.adopted = False
+        # PAY at the last moment still leaves vend_timeout for the customer
+        deadline = time.monotonic() + hold + vend_timeout
+        self.future = client.submit(client.speculative_vend(amount, product, deadline, prepare))
+        self._timer = threading.Timer(hold, self.cancel)
+        self._timer.daemon = True
+        self._timer.start()
+        if on_paid:
+            self.future.add_done_callback(lambda f: self._done(f, on_paid))
+
+    def _done(self, future, on_paid):
+        if not future.cancelled() and future.exception() is None and future.result() \
+                and not self.adopted:
+            on_paid(self)
+
+    def usable(self):
+        """Still running, or already approved."""
+        f = self.future
+        if f.cancelled():
+            return False
+        return not f.done() or (f.exception() is None and f.result() is True)
+
+    def adopt(self):
+        """Take over the vend (PAY pressed); returns its Future."""
+        self._timer.cancel()
+        self.adopted = True
+        return self.future
+
+    def cancel(self):
+        """Tear the vend down; False if it was adopted or has already finished."""
+        self._timer.cancel()
+        if self.adopted:
+            return False
+        return self.future.cancel()
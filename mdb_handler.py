@@ -1,31 +1,108 @@
-import serial, io, time, sys, os
+# mdb_handler.py
+#
+# Serial link to the MDB cashless master (text protocol, 115200 baud)
+# -----------------------------------------------------------------------------
+# A background reader thread owns the receive side of the port: it reads raw
+# bytes, splits them into lines and parses every line into an MDBEvent:
+#   STATUS  d,STATUS,INIT / IDLE / VEND / RESET   value = state name
+#   CREDIT  d,STATUS,CREDIT,<amount>              value = float amount
+#   RESULT  d,STATUS,RESULT,1 / -1                value = int result
+#   ERR     d,ERR,"..." / D,ERR,"..."             value = message text
+#   OTHER   anything else                         value = None
+#
+# Events go onto a queue; wait_event() blocks until a matching event arrives
+# or a deadline passes, so a vend result is handled the moment its line
+# lands instead of on the next poll. readNWait() keeps its old contract
+# (raw line, or "" on timeout) on top of the same queue.
+#
+# Listeners (add_listener) see every event first, on the reader thread; if
+# one returns True the event is claimed and not queued. mdb_async uses this
+# to drive its asyncio vend flow off the same port.
+#
+# ReaderSupervisor keeps the reader warm: it probes D,STATUS in the
+# background, reinitializes on RESET / silence and caches a "ready" state,
+# so a payment can skip the preflight when the reader answered moments ago.
+# Its state is mirrored to logs/mdb_health.json for the bot's /info.
+# -----------------------------------------------------------------------------
+
+import os
+import queue
+import threading
+import time
+
+import serial
+
+from utils import save_snapshot
+
+
+class MDBEvent:
+    """One parsed line from the cashless master."""
+
+    __slots__ = ("kind", "value", "line", "ts")
+
+    def __init__(self, kind, value, line, ts=None):
+        self.kind = kind
+        self.value = value
+        self.line = line
+        self.ts = ts if ts is not None else time.monotonic()
+
+    def __repr__(self):
+        return f"MDBEvent({self.kind}, {self.value!r})"
+
+
+def parse_line(line):
+    """Parse one protocol line (without newline) into an MDBEvent."""
+    fields = line.split(",")
+    try:
+        if len(fields) >= 3 and fields[0] in ("d", "D") and fields[1] == "ERR":
+            return MDBEvent("ERR", ",".join(fields[2:]).strip('"'), line)
+        if len(fields) >= 3 and fields[0] == "d" and fields[1] == "STATUS":
+            state = fields[2]
+            if state == "CREDIT" and len(fields) > 3:
+                return MDBEvent("CREDIT", float(fields[3]), line)
+            if state == "RESULT" and len(fields) > 3:
+                return MDBEvent("RESULT", int(fields[3]), line)
+            return MDBEvent("STATUS", state, line)
+    except ValueError:
+        pass
+    return MDBEvent("OTHER", None, line)
+
 
 class MDBHandler:
     VEND_TIMEOUT = 10  # Timeout for vending operations in seconds.
+    READ_TIMEOUT = 5.0  # readNWait default (the old readline loop: 5 × 1 s serial timeout)
+    _READ_POLL_SEC = 0.2  # serial read timeout; bounds how long stopping the reader takes
 
     def __init__(self, port="/dev/ttyACM0", debug=False):
         self.port = port
         self.debug = debug
         self.ser = None
-        self.sio = None
+        self.events = queue.Queue()
+        self.last_status = None        # last STATUS value seen (INIT / IDLE / …)
+        self.listeners = []            # fn(event) → True to claim the event
+        self._write_lock = threading.Lock()
+        self._reader = None
+        self._reader_stop = None
 
     def init_serial(self):
         """Initialize the serial port."""
         try:
-            self.ser = serial.Serial(port=self.port, baudrate=115200, timeout=1)
-            self.sio = io.TextIOWrapper(io.BufferedRWPair(self.ser, self.ser))
-            time.sleep(1)  # Stabilize connection
-            if self.debug:
-                print("Serial port initialized.")
+            self._open()
         except Exception as e:
             print(f"Serial initialization error: {e}")
             raise
 
     def initserial(self):
         """Initialize serial port."""
-        self.ser = serial.Serial(port=self.port, baudrate=115200, timeout=1)
-        self.sio = io.TextIOWrapper(io.BufferedRWPair(self.ser, self.ser))
+        self._open()
+
+    def _open(self):
+        self._stop_reader()
+        if self.ser and self.ser.is_open:
+            self.ser.close()
+        self.ser = serial.Serial(port=self.port, baudrate=115200, timeout=self._READ_POLL_SEC)
         time.sleep(1)  # Allow stabilization
+        self._start_reader()
         if self.debug:
             print("Serial port initialized.")
 
@@ -34,57 +111,155 @@ class MDBHandler:
         """Cleanly close the serial communication."""
         self.write2Serial("D,READER,0")  # Disable the reader
         self.write2Serial("D,0")         # Disable the master
+        self._stop_reader()
         if self.ser and self.ser.is_open:
             self.ser.close()
             print("Serial port closed.")
 
+    # ------------------------------------------------------------------
+    # Reader thread
+    # ------------------------------------------------------------------
+    def _start_reader(self):
+        self._reader_stop = threading.Event()
+        self._reader = threading.Thread(target=self._reader_loop,
+                                        args=(self.ser, self._reader_stop),
+                                        daemon=True, name="MDBReader")
+        self._reader.start()
+
+    def _stop_reader(self):
+        if self._reader is None:
+            return
+        self._reader_stop.set()
+        if self._reader is not threading.current_thread():
+            self._reader.join(timeout=2 * self._READ_POLL_SEC + 1)
+        self._reader = None
+
+    def _reader_loop(self, ser, stop):
+        """Read raw bytes, split lines, publish parsed events."""
+        pending = bytearray()
+        while not stop.is_set():
+            try:
+                chunk = ser.read(ser.in_waiting or 1)
+            except Exception as e:
+                if not stop.is_set():
+                    print(f"MDBHandler: Reader stopped: {e}")
+                return
+            if not chunk:
+                continue
+            pending += chunk
+            while True:
+                end = pending.find(b"\n")
+                if end < 0:
+                    break
+                line = pending[:end].decode("ascii", errors="replace").strip()
+                del pending[:end + 1]
+                if line:
+                    self._publish(parse_line(line))
 
+    def _publish(self, event):
+        if self.debug:
+            print(f"Read: {event.line}")
+        if event.kind == "STATUS":
+            self.last_status = event.value
+        claimed = False
+        for listener in self.listeners:
+            claimed = listener(event) or claimed
+        if not claimed:
+            self.events.put(event)
+
+    def add_listener(self, listener):
+        """Call *listener(event)* on the reader thread for every parsed line."""
+        self.listeners.append(listener)
+
+    def wait_event(self, kinds=None, timeout=None, deadline=None):
+        """
+        Next event whose kind is in *kinds* (any kind if None), or None once
+        *timeout* seconds / the time.monotonic() *deadline* has passed.
+        Events of other kinds are consumed and dropped.
+        """
+        if deadline is None:
+            deadline = time.monotonic() + (self.READ_TIMEOUT if timeout is None else timeout)
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            try:
+                event = self.events.get(timeout=remaining)
+            except queue.Empty:
+                return None
+            if kinds is None or event.kind in kinds:
+                return event
 
+    def clear_events(self):
+        """Drop queued events nobody consumed (stale replies)."""
+        while True:
+            try:
+                self.events.get_nowait()
+            except queue.Empty:
+                return
+
+    # ------------------------------------------------------------------
+    # Commands
+    # ------------------------------------------------------------------
     def write2Serial(self, message):
         """Write a message to the serial port."""
-        self.sio.write(message + "\n")
-        self.sio.flush()
+        with self._write_lock:
+            self.ser.write((message + "\n").encode("ascii"))
+            self.ser.flush()
 
-    def readNWait(self):
-        """Read serial response with retries."""
-        for i in range(5):  # Wait for up to 500ms
-            buf = self.sio.readline()
-            if self.debug:
-                print(f"Read: {buf}")
-            if len(buf) > 0:
-                break
-            time.sleep(0.1)
-        return buf
+    def readNWait(self, timeout=None):
+        """Next line from the reader, or "" if none arrives within *timeout*."""
+        event = self.wait_event(timeout=timeout)
+        return event.line if event else ""
 
 
     def writeNReadLn(self, message):
         """Send and read response."""
         if self.debug:
             print(f"Sending: {message}")
-        self.sio.write(message + "\n")
-        self.sio.flush()
+        self.write2Serial(message)
         return self.readNWait()
 
-    def init_devices(self):
-        """Initialize MDB master and slave devices."""
-        res = self.writeNReadLn("D,2")  # Start in Direct Vend mode
+    def query_status(self, timeout=None):
+        """D,STATUS round trip: the reported state, or None without a STATUS reply."""
+        self.clear_events()
+        self.write2Serial("D,STATUS")
+        event = self.wait_event(("STATUS", "ERR"), timeout=timeout)
+        return event.value if event and event.kind == "STATUS" else None
+
+    def init_devices(self, timeout=None):
+        """Initialize MDB master and slave devices (TimeoutError after *timeout* s)."""
+        deadline = time.monotonic() + timeout if timeout is not None else None
+
+        def read():
+            if deadline is None:
+                return self.readNWait()
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError("Card reader did not become IDLE in time")
+            return self.readNWait(timeout=min(remaining, self.READ_TIMEOUT))
+
+        if self.debug:
+            print("Sending: D,2")
+        self.write2Serial("D,2")  # Start in Direct Vend mode
+        res = read()
         if 'D,ERR,"cashless master is on"' in res:
             print("Restarting cashless device...")
             self.write2Serial("D,0")  # Restart the master
             self.write2Serial("D,2")  # Send D,2 command again
-            res = self.readNWait()
+            res = read()
 
         # Wait for the slave device to send STATUS = INIT
         while 'd,STATUS,INIT' not in res:
             print("Waiting for STATUS = INIT. Please enable the reader...")
-            res = self.readNWait()
-        
+            res = read()
+
         # Enable the reader and wait for STATUS = IDLE
         self.write2Serial("D,READER,1")  # Send enable reader command
         while 'd,STATUS,IDLE' not in res:
             print("Waiting for STATUS = IDLE...")
-            res = self.readNWait()
-        
+            res = read()
+
         if self.debug:
             print("Slave device is IDLE and ready.")
 
@@ -101,19 +276,18 @@ class MDBHandler:
     def normal_vend(self, amount, product):
         """Fallback for normal vend."""
         print("Please insert payment media...")
-        response = self.readNWait()
-        if 'd,STATUS,CREDIT,' in response:
-            credit = float(response.split(",")[-1])
-            if credit >= float(amount):
-                response = self.writeNReadLn(f"D,REQ,{amount},{product}")
-                if 'd,STATUS,VEND' in response:
-                    print("Transaction Success.")
-                    return True
+        credit = self.wait_event(("CREDIT",), timeout=self.VEND_TIMEOUT)
+        if credit and credit.value >= float(amount):
+            response = self.writeNReadLn(f"D,REQ,{amount},{product}")
+            if 'd,STATUS,VEND' in response:
+                print("Transaction Success.")
+                return True
         print("Insufficient credit or failure.")
         return False
 
     def cleanup(self):
         """Close serial port."""
+        self._stop_reader()
         if self.ser:
             self.ser.close()
             print("Serial port closed.")
@@ -136,3 +310,155 @@ class MDBHandler:
             raise ValueError("Transaction Failed!")
 
 
+class ReaderSupervisor:
+    """
+    Background keep‑warm probe for the card reader. Anyone talking to the
+    reader synchronously (payments, probes) holds self.lock.
+    """
+
+    PROBE_SEC = 15          # D,STATUS probe interval
+    FRESH_SEC = 20          # a ready state younger than this skips the preflight
+    PROBE_TIMEOUT = 1.0     # D,STATUS → reply
+    INIT_TIMEOUT = 15.0     # initserial + init_devices before giving up
+    _HEALTH_PATH = os.path.join("logs", "mdb_health.json")
+
+    def __init__(self, handler, busy=None, path=_HEALTH_PATH):
+        """*busy()* returns True while something else owns the reader (a vend)."""
+        self.handler = handler
+        self.busy = busy
+        self.path = path
+        self.lock = threading.RLock()
+        self.ready = False
+        self.last_ok = 0.0              # time.monotonic() of the last good reply
+        self.up_since = None            # wall clock of the last not‑ready → ready
+        self.probes = 0
+        self.resets = 0
+        self.reinits = 0
+        self.failures = 0
+        self._reset_seen = False        # only a probe / reinit clears a RESET
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        handler.add_listener(self._on_event)
+
+    def start(self, ready=False):
+        """Start probing; *ready* when init_devices() just succeeded."""
+        if ready:
+            self._mark_ready()
+        self._thread = threading.Thread(target=self._run, daemon=True, name="MDBSupervisor")
+        self._thread.start()
+
+    def close(self):
+        self._stop.set()
+        self._wake.set()
+        if self._thread:
+            self._thread.join(timeout=self.INIT_TIMEOUT + 1)
+
+    def wake(self):
+        """Probe now instead of at the next interval."""
+        self._wake.set()
+
+    # ------------------------------------------------------------------
+    # State
+    # ------------------------------------------------------------------
+    def _on_event(self, event):
+        """Reader‑thread listener: every IDLE keeps us warm, RESET drops us."""
+        if event.kind == "STATUS" and event.value == "IDLE" and not self._reset_seen:
+            self._mark_ready()
+        elif event.kind == "STATUS" and event.value == "RESET":
+            self._mark_reset()
+            self._wake.set()
+        return False
+
+    def _mark_ready(self, confirmed=False):
+        if confirmed:
+            self._reset_seen = False
+        self.last_ok = time.monotonic()
+        if not self.ready:
+            self.ready = True
+            self.up_since = time.time()
+            print("MDBHandler: Card reader ready.")
+            self._export()
+
+    def _mark_reset(self):
+        self.ready = False
+        if not self._reset_seen:
+            self._reset_seen = True
+            self.resets += 1
+            print("MDBHandler: Card reader reset detected.")
+            self._export()
+
+    def ensure_ready(self, max_age=None):
+        """
+        True if the reader is usable: at once when it was confirmed healthy
+        within *max_age* seconds (FRESH_SEC), otherwise after a probe and,
+        if needed, a reinitialization.
+        """
+        max_age = self.FRESH_SEC if max_age is None else max_age
+        with self.lock:
+            if self.ready and time.monotonic() - self.last_ok < max_age:
+                return True
+            return self.probe()
+
+    def probe(self):
+        """D,STATUS now; reinitialize on RESET or no reply. Returns readiness."""
+        with self.lock:
+            self.probes += 1
+            try:
+                status = self.handler.query_status(self.PROBE_TIMEOUT)
+            except Exception as e:
+                print(f"MDBHandler: Status probe failed: {e}")
+                status = None
+            if status not in (None, "RESET"):
+                self._mark_ready(confirmed=True)
+                return True
+
+            if status == "RESET":
+                self._mark_reset()
+            elif self.ready:
+                self.ready = False
+            print(f"MDBHandler: Reader status {status or 'missing'} – reinitializing...")
+            try:
+                self.handler.initserial()
+                self.handler.init_devices(timeout=self.INIT_TIMEOUT)
+            except Exception as e:
+                self.failures += 1
+                print(f"MDBHandler: Reinitialization failed: {e}")
+                self._export()
+                return False
+            self.reinits += 1
+            self._mark_ready(confirmed=True)
+            self._export()
+            return True
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wake.wait(self.PROBE_SEC)
+            self._wake.clear()
+            if self._stop.is_set():
+                return
+            if self.busy and self.busy():
+                continue
+            # A payment holding the lock is talking to the reader right now
+            if not self.lock.acquire(blocking=False):
+                continue
+            try:
+                self.probe()
+            finally:
+                self.lock.release()
+
+    def snapshot(self):
+        """Reader state as a dict; written to mdb_health.json on every change."""
+        return {
+            "ready": self.ready,
+            "since": self.up_since,
+            "uptime_sec": time.time() - self.up_since if self.ready and self.up_since else 0.0,
+            "last_ok_age_sec": time.monotonic() - self.last_ok if self.last_ok else None,
+            "probes": self.probes,
+            "resets": self.resets,
+            "reinits": self.reinits,
+            "failures": self.failures,
+        }
+
+    def _export(self):
+        save_snapshot(self.path, self.snapshot(), "MDBHandler")
@@ -0,0 +1,418 @@
+# mdb_simulator.py
+#
+# Software stand‑in for the MDB cashless master on a pseudo‑terminal
+# -----------------------------------------------------------------------------
+# Opens a pty and speaks the text protocol MDBHandler expects, so the payment
+# path runs end to end without the reader on /dev/ttyACM0:
+#   • D,2 / D,0                 master on / off (D,ERR,"cashless master is on")
+#   • D,READER,1 / D,READER,0   INIT → IDLE
+#   • D,STATUS                  d,STATUS,<state>
+#   • D,REQ,<amount>,<product>  direct vend: d,STATUS,VEND, later RESULT,1/-1
+#                               normal vend: d,ERR,"-1", later CREDIT,<amount>
+#   • D,REQ,-1 / D,END          cancel / close the session
+#
+# Scriptable behaviour:
+#   • latency + jitter on every reply, approve_after for the customer's tap
+#   • per‑vend outcomes from a script ("approve", "decline", "timeout",
+#     "reset") or drawn from decline_rate / reset_rate
+#   • drop_rate – fraction of vend‑session lines (VEND, RESULT, CREDIT,
+#     ERR) silently lost; init / status replies always arrive
+#   • reset() – the reader drops off the bus and announces d,STATUS,RESET
+#
+# Usage:
+#   python mdb_simulator.py serve                     # prints the pty path
+#   MDB_PORT=/dev/pts/N python main.py                # app against the simulator
+#   python mdb_simulator.py bench --vends 200 --latency 0.005
+#   python mdb_simulator.py bench --vends 50 --decline-rate 0.2 --drop-rate 0.05 --reset-rate 0.05
+#   python mdb_simulator.py check                     # protocol regressions, exit 1 on failure
+# -----------------------------------------------------------------------------
+
+import argparse
+import collections
+import heapq
+import os
+import random
+import select
+import threading
+import time
+import tty
+
+
+class MDBSimulator:
+    """Cashless master model behind one pty; self.port is the device path."""
+
+    OUTCOMES = ("approve", "decline", "timeout", "reset")
+
+    def __init__(self, latency=0.0, jitter=0.0, approve_after=0.3, direct_vend=True,
+                 decline_rate=0.0, reset_rate=0.0, drop_rate=0.0, script=None, seed=None):
+        self.latency = latency              # command → reply
+        self.jitter = jitter                # + uniform(0, jitter)
+        self.approve_after = approve_after  # VEND → RESULT (or ERR → CREDIT)
+        self.direct_vend = direct_vend
+        self.decline_rate = decline_rate
+        self.reset_rate = reset_rate
+        self.drop_rate = drop_rate
+        self.script = collections.deque(script or ())
+        self.random = random.Random(seed)
+
+        self.lock = threading.Lock()
+        self.master_on = False
+        self.state = "OFF"                  # OFF / INIT / IDLE / VEND / CREDIT / RESET
+        self.credit = 0.0
+        self.stats = collections.Counter()
+        self.charged = []                   # amounts of approved direct vends
+        self.commands_seen = collections.Counter()
+        self._session = 0                   # bumps on cancel / reset; stale timers are ignored
+
+        self._fd, slave = os.openpty()
+        tty.setraw(slave)
+        self.port = os.ttyname(slave)
+        self._slave = slave                 # keep open so the pty survives reopen
+        self._outgoing = []                 # heap of (due, seq, line, droppable)
+        self._seq = 0
+        self._cond = threading.Condition()
+        self._running = True
+        self._threads = [threading.Thread(target=self._reader_loop, daemon=True, name="MDBSimReader"),
+                         threading.Thread(target=self._writer_loop, daemon=True, name="MDBSimWriter")]
+        for thread in self._threads:
+            thread.start()
+
+    def close(self):
+        self._running = False
+        with self._cond:
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join(timeout=1)
+        os.close(self._fd)
+        os.close(self._slave)
+
+    # ------------------------------------------------------------------
+    # Wire
+    # ------------------------------------------------------------------
+    def _reader_loop(self):
+        pending = b""
+        while self._running:
+            ready, _, _ = select.select([self._fd], [], [], 0.1)
+            if not ready:
+                continue
+            try:
+                pending += os.read(self._fd, 256)
+            except OSError:
+                return
+            while b"\n" in pending:
+                line, pending = pending.split(b"\n", 1)
+                line = line.decode("ascii", errors="replace").strip()
+                if line:
+                    self._handle(line)
+
+    def _writer_loop(self):
+        with self._cond:
+            while self._running:
+                if not self._outgoing:
+                    self._cond.wait(0.1)
+                    continue
+                due = self._outgoing[0][0]
+                now = time.monotonic()
+                if due > now:
+                    self._cond.wait(due - now)
+                    continue
+                _, _, line, droppable = heapq.heappop(self._outgoing)
+                if droppable and self.random.random() < self.drop_rate:
+                    self.stats["dropped"] += 1
+                    continue
+                os.write(self._fd, (line + "\r\n").encode("ascii"))
+                self.stats["lines_out"] += 1
+
+    def send(self, line, delay=None, droppable=False):
+        """Queue *line* for the Pi after *delay* (default: latency + jitter)."""
+        if delay is None:
+            delay = self.latency + (self.random.uniform(0, self.jitter) if self.jitter else 0.0)
+        with self._cond:
+            self._seq += 1
+            heapq.heappush(self._outgoing, (time.monotonic() + delay, self._seq, line, droppable))
+            self._cond.notify()
+
+    def _later(self, delay, func, *args):
+        """Run *func* after *delay* unless a cancel / reset intervened."""
+        session = self._session
+
+        def fire():
+            with self.lock:
+                if session == self._session:
+                    func(*args)
+        timer = threading.Timer(delay, fire)
+        timer.daemon = True
+        timer.start()
+
+    # ------------------------------------------------------------------
+    # Protocol
+    # ------------------------------------------------------------------
+    def _handle(self, line):
+        fields = line.split(",")
+        with self.lock:
+            self.commands_seen[",".join(fields[:2])] += 1
+            if fields[:2] == ["D", "2"]:
+                if self.master_on:
+                    self.send('D,ERR,"cashless master is on"')
+                    return
+                self.master_on = True
+                self.state = "INIT"
+                self.send("d,STATUS,INIT")
+            elif fields[:2] == ["D", "0"]:
+                self._end_session()
+                self.master_on = False
+                self.state = "OFF"
+            elif fields[:2] == ["D", "READER"] and len(fields) > 2:
+                if not self.master_on:
+                    self.send('d,ERR,"cashless master is off"')
+                elif fields[2] == "1":
+                    self.state = "IDLE"
+                    self.send("d,STATUS,IDLE")
+                else:
+                    self.state = "INIT"
+            elif fields[:2] == ["D", "STATUS"]:
+                self.send(f"d,STATUS,{self.state}")
+            elif fields[:2] == ["D", "REQ"] and fields[2:3] == ["-1"]:
+                self._cancel()
+            elif fields[:2] == ["D", "REQ"] and len(fields) >= 4:
+                self._request(float(fields[2]))
+            elif fields[:2] == ["D", "END"]:
+                self._end_session()
+                self.state = "IDLE"
+                self.send("d,STATUS,IDLE")
+            else:
+                self.send('d,ERR,"unknown command"')
+
+    def _request(self, amount):
+        if self.state == "CREDIT":
+            # Normal vend: payment media already presented
+            if amount <= self.credit:
+                self.stats["approved"] += 1
+                self.send("d,STATUS,VEND", droppable=True)
+            else:
+                self.stats["declined"] += 1
+                self.send('d,ERR,"insufficient credit"', droppable=True)
+            self._end_session()
+            self.state = "IDLE"
+            return
+        if self.state != "IDLE":
+            self.send(f'd,ERR,"reader is {self.state.lower()}"')
+            return
+
+        outcome = self._next_outcome()
+        self.stats["requests"] += 1
+        if self.direct_vend:
+            self.state = "VEND"
+            self.send("d,STATUS,VEND", droppable=True)
+        else:
+            self.state = "WAIT"
+            self.send('d,ERR,"-1"', droppable=True)
+        if outcome == "timeout":
+            self.stats["timeouts"] += 1
+        elif outcome == "reset":
+            self._later(self.approve_after, self._reset)
+        else:
+            self._later(self.approve_after, self._outcome, amount, outcome == "approve")
+
+    def _outcome(self, amount, approved):
+        if not self.direct_vend:
+            self.state = "CREDIT"
+            self.credit = amount if approved else amount / 2
+            self.send(f"d,STATUS,CREDIT,{self.credit:.2f}", delay=0.0, droppable=True)
+            return
+        self.stats["approved" if approved else "declined"] += 1
+        if approved:
+            self.charged.append(amount)
+        self.state = "IDLE"
+        self.send(f"d,STATUS,RESULT,{1 if approved else -1}", delay=0.0, droppable=True)
+
+    def _cancel(self):
+        pending = self.state in ("VEND", "WAIT", "CREDIT")
+        self._end_session()
+        self.state = "IDLE" if self.master_on else self.state
+        if pending:
+            self.stats["cancelled"] += 1
+            self.send("d,STATUS,RESULT,-1")
+        else:
+            self.send(f"d,STATUS,{self.state}")
+
+    def _end_session(self):
+        self._session += 1
+        self.credit = 0.0
+
+    def _next_outcome(self):
+        if self.script:
+            outcome = self.script.popleft()
+            if outcome not in self.OUTCOMES:
+                raise ValueError(f"Unknown scripted outcome {outcome!r}")
+            return outcome
+        r = self.random.random()
+        if r < self.reset_rate:
+            return "reset"
+        if r < self.reset_rate + self.decline_rate:
+            return "decline"
+        return "approve"
+
+    def reset(self):
+        """The reader drops off the bus: master off, d,STATUS,RESET."""
+        with self.lock:
+            self._reset()
+
+    def _reset(self):
+        self._end_session()
+        self.master_on = False
+        self.state = "RESET"
+        self.stats["resets"] += 1
+        self.send("d,STATUS,RESET", delay=0.0)
+
+
+# -----------------------------------------------------------------------------
+#  CLI
+# -----------------------------------------------------------------------------
+def bench(sim, vends, price, deadline_sec):
+    """Vends through MDBHandler + AsyncMDBClient, as process_payment does."""
+    from mdb_async import AsyncMDBClient
+    from mdb_handler import MDBHandler
+
+    handler = MDBHandler(port=sim.port)
+    handler.init_serial()
+    handler.init_devices()
+    client = AsyncMDBClient(handler)
+    results = collections.Counter()
+    latencies = []
+    start = time.monotonic()
+    for i in range(vends):
+        while client.busy:              # late replies of the last vend still belong to it
+            time.sleep(0.01)
+        if handler.last_status == "RESET":
+            handler.init_devices()
+            results["reinit"] += 1
+        began = time.monotonic()
+        try:
+            approved = client.submit(client.vend(price, 1 + i % 14, began + deadline_sec)).result()
+            results["approved" if approved else "declined"] += 1
+            latencies.append(time.monotonic() - began)
+        except TimeoutError:
+            results["timeout"] += 1
+    elapsed = time.monotonic() - start
+    client.close()
+    handler.cleanup()
+
+    latencies.sort()
+    print("\n=== MDB simulator bench ===")
+    print(f"vends    : {vends} in {elapsed:.2f} s ({vends / elapsed:.1f}/s)")
+    print(f"client   : {dict(results)}")
+    print(f"simulator: {dict(sim.stats)}")
+    if latencies:
+        last = len(latencies) - 1
+        print(f"latency  : p50 {latencies[int(0.5 * last)] * 1000:.1f} ms, "
+              f"p95 {latencies[int(0.95 * last)] * 1000:.1f} ms, max {latencies[-1] * 1000:.1f} ms")
+
+
+def check(sim):
+    """
+    Regression scenarios for the speculative vend path; returns the number
+    of failures.
+      reselect – select a locker, select another before the reader answers,
+                 press PAY: the late RESULT,-1 of the first session must not
+                 decline the second
+      hold     – an unadopted preparation is torn down after its hold time
+      reprice  – the price changes between selection and PAY: the old vend
+                 is cancelled and only the new price is charged
+    """
+    from mdb_async import AsyncMDBClient, SpeculativeVend
+    from mdb_handler import MDBHandler, ReaderSupervisor
+
+    sim.approve_after = max(sim.approve_after, 0.5)   # room to reselect before the tap
+    handler = MDBHandler(port=sim.port)
+    handler.init_serial()
+    handler.init_devices()
+    client = AsyncMDBClient(handler)
+    supervisor = ReaderSupervisor(handler, busy=lambda: client.busy, path=None)
+    supervisor.start(ready=True)
+    failures = 0
+
+    def report(name, ok, detail):
+        nonlocal failures
+        failures += not ok
+        print(f"{'PASS' if ok else 'FAIL'}  {name:9} {detail}")
+
+    try:
+        first = SpeculativeVend(client, "2.5", 3, 5, prepare=supervisor.ensure_ready)
+        time.sleep(0.1)
+        first.cancel()
+        second = SpeculativeVend(client, "2.5", 4, 5, prepare=supervisor.ensure_ready)
+        try:
+            approved = second.adopt().result(timeout=10)
+        except Exception as e:
+            approved = e
+        report("reselect", approved is True, f"PAY result {approved!r}, simulator {dict(sim.stats)}")
+
+        while client.busy:
+            time.sleep(0.01)
+        held = SpeculativeVend(client, "2.5", 5, 5, prepare=supervisor.ensure_ready, hold_sec=0.2)
+        time.sleep(0.4)
+        report("hold", held.future.cancelled(), f"cancelled={held.future.cancelled()}")
+
+        while client.busy:
+            time.sleep(0.01)
+        del sim.charged[:]
+        stale = SpeculativeVend(client, "2.5", 6, 5, prepare=supervisor.ensure_ready)
+        time.sleep(0.1)
+        price = "3.0"                   # admin changed it; PAY follows app.process_payment
+        if stale.amount != price and stale.cancel():
+            vend = client.submit(client.vend(price, 6, time.monotonic() + 5))
+        else:
+            vend = stale.adopt()
+        try:
+            approved = vend.result(timeout=10)
+        except Exception as e:
+            approved = e
+        report("reprice", approved is True and sim.charged == [3.0],
+               f"PAY result {approved!r}, charged {sim.charged}")
+    finally:
+        supervisor.close()
+        client.close()
+        handler.cleanup()
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description="MDB cashless-master simulator on a pty")
+    parser.add_argument("mode", choices=("serve", "bench", "check"))
+    parser.add_argument("--latency", type=float, default=0.005)
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--approve-after", type=float, default=0.05)
+    parser.add_argument("--normal-vend", action="store_true", help="no direct vend support")
+    parser.add_argument("--decline-rate", type=float, default=0.0)
+    parser.add_argument("--reset-rate", type=float, default=0.0)
+    parser.add_argument("--drop-rate", type=float, default=0.0)
+    parser.add_argument("--script", default="", help="comma-separated outcomes, e.g. approve,decline,reset")
+    parser.add_argument("--vends", type=int, default=100)
+    parser.add_argument("--price", type=float, default=2.5)
+    parser.add_argument("--deadline", type=float, default=2.0, help="per-vend deadline (s)")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    sim = MDBSimulator(latency=args.latency, jitter=args.jitter, approve_after=args.approve_after,
+                       direct_vend=not args.normal_vend, decline_rate=args.decline_rate,
+                       reset_rate=args.reset_rate, drop_rate=args.drop_rate, seed=args.seed,
+                       script=[s for s in args.script.split(",") if s])
+    try:
+        if args.mode == "serve":
+            print(f"MDB simulator on {sim.port} – Ctrl+C to stop")
+            while True:
+                time.sleep(1)
+        if args.mode == "check":
+            if check(sim):
+                raise SystemExit(1)
+            return
+        bench(sim, args.vends, args.price, args.deadline)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sim.close()
+
+
+if __name__ == "__main__":
+    main()
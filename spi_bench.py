@@ -0,0 +1,257 @@
+# spi_bench.py
+#
+# Micro‑benchmark for the SPIHandler transfer paths
+# -----------------------------------------------------------------------------
+# Every row is printed twice: "xfer2" is the baseline (every frame through
+# xfer2(), as before), "write" the current path (write‑only frames through
+# writebytes2(), reads through xfer2()).
+#
+# wire      – one call per frame on the device itself: a 6‑byte command, a
+#             9‑byte framed command, a 4‑frame batch and a 4 KiB bulk chunk.
+#             With --spidev BUS.DEV this is the real py‑spidev driver on the
+#             Pi; the frames are all 0xFF, which an attached STM32 takes as
+#             dummy phases. Without it a stand‑in copies the argument the
+#             way py‑spidev does (xfer2: list + reply list, writebytes2:
+#             buffer as is), so only the Python side is measured.
+# handler   – SPIHandler end to end against in‑process stand‑ins:
+#   read          – interrupt reads (dummy + response) from a stand‑in that
+#                   always answers 0xFE, so no frame decoding is included
+#   legacy        – 6‑byte commands through the writer thread
+#   framed        – framed commands, one frame per transfer
+#   framed-batch  – framed commands, batch=True (several frames per transfer)
+#
+# Columns: transfers and bytes per operation, tracemalloc peak and net
+# blocks (Python allocations only), wall time per operation.
+#
+# Usage:
+#   python spi_bench.py [--ops 2000] [--gap 0.0] [--spidev 0.0]
+# -----------------------------------------------------------------------------
+
+import argparse
+import contextlib
+import io
+import os
+import queue
+import tempfile
+import time
+import tracemalloc
+
+from spi_capture import _NullGpio, _ReplayApp
+from stm32_simulator import STM32Simulator
+
+
+class _CountingSpiDev:
+    """
+    Answers every read with the "queue empty" frame and counts transfers.
+    Arguments are copied the way py‑spidev does it.
+    """
+
+    _FRAME = [0xFE, 0, 0, 0, 0, 0]
+
+    def __init__(self):
+        self.max_speed_hz = 0
+        self.mode = 0
+        self.transfers = 0
+        self.bytes = 0
+
+    def open(self, bus, device):
+        pass
+
+    def xfer2(self, data):
+        tx = list(data)                 # PySequence_Fast
+        self.transfers += 1
+        self.bytes += len(tx)
+        if tx[0] == 0x00:
+            return list(self._FRAME)
+        return [0x00] * len(tx)
+
+    def writebytes2(self, data):
+        self.transfers += 1             # buffer protocol: no copy
+        self.bytes += len(data)
+
+    def close(self):
+        pass
+
+
+class _CountingSimDev:
+    """Simulator spidev that counts transfers and bytes."""
+
+    def __init__(self, sim):
+        self._dev = sim.spidev()
+        self.transfers = 0
+        self.bytes = 0
+
+    def __getattr__(self, name):
+        return getattr(self._dev, name)
+
+    def __setattr__(self, name, value):
+        if name in ("max_speed_hz", "mode"):
+            setattr(self._dev, name, value)
+        object.__setattr__(self, name, value)
+
+    def xfer2(self, data):
+        self.transfers += 1
+        self.bytes += len(data)
+        return self._dev.xfer2(data)
+
+    def writebytes2(self, data):
+        self.transfers += 1
+        self.bytes += len(data)
+        self._dev.writebytes2(data)
+
+
+class _SpidevCounter:
+    """Counts transfers and bytes on a real spidev.SpiDev."""
+
+    def __init__(self, dev):
+        self.dev = dev
+        self.transfers = 0
+        self.bytes = 0
+
+    def xfer2(self, data):
+        self.transfers += 1
+        self.bytes += len(data)
+        return self.dev.xfer2(data)
+
+    def writebytes2(self, data):
+        self.transfers += 1
+        self.bytes += len(data)
+        self.dev.writebytes2(data)
+
+
+def _make_handler(spi, gpio, gap, write=True, **kwargs):
+    from spi_handler import SPIHandler
+    handler = SPIHandler(_ReplayApp(), queue.Queue(), spi_dev=spi, gpio=gpio, **kwargs)
+    handler._FRAME_GAP_SEC = gap
+    handler._READ_DELAY_SEC = 0.0
+    handler._READY_POLL_SEC = 0.0
+    if not write:
+        handler._writebytes2 = None     # baseline: everything through xfer2
+    return handler
+
+
+def _measure(run, ops, spi):
+    """Run *run()* under tracemalloc; returns the result row."""
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    tracemalloc.reset_peak()
+    base, _ = tracemalloc.get_traced_memory()
+    transfers, sent = spi.transfers, spi.bytes
+    start = time.perf_counter()
+    run()
+    elapsed = time.perf_counter() - start
+    _current, peak = tracemalloc.get_traced_memory()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    blocks = sum(stat.count_diff for stat in after.compare_to(before, "filename")
+                 if stat.traceback[0].filename.endswith("spi_handler.py"))
+    return {
+        "ops": ops,
+        "xfer/op": (spi.transfers - transfers) / ops,
+        "bytes/op": (spi.bytes - sent) / ops,
+        "peak_kib": (peak - base) / 1024,
+        "net_blocks": blocks,
+        "us/op": elapsed / ops * 1e6,
+    }
+
+
+# ----------------------------------------------------------------------
+# Wire: one device call per frame
+# ----------------------------------------------------------------------
+_WIRE_FRAMES = (("cmd-6", 6), ("frame-9", 9), ("batch-36", 36), ("bulk-4096", 4096))
+
+
+def bench_wire(ops, spi, size, write):
+    view = memoryview(bytearray(b"\xff" * size))
+    call = spi.writebytes2 if write else spi.xfer2
+
+    def run():
+        for _ in range(ops):
+            call(view)
+    return _measure(run, ops, spi)
+
+
+# ----------------------------------------------------------------------
+# Handler scenarios
+# ----------------------------------------------------------------------
+def bench_read(ops, gap, write):
+    spi = _CountingSpiDev()
+    handler = _make_handler(spi, _NullGpio(), gap, write, interrupt_mode="poll")
+    try:
+        return _measure(lambda: [handler._send_dummy_and_read() for _ in range(ops)], ops, spi)
+    finally:
+        handler.close()
+
+
+def bench_commands(ops, gap, write, protocol="legacy", batch=False):
+    sim = STM32Simulator(lockers=14)
+    spi = _CountingSimDev(sim)
+    handler = _make_handler(spi, sim.gpio, gap, write, protocol=protocol, batch=batch)
+
+    def run():
+        futures = [handler.open_locker(1 + i % 14) for i in range(ops)]
+        for f in futures:
+            f.exception(timeout=30)
+    try:
+        row = _measure(run, ops, spi)
+        row["batches"] = handler.batched_transfers
+        return row
+    finally:
+        handler.close()
+
+
+def _open_spidev(spec):
+    import spidev
+    bus, device = (int(part) for part in spec.split("."))
+    dev = spidev.SpiDev()
+    dev.open(bus, device)
+    dev.max_speed_hz = 500000
+    dev.mode = 0
+    return dev
+
+
+def main():
+    parser = argparse.ArgumentParser(description="SPIHandler transfer micro-benchmark")
+    parser.add_argument("--ops", type=int, default=2000)
+    parser.add_argument("--gap", type=float, default=0.0,
+                        help="inter-frame gap for the writer (s); production uses 0.05")
+    parser.add_argument("--spidev", metavar="BUS.DEV",
+                        help="run the wire rows on /dev/spidevBUS.DEV (py-spidev)")
+    args = parser.parse_args()
+
+    # interpret_and_notify writes into ./logs – keep that out of the repo
+    os.chdir(tempfile.mkdtemp(prefix="spibench_"))
+    os.makedirs("logs", exist_ok=True)
+
+    dev = _open_spidev(args.spidev) if args.spidev else None
+    wire_spi = _SpidevCounter(dev) if dev else _CountingSpiDev()
+    scenarios = [(f"wire {name}", lambda write, size=size: bench_wire(args.ops, wire_spi, size, write))
+                 for name, size in _WIRE_FRAMES]
+    scenarios += [
+        ("read", lambda write: bench_read(args.ops, args.gap, write)),
+        ("legacy", lambda write: bench_commands(args.ops, args.gap, write)),
+        ("framed", lambda write: bench_commands(args.ops, args.gap, write, "framed")),
+        ("framed-batch", lambda write: bench_commands(args.ops, args.gap, write, "framed",
+                                                      batch=True)),
+    ]
+    rows = []
+    try:
+        for name, scenario in scenarios:
+            for write in (False, True):
+                with contextlib.redirect_stdout(io.StringIO()):   # the handler logs every frame
+                    rows.append((name, "write" if write else "xfer2", scenario(write)))
+    finally:
+        if dev:
+            dev.close()
+
+    device = f"/dev/spidev{args.spidev}" if dev else "py-spidev stand-in"
+    print(f"\n=== SPIHandler transfer benchmark (wire rows: {device}) ===")
+    print(f"{'scenario':16} {'path':6} {'ops':>6} {'xfer/op':>8} {'bytes/op':>9} "
+          f"{'peak KiB':>9} {'net blocks':>10} {'us/op':>8} {'batches':>8}")
+    for name, path, r in rows:
+        print(f"{name:16} {path:6} {r['ops']:6d} {r['xfer/op']:8.2f} {r['bytes/op']:9.1f} "
+              f"{r['peak_kib']:9.1f} {r['net_blocks']:10d} {r['us/op']:8.1f} {r.get('batches', 0):8d}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,247 @@
+# spi_boards.py
+#
+# Several STM32 boards behind one Pi: locker ranges → SPI chip‑selects
+# -----------------------------------------------------------------------------
+# boards.json (optional, next to lockers.json):
+#   {"boards": [
+#       {"name": "left",  "bus": 0, "device": 0, "interrupt_pin": 17,
+#        "reset_pin": 14, "lockers": [1, 14]},
+#       {"name": "right", "bus": 0, "device": 1, "interrupt_pin": 27,
+#        "reset_pin": 22, "lockers": [15, 40]}
+#   ]}
+# The other keys in BOARD_KEYS are passed to that board's SPIHandler, e.g.
+# "read_mode": "adaptive" for firmware that supports ready polling; an
+# unknown key is rejected with ValueError when the file is loaded.
+#
+# Every board gets its own SPIHandler – own writer thread, interrupt reader,
+# watchdog and health file – so traffic to one board never waits behind
+# another. Locker ids stay one byte on the wire: each board numbers its
+# lockers from 1 and SPIBoardRegistry translates global ↔ local ids.
+#
+# SPIBoardRegistry exposes the SPIHandler methods the app uses, so
+# app.spi_handler can be either. Without boards.json it is a single board
+# on bus 0 / device 0 driving lockers 1‑14, exactly as before.
+# -----------------------------------------------------------------------------
+
+import bisect
+import json
+import os
+import threading
+from concurrent.futures import Future
+
+from spi_handler import SPIHandler
+
+BOARDS_FILE = "boards.json"
+_BROADCAST = 255
+
+DEFAULT_BOARD = {"name": None, "bus": 0, "device": 0,
+                 "interrupt_pin": None, "reset_pin": None, "lockers": [1, 14]}
+
+# "lockers" plus the SPIHandler arguments a board entry may set
+BOARD_KEYS = frozenset({"lockers", "name", "bus", "device", "interrupt_pin", "reset_pin",
+                        "speed_hz", "clock", "protocol", "batch", "interrupt_mode",
+                        "read_mode", "bulk_mode", "drain", "capture_path"})
+
+
+def load_board_config(path=BOARDS_FILE):
+    """Board list from *path*, or the single default board if it is missing."""
+    if not os.path.exists(path):
+        return [dict(DEFAULT_BOARD)]
+    with open(path, "r", encoding="utf-8") as f:
+        boards = json.load(f)["boards"]
+
+    for board in boards:
+        for key in board:
+            if key not in BOARD_KEYS:
+                raise ValueError(f"Board {board.get('name')}: unknown key {key!r} in {path}")
+
+    spans = sorted((int(b["lockers"][0]), int(b["lockers"][1]), b.get("name")) for b in boards)
+    for (first, last, name), following in zip(spans, spans[1:] + [None]):
+        if last < first or last - first + 1 >= _BROADCAST:
+            raise ValueError(f"Board {name}: invalid locker range {first}-{last}")
+        if following and following[0] <= last:
+            raise ValueError(f"Boards {name} and {following[2]} overlap at locker {following[0]}")
+    return boards
+
+
+def gather(futures):
+    """One Future resolving to the list of results (or the first exception)."""
+    result = Future()
+    futures = list(futures)
+    if not futures:
+        result.set_result([])
+        return result
+    remaining = [len(futures)]
+    lock = threading.Lock()
+
+    def done(_f):
+        with lock:
+            remaining[0] -= 1
+            if remaining[0]:
+                return
+        for f in futures:
+            error = f.exception() if not f.cancelled() else RuntimeError("cancelled")
+            if error is not None:
+                result.set_exception(error)
+                return
+        result.set_result([f.result() for f in futures])
+
+    for f in futures:
+        f.add_done_callback(done)
+    return result
+
+
+def _failed(error):
+    future = Future()
+    future.set_exception(error)
+    return future
+
+
+class SPIBoardRegistry:
+    """Routes locker commands to the SPIHandler of the board that owns them."""
+
+    def __init__(self, app, bot_queue, boards=None, **handler_kwargs):
+        """
+        *boards* is the load_board_config() list; *handler_kwargs* (speed_hz,
+        protocol, …) are passed to every SPIHandler, a board entry may
+        override them with its own keys.
+        """
+        self.boards = []                # [(first, last, handler)] sorted by first
+        for board in boards if boards is not None else load_board_config():
+            first, last = int(board["lockers"][0]), int(board["lockers"][1])
+            kwargs = dict(handler_kwargs)
+            kwargs.update({k: v for k, v in board.items() if k != "lockers"})
+            handler = SPIHandler(app, bot_queue, locker_offset=first - 1,
+                                 locker_count=last - first + 1, **kwargs)
+            self.boards.append((first, last, handler))
+            print(f"SPIBoardRegistry: Board {board.get('name') or 'default'} "
+                  f"drives lockers {first}-{last}.")
+        self.boards.sort(key=lambda b: b[0])
+        self._firsts = [b[0] for b in self.boards]
+
+    # ------------------------------------------------------------------
+    # Routing
+    # ------------------------------------------------------------------
+    @property
+    def handlers(self):
+        return [b[2] for b in self.boards]
+
+    @property
+    def protocol(self):
+        return self.boards[0][2].protocol if self.boards else "legacy"
+
+    def board_for(self, locker):
+        """(handler, local_locker) owning global *locker*, or (None, None)."""
+        index = bisect.bisect_right(self._firsts, int(locker)) - 1
+        if index < 0:
+            return None, None
+        first, last, handler = self.boards[index]
+        if int(locker) > last:
+            return None, None
+        return handler, int(locker) - first + 1
+
+    def _route(self, locker, call):
+        handler, local = self.board_for(locker)
+        if handler is None:
+            print(f"SPIBoardRegistry: No board drives locker {locker}.")
+            return _failed(ValueError(f"No board drives locker {locker}"))
+        return call(handler, local)
+
+    def _split(self, table):
+        """{global: value} → {handler: {local: value}}."""
+        per_board = {}
+        for locker, value in table.items():
+            handler, local = self.board_for(locker)
+            if handler is None:
+                print(f"SPIBoardRegistry: No board drives locker {locker} – skipped.")
+                continue
+            per_board.setdefault(handler, {})[local] = value
+        return per_board
+
+    # ------------------------------------------------------------------
+    # SPIHandler API
+    # ------------------------------------------------------------------
+    def set_led_color(self, locker_number, red, green, blue, mode=0xFF,
+                      callback=None, force=False):
+        """Per‑locker colour, or on every board for locker 255 (list result)."""
+        if locker_number == _BROADCAST:
+            future = gather(h.set_led_color(_BROADCAST, red, green, blue, mode, force=force)
+                            for h in self.handlers)
+            if callback:
+                future.add_done_callback(callback)
+            return future
+        return self._route(locker_number, lambda h, local: h.set_led_color(
+            local, red, green, blue, mode, callback=callback, force=force))
+
+    def open_locker(self, locker_number, callback=None):
+        return self._route(locker_number,
+                           lambda h, local: h.open_locker(local, callback=callback))
+
+    def set_price(self, locker_number, price, callback=None, force=False):
+        return self._route(locker_number, lambda h, local: h.set_price(
+            local, price, callback=callback, force=force))
+
+    def set_fan_mode(self, mode, callback=None, force=False):
+        future = gather(h.set_fan_mode(mode, force=force) for h in self.handlers)
+        if callback:
+            future.add_done_callback(callback)
+        return future
+
+    def apply_lighting_scene(self, colors=None, mode=None, force=False):
+        """SPIHandler.apply_lighting_scene on every board (list result)."""
+        if colors is None:
+            return gather(h.apply_lighting_scene(mode=mode, force=force) for h in self.handlers)
+        return gather(h.apply_lighting_scene(part, force=force)
+                      for h, part in self._split(colors).items())
+
+    def upload_prices(self, prices, force=False):
+        return self._upload("upload_prices", prices, force)
+
+    def upload_colors(self, colors, force=False):
+        return self._upload("upload_colors", colors, force)
+
+    def _upload(self, method, table, force):
+        """Bulk upload per board; resolves True only if every board acked."""
+        result = Future()
+        parts = gather(getattr(h, method)(part, force=force)
+                       for h, part in self._split(table).items())
+
+        def done(f):
+            if f.exception() is not None:
+                result.set_exception(f.exception())
+            else:
+                result.set_result(all(f.result()))
+        parts.add_done_callback(done)
+        return result
+
+    def request_resync(self):
+        # app.resync_stm32() covers every board; one debounced worker is enough
+        if self.boards:
+            self.boards[0][2].request_resync()
+
+    def invalidate_shadow(self):
+        for handler in self.handlers:
+            handler.invalidate_shadow()
+
+    def shadow_state(self):
+        """SPIHandler.shadow_state() merged over all boards, global locker ids."""
+        state = {"fan_mode": {}}
+        for first, _last, handler in self.boards:
+            board = handler.shadow_state()
+            state["fan_mode"][handler.name] = board.pop("fan_mode")
+            for local, entry in board.items():
+                state[local if local == _BROADCAST else local + first - 1] = entry
+        return state
+
+    def queue_depth(self):
+        return sum(h.queue_depth() for h in self.handlers)
+
+    def health_snapshot(self):
+        return {h.name: h.health.snapshot() for h in self.handlers}
+
+    def metrics_snapshot(self, reset=False):
+        return {h.name: h.metrics_snapshot(reset) for h in self.handlers}
+
+    def close(self):
+        for handler in self.handlers:
+            handler.close()
@@ -0,0 +1,251 @@
+# spi_capture.py
+#
+# Binary capture of Pi ↔ STM32 SPI traffic and a deterministic replay tool
+# -----------------------------------------------------------------------------
+# File layout:  b"SPICAP1\n" followed by records
+#   record = <d B H f>  wall‑clock timestamp, direction, length, latency (s)
+#            + tx bytes (length) + rx bytes (length)
+# Directions:  TX     – command / bulk / framed frame written by the Pi
+#              DUMMY  – phase‑1 of an interrupt read (starts one event)
+#              RX     – phase‑2 read (rx holds the STM32 frame)
+#
+# Usage:
+#   SPIHandler(..., capture_path="logs/spi.cap")      # or handler.start_capture()
+#   python spi_capture.py dump logs/spi.cap
+#   python spi_capture.py replay logs/spi.cap [--drain]
+# -----------------------------------------------------------------------------
+
+import argparse
+import collections
+import os
+import queue
+import struct
+import tempfile
+import threading
+import time
+
+MAGIC = b"SPICAP1\n"
+DIR_TX = 0
+DIR_DUMMY = 1
+DIR_RX = 2
+_DIR_NAMES = {DIR_TX: "TX", DIR_DUMMY: "DUMMY", DIR_RX: "RX"}
+
+_HEADER = struct.Struct("<dBHf")
+
+CaptureRecord = collections.namedtuple("CaptureRecord", "timestamp direction tx rx latency")
+
+
+class SpiCapture:
+    """Thread‑safe append‑only writer for the capture format above."""
+
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        new_file = not os.path.exists(path) or os.path.getsize(path) == 0
+        self.path = path
+        self._file = open(path, "ab")
+        if new_file:
+            self._file.write(MAGIC)
+        self._lock = threading.Lock()
+        self.records = 0
+
+    def record(self, direction, tx, rx, latency):
+        tx = bytes(tx)
+        rx = bytes(rx or b"").ljust(len(tx), b"\x00")[:len(tx)]
+        with self._lock:
+            if self._file is None:
+                return
+            self._file.write(_HEADER.pack(time.time(), direction, len(tx), latency))
+            self._file.write(tx)
+            self._file.write(rx)
+            self.records += 1
+
+    def close(self):
+        with self._lock:
+            if self._file:
+                self._file.close()
+                self._file = None
+
+
+def read_capture(path):
+    """Yield CaptureRecord tuples from a capture file."""
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not an SPI capture file")
+        while True:
+            header = f.read(_HEADER.size)
+            if len(header) < _HEADER.size:
+                return
+            ts, direction, length, latency = _HEADER.unpack(header)
+            tx = f.read(length)
+            rx = f.read(length)
+            if len(rx) < length:
+                return                  # truncated tail (capture still open)
+            yield CaptureRecord(ts, direction, tx, rx, latency)
+
+
+# -----------------------------------------------------------------------------
+#  Replay
+# -----------------------------------------------------------------------------
+class _ReplaySpiDev:
+    """Serves the captured read responses of the current event, in order."""
+
+    _IDLE = (0x00, 0xFF)
+
+    def __init__(self):
+        self.max_speed_hz = 0
+        self.mode = 0
+        self.responses = collections.deque()
+        self.transfers = 0
+
+    def open(self, bus, device):
+        pass
+
+    def load_event(self, reads):
+        self.responses = collections.deque(
+            list(rx) for rx in reads if rx and rx[0] not in self._IDLE)
+
+    def xfer2(self, data):
+        self.transfers += 1
+        if list(data) == [0x00] * len(data) and self.responses:
+            return self.responses.popleft()
+        return [0x00] * len(data)
+
+    def close(self):
+        pass
+
+
+class _NullGpio:
+    BOTH_EDGES = 3
+
+    def gpiochip_open(self, chip):
+        return chip
+
+    def gpiochip_close(self, handle):
+        pass
+
+    def gpio_claim_input(self, handle, gpio):
+        pass
+
+    def gpio_claim_output(self, handle, gpio, level):
+        pass
+
+    def gpio_claim_alert(self, handle, gpio, edge, flags=0):
+        pass
+
+    def callback(self, handle, gpio, edge=3, func=None):
+        return None
+
+    def gpio_read(self, handle, gpio):
+        return 0
+
+    def gpio_write(self, handle, gpio, level):
+        pass
+
+
+class _ReplayApp:
+    class _Frame:
+        def show(self):
+            pass
+
+    def __init__(self):
+        self.information_frame = self._Frame()
+
+    def resync_stm32(self, force=False):
+        pass
+
+
+def split_events(records):
+    """Group a capture into ("tx", record) and ("event", [rx, ...]) items."""
+    items = []
+    reads = None
+    for rec in records:
+        if rec.direction == DIR_DUMMY:
+            reads = []
+            items.append(("event", reads))
+        elif rec.direction == DIR_RX and reads is not None:
+            reads.append(rec.rx)
+        elif rec.direction == DIR_TX:
+            items.append(("tx", rec))
+    return items
+
+
+def replay(path, app=None, bot_queue=None, drain=False):
+    """
+    Feed a capture back through SPIHandler as fast as possible.
+
+    Every captured interrupt goes through _send_dummy_and_read() (and so
+    _dispatch_frame / interpret_and_notify) with the recorded responses;
+    every captured legacy command is re‑queued with send_command(). The
+    inter‑frame and read delays are zeroed on the replay handler only, and
+    resets (0xF2 frames, watchdog) are counted instead of run, so the NRST
+    state machine never holds the writer during a replay.
+    Returns a dict of counts and throughput.
+    """
+    from spi_handler import SPIHandler
+
+    items = split_events(read_capture(path))
+    spi = _ReplaySpiDev()
+    bot_queue = bot_queue if bot_queue is not None else queue.Queue()
+    handler = SPIHandler(app or _ReplayApp(), bot_queue, spi_dev=spi, gpio=_NullGpio(),
+                         interrupt_mode="poll", drain=drain)
+    handler._FRAME_GAP_SEC = 0.0
+    handler._READ_DELAY_SEC = 0.0
+    handler._READY_POLL_SEC = 0.0
+    resets = []
+    handler._reset_stm32 = lambda delay=0: resets.append(delay)
+
+    events = commands = 0
+    futures = []
+    start = time.monotonic()
+    for kind, item in items:
+        if kind == "event":
+            spi.load_event(item)
+            handler._send_dummy_and_read()
+            events += 1
+        elif len(item.tx) == 6 and item.tx[0] in (0x01, 0x02, 0x03, 0x04):
+            futures.append(handler.send_command(item.tx[0], list(item.tx[1:]), force=True))
+            commands += 1
+    for f in futures:
+        f.exception()                   # wait for the writer to drain
+    elapsed = time.monotonic() - start
+    handler.close()
+
+    return {
+        "events": events,
+        "frames": handler.frames_received,
+        "commands": commands,
+        "resets": len(resets),
+        "seconds": elapsed,
+        "events_per_sec": events / elapsed if elapsed else 0.0,
+        "commands_per_sec": commands / elapsed if elapsed else 0.0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Inspect or replay SPI captures")
+    sub = parser.add_subparsers(dest="action", required=True)
+    dump = sub.add_parser("dump", help="print every record")
+    dump.add_argument("path")
+    rep = sub.add_parser("replay", help="replay through SPIHandler and report throughput")
+    rep.add_argument("path")
+    rep.add_argument("--drain", action="store_true", help="capture was taken in drain mode")
+    args = parser.parse_args()
+
+    path = os.path.abspath(args.path)
+    if args.action == "dump":
+        for rec in read_capture(path):
+            print(f"{rec.timestamp:.6f} {_DIR_NAMES.get(rec.direction, rec.direction):5} "
+                  f"{rec.latency * 1e6:8.1f}us  tx={rec.tx.hex(' ')}  rx={rec.rx.hex(' ')}")
+        return
+
+    # interpret_and_notify writes into ./logs – keep replays out of the real logs
+    os.chdir(tempfile.mkdtemp(prefix="spireplay_"))
+    os.makedirs("logs", exist_ok=True)
+    result = replay(path, drain=args.drain)
+    print("\n=== SPI capture replay ===")
+    for key, value in result.items():
+        print(f"{key:17}: {value:.3f}" if isinstance(value, float) else f"{key:17}: {value}")
+
+
+if __name__ == "__main__":
+    main()
@@ -3,16 +3,75 @@
 # Raspberry Pi ↔ STM32 communication handler **with watchdog & black‑box logging**
 # -----------------------------------------------------------------------------
 # Features added on top of the original SPIHandler:
-#   • Tracks last valid SPI traffic timestamp
-#   • If >120 s of silence → pulses GPIO 14 low (100 ms) to reset the STM32
-#   • Before every reset writes a line to BLACK_BOX_STM32.txt (auto‑created)
-#   • If still silent another 120 s later → queues one Telegram alert
-#   • When SPI resumes → flags clear and the next outage starts a new cycle
+#   • Watchdog waits on a monotonic deadline that every valid frame pushes
+#     back; its state lives in SPIHealth (healthy → silent → reset‑pending →
+#     alert‑sent) and is mirrored to logs/spi_health.json for the bot
+#   • If >120 s of silence → pulses GPIO 14 low (100 ms) to reset the STM32
+#   • Before every reset writes a line to BLACK_BOX_STM32.txt (auto‑created)
+#   • If still silent another 120 s later → queues one Telegram alert
+#   • When SPI resumes → health returns to healthy and the next outage
+#     starts a new cycle
+#   • GPIO 17 is watched with lgpio edge alerts (falls back to 100 ms polling)
+#   • All outgoing commands go through one writer thread fed by a priority
+#     queue (unlock → price → LED/fan); callers get a Future back
+#   • LED / price / fan updates are coalesced per (opcode, locker): a newer
+#     update replaces one that is still waiting in the queue
+#   • A shadow copy of the last value written per (opcode, locker) turns
+#     repeated writes into no‑ops; cleared on 0xF5 resync and NRST resets
+#   • Full price / RGB tables can be uploaded in one chunked bulk transfer
+#     (opcode 0x10, acknowledged by a 0xF7 frame); old firmware that never
+#     acknowledges falls back to the per‑locker frames
+#   • Adaptive read (read_mode="adaptive", opt‑in per board): after the
+#     dummy phase the response is polled until it is ready instead of always
+#     sleeping 100 ms; needs firmware that clocks out idle bytes until the
+#     frame is loaded. Turnaround is recorded in either mode
+#   • Optional "framed" protocol: [0xA5, seq, cmd, d0..d4, CRC‑8] frames,
+#     acknowledged by 0xF8 frames, several in flight, selective retransmit
+#   • Drain mode: one interrupt reads frames until the STM32 answers with
+#     the 0xFE "queue empty" marker, dispatching each in order
+#   • Every transfer can be written to a binary capture (spi_capture.py)
+#   • 0xF5 resync requests are debounced onto a worker thread so the GPIO
+#     monitor goes straight back to servicing interrupts
+#   • NRST resets run as a timer‑driven state machine (pulsing → booting →
+#     awaiting_resync → idle); outgoing commands are held until it is idle
+#   • Several boards: name / interrupt_pin / reset_pin / locker_offset
+#     let spi_boards.py run one handler per STM32 (see boards.json)
+#   • clock="auto" calibrates the SPI clock with echo frames (0x3C → 0xF9),
+#     keeps the speed one step below the fastest error‑free one in
+#     logs/spi_clock.json and re‑checks it after every watchdog reset;
+#     the bus is taken per echo trial and only while no command is queued,
+#     and the IRQ edges raised by the echoes are not read again;
+#     firmware without echo is saved as "unsupported" and not probed again
+#     (delete its entry after a firmware update)
+#   • apply_lighting_scene(): a whole LED scene in one operation – a single
+#     all‑lockers (255) frame when every locker gets the same value, else a
+#     bulk RGB table / coalesced background frames; never blocks the caller
+#   • Write‑only frames (commands, dummy phase, bulk chunks) go out with
+#     writebytes2(), which takes the preallocated bytearray / memoryview
+#     frames as they are; only reads use xfer2(), which copies its argument
+#     into a list. With batch=True (framed protocol) several queued frames
+#     share one transfer and one inter‑frame gap (see spi_bench.py)
+#   • Each IRQ edge is stamped with time.monotonic(); the stamp follows the
+#     frame through interpret_and_notify and EVENT_JOURNAL keeps rolling
+#     edge → read / decode / db / notify / handled percentiles
+#   • Lock wait, xfer2 time, end‑to‑end latency and errors are kept as
+#     per‑command histograms (spi_metrics.py, handler.metrics_snapshot())
 # -----------------------------------------------------------------------------
 
 # -----------------------------------------------------------------------------
 #  Imports & platform‑adaptive mocks
 # -----------------------------------------------------------------------------
+import threading
+import time
+import datetime
+import queue
+import itertools
+import collections
+import contextlib
+import json
+import os
+from concurrent.futures import Future
+
 try:
     import spidev          # SPI library (real Pi)
     import lgpio           # Raspberry Pi 5 GPIO library
@@ -22,13 +81,28 @@ except ImportError:
         def open(self, bus, device):
             print(f"[MOCK SPI] open({bus}, {device})")
         def xfer2(self, data):
-            print(f"[MOCK SPI] xfer2({data})")
+            print(f"[MOCK SPI] xfer2({list(data)})")
             return [0x00] * len(data)
+        def writebytes2(self, data):
+            print(f"[MOCK SPI] writebytes2({list(data)})")
         def close(self):
             print("[MOCK SPI] close()")
     spidev = type("SpiDevHolder", (), {"SpiDev": _MockSpiDev})()
 
+    class _MockCallback:
+        def __init__(self, gpio, func):
+            self.gpio = gpio
+            self.func = func
+        def cancel(self):
+            _MockLgpio._callbacks.remove(self)
+
     class _MockLgpio:
+        RISING_EDGE = 1
+        FALLING_EDGE = 2
+        BOTH_EDGES = 3
+        _callbacks = []
+        _levels = {}
+
         @staticmethod
         def gpiochip_open(chip):
             print(f"[MOCK GPIO] gpiochip_open({chip})")
@@ -40,8 +114,25 @@ except ImportError:
         def gpio_claim_output(chip, pin, level):
             print(f"[MOCK GPIO] gpio_claim_output({chip}, {pin}, level={level})")
         @staticmethod
+        def gpio_claim_alert(chip, pin, edge, flags=0):
+            print(f"[MOCK GPIO] gpio_claim_alert({chip}, {pin}, edge={edge})")
+        @staticmethod
+        def callback(chip, pin, edge=3, func=None):
+            cb = _MockCallback(pin, func)
+            _MockLgpio._callbacks.append(cb)
+            return cb
+        @staticmethod
+        def fire_edge(chip, pin, level=None):
+            """Simulate an edge on *pin*: flips the level and runs callbacks."""
+            if level is None:
+                level = 1 - _MockLgpio._levels.get(pin, 0)
+            _MockLgpio._levels[pin] = level
+            for cb in list(_MockLgpio._callbacks):
+                if cb.gpio == pin and cb.func:
+                    cb.func(chip, pin, level, time.monotonic_ns())
+        @staticmethod
         def gpio_read(chip, pin):
-            return 0
+            return _MockLgpio._levels.get(pin, 0)
         @staticmethod
         def gpio_write(chip, pin, value):
             print(f"[MOCK GPIO] gpio_write({chip}, {pin}, {value})")
@@ -51,10 +142,123 @@ except ImportError:
     lgpio = _MockLgpio
 # -----------------------------------------------------------------------------
 
-import threading
-import time
-import datetime
-from utils import interpret_and_notify
+from utils import interpret_and_notify, save_snapshot
+from spi_capture import SpiCapture, DIR_TX, DIR_DUMMY, DIR_RX
+from spi_metrics import SpiMetrics, EVENT_JOURNAL, command_label
+
+
+def _build_crc8_table(poly=0x07):
+    table = []
+    for byte in range(256):
+        crc = byte
+        for _ in range(8):
+            crc = ((crc << 1) ^ poly) & 0xFF if crc & 0x80 else (crc << 1) & 0xFF
+        table.append(crc)
+    return table
+
+_CRC8_TABLE = _build_crc8_table()
+_CLOCK_FILE_LOCK = threading.Lock()     # logs/spi_clock.json is shared by all boards
+
+
+def crc8(data):
+    """CRC‑8 (poly 0x07, init 0x00) as used by the framed SPI protocol."""
+    crc = 0
+    for b in data:
+        crc = _CRC8_TABLE[crc ^ b]
+    return crc
+
+
+def _fill(buf, offset, values, size=5):
+    """Copy *values* into buf[offset:offset + size], zero‑padded, in place."""
+    for i in range(size):
+        buf[offset + i] = values[i] if i < len(values) else 0
+
+
+class _SpiCommand:
+    """One queued outgoing frame plus the Future handed back to the caller."""
+    __slots__ = ("command", "data", "priority", "future", "enqueued_at",
+                 "key", "merged", "superseded")
+
+    def __init__(self, command, data, priority, future, key=None):
+        self.command = command
+        self.data = data
+        self.priority = priority
+        self.future = future
+        self.enqueued_at = time.monotonic()
+        self.key = key              # (opcode, locker) for coalescable frames
+        self.merged = []            # Futures of older updates this one replaced
+        self.superseded = False     # True once a newer update took its place
+
+    def futures(self):
+        return self.merged + [self.future]
+
+
+class SPIHealth:
+    """
+    Thread‑safe link health shared by the watchdog, the GUI, the bot and the
+    metrics code. States: healthy, silent, reset-pending, alert-sent.
+    """
+
+    HEALTHY = "healthy"
+    SILENT = "silent"
+    RESET_PENDING = "reset-pending"
+    ALERT_SENT = "alert-sent"
+    _HISTORY = 50
+
+    def __init__(self, path=None, name=None):
+        self.path = path
+        self.name = name
+        self._lock = threading.Lock()
+        self.state = self.HEALTHY
+        self.since = time.time()
+        self.last_frame_time = None
+        self.frames = 0
+        self.outages = 0
+        self.resets = 0
+        self.alerts = 0
+        self.history = collections.deque(maxlen=self._HISTORY)
+
+    def note_frame(self):
+        """Record a valid frame; returns True if it ended an outage."""
+        with self._lock:
+            self.frames += 1
+            self.last_frame_time = time.time()
+            if self.state == self.HEALTHY:
+                return False
+        self.transition(self.HEALTHY)
+        return True
+
+    def transition(self, state):
+        with self._lock:
+            if state == self.state:
+                return
+            now = time.time()
+            self.history.append((now, self.state, state))
+            self.state = state
+            self.since = now
+            if state == self.SILENT:
+                self.outages += 1
+            elif state == self.RESET_PENDING:
+                self.resets += 1
+            elif state == self.ALERT_SENT:
+                self.alerts += 1
+        print(f"SPIHandler: Link health → {state}")
+        save_snapshot(self.path, self.snapshot(), "SPIHandler")
+
+    def snapshot(self):
+        """Copy of the link health taken under the lock (also what the bot reads)."""
+        with self._lock:
+            return {
+                "board": self.name,
+                "state": self.state,
+                "since": self.since,
+                "last_frame_time": self.last_frame_time,
+                "frames": self.frames,
+                "outages": self.outages,
+                "resets": self.resets,
+                "alerts": self.alerts,
+                "history": [list(h) for h in self.history],
+            }
 
 
 class SPIHandler:
@@ -62,154 +266,1395 @@ class SPIHandler:
 
     # ------------------- constants ------------------------------
     _TIMEOUT_SEC = 120            # Silence threshold (2 minutes)
-    _RESET_PULSE_SEC = 2        # 100 ms active‑low pulse
-    _CHECK_EVERY_SEC = 5          # Watchdog poll interval
+    _RESET_PULSE_SEC = 2        # 100 ms active‑low pulse
+    _F2_RESET_DELAY_SEC = 2       # 0xF2 frame → NRST pulse
+    _BOOT_SEC = 1.0               # NRST release → firmware ready
+    _RESYNC_WAIT_SEC = 5.0        # Give up waiting for the board's first frame
+    _SILENT_SEC = 30              # Silence before health reports "silent"
     _RESET_GPIO_PIN = 14          # NRST line of STM32 (active‑low)
     _INTERRUPT_PIN = 17           # STM32 → Pi interrupt pin
+    _POLL_INTERVAL_SEC = 0.1      # Polling fallback interval
+    _FRAME_GAP_SEC = 0.05         # Pause between frames so the STM32 keeps up
+    _LOG_FRAMES = False           # Debug: print every outgoing command frame
+    _READ_DELAY_SEC = 0.1         # Fixed dummy→read gap (adaptive deadline)
+    _READY_POLL_SEC = 0.002       # Adaptive read: re‑poll interval
+    _IDLE_BYTES = (0x00, 0xFF)    # First byte while the response is not loaded
+    _DUMMY_FRAME = b"\xff" * 6    # Phase‑1 of an interrupt read
+    _READ_FRAME = bytes(6)        # Phase‑2: clock the response out
+    _DRAIN_EMPTY = 0xFE           # STM32 has no more queued frames
+    _DRAIN_MAX_FRAMES = 32        # Safety cap per interrupt
+    _RESYNC_DEBOUNCE_SEC = 0.2    # Quiet time before a requested resync runs
+
+    # Writer queue priorities (lower is sent first)
+    PRIORITY_UNLOCK = 0
+    PRIORITY_PRICE = 1
+    PRIORITY_LED = 2
+    PRIORITY_FAN = 2
+    PRIORITY_DEFAULT = 3
+    _OPCODE_PRIORITY = {
+        0x03: PRIORITY_UNLOCK,
+        0x02: PRIORITY_PRICE,
+        0x01: PRIORITY_LED,
+        0x04: PRIORITY_FAN,
+    }
+    # Opcodes where only the newest pending value per locker matters
+    _COALESCE_OPCODES = (0x01, 0x02, 0x04)
+
+    # Bulk table upload: [0x10, table, count_hi, count_lo, chunk, chunks] + records
+    _BULK_OPCODE = 0x10
+    _BULK_ACK = 0xF7              # [0xF7, table, count_hi, count_lo, checksum, status]
+    _BULK_CHUNK_BYTES = 4096      # spidev default bufsiz
+    _BULK_ACK_TIMEOUT_SEC = 0.5   # Once no IRQ edge is left unread
+    _BULK_PROBE_TRIES = 3         # Unanswered probes before bulk is taken as unsupported
+    TABLE_RGB = 0x01              # records: locker, r, g, b, mode
+    TABLE_PRICE = 0x02            # records: locker, cents_hi, cents_lo
+    _BULK_RECORD_SIZE = {TABLE_RGB: 5, TABLE_PRICE: 3}
+
+    # Framed protocol: [0xA5, seq, cmd, d0..d4, crc] ⇄ [0xF8, seq, status, result, 0, crc]
+    _FRAME_START = 0xA5
+    _FRAME_ACK = 0xF8
+    _MAX_IN_FLIGHT = 4            # Unacknowledged frames allowed on the wire
+    _ACK_TIMEOUT_SEC = 0.3        # Retransmit a frame not acked within this
+    _MAX_RETRIES = 3
+
+    # Clock calibration: [0x3C, seq, p0, p1, p2, crc] ⇄ [0xF9, seq, p0, p1, p2, crc]
+    # 0x3C is ≥3 bit flips away from every other command opcode, so a
+    # corrupted echo can never turn into an unlock or price write.
+    _ECHO_OPCODE = 0x3C
+    _ECHO_REPLY = 0xF9
+    _ECHO_PATTERNS = ((0x55, 0xAA, 0x55), (0xFF, 0x00, 0xFF), (0x0F, 0xF0, 0x3C),
+                      (0x01, 0x80, 0x7E))
+    _CALIBRATION_SPEEDS = (250_000, 500_000, 1_000_000, 1_600_000,
+                           2_000_000, 4_000_000, 8_000_000)
+    _CALIBRATION_TRIALS = 20      # Echo round trips per speed
+    _ECHO_READ_SEC = 0.005        # Echo sent → reply loaded (firmware with echo)
+    _CLOCK_PATH = "logs/spi_clock.json"
     _BLACKBOX_PATH = "logs/BLACK_BOX_STM32.txt"
+    _HEALTH_PATH = "logs/spi_health.json"
 
     # ------------------- constructor ---------------------------
-    def __init__(self, app, bot_queue, bus=0, device=0, speed_hz=1_600_000):
+    def __init__(self, app, bot_queue, bus=0, device=0, speed_hz=1_600_000,
+                 interrupt_mode="edge", bulk_mode="auto", read_mode="fixed",
+                 protocol="legacy", drain=False, spi_dev=None, gpio=None,
+                 capture_path=None, name=None, interrupt_pin=None,
+                 reset_pin=None, locker_offset=0, clock="fixed", batch=False,
+                 locker_count=None):
+        """
+        spi_dev / gpio let a stand‑in replace the real hardware: any object
+        with the SpiDev interface and any module‑like object with the lgpio
+        functions used here (see stm32_simulator.py).
+
+        name, interrupt_pin, reset_pin and locker_offset describe one board
+        of a multi‑board wall (spi_boards.py); lockers in its frames are
+        numbered locally and locker_offset maps them to global ids;
+        locker_count (lockers 1..n on this board) enables the single‑frame
+        shortcut of apply_lighting_scene.
+
+        clock="auto" replaces *speed_hz* with the calibrated clock (see
+        calibrate_clock); *speed_hz* stays in use if the firmware has no echo.
+
+        read_mode="adaptive" re‑reads the response every few ms instead of
+        waiting the full _READ_DELAY_SEC; only for firmware that answers with
+        idle bytes (0x00 / 0xFF) until the frame is loaded, e.g. via a
+        "read_mode" key in boards.json.
+
+        batch=True (framed protocol only) sends up to _MAX_IN_FLIGHT queued
+        frames back to back in one transfer; the firmware must parse
+        consecutive 0xA5 frames from one chip‑select.
+        """
         self.app = app
         self.bot_queue = bot_queue
+        self.name = name
+        self.locker_offset = locker_offset
+        self.locker_count = locker_count
+        if interrupt_pin is not None:
+            self._INTERRUPT_PIN = interrupt_pin
+        if reset_pin is not None:
+            self._RESET_GPIO_PIN = reset_pin
+        if name:
+            self._HEALTH_PATH = f"logs/spi_health_{name}.json"
+        self.gpio = gpio if gpio is not None else lgpio
 
         # SPI init ------------------------------------------------
         try:
-            self.spi = spidev.SpiDev()
+            self.spi = spi_dev if spi_dev is not None else spidev.SpiDev()
             self.spi.open(bus, device)
             self.spi.max_speed_hz = speed_hz
             self.spi.mode = 0  # SPI mode‑0
-            print("SPIHandler: SPI initialised (mode 0, 1.6 MHz).")
+            print(f"SPIHandler: SPI initialised (mode 0, {speed_hz / 1e6:.1f} MHz).")
         except Exception as e:
             print(f"SPIHandler: Failed to initialise SPI – {e}")
             self.spi = None
+        # Stand‑ins without writebytes2 get every frame through xfer2
+        self._writebytes2 = getattr(self.spi, "writebytes2", None)
 
         # GPIO init -----------------------------------------------
         try:
-            self.chip = lgpio.gpiochip_open(0)
-            lgpio.gpio_claim_input(self.chip, self._INTERRUPT_PIN)
-            lgpio.gpio_claim_output(self.chip, self._RESET_GPIO_PIN, 1)  # keep NRST high
-            print("SPIHandler: GPIO initialised (interrupt 17, reset 14).")
+            self.chip = self.gpio.gpiochip_open(0)
+            self.gpio.gpio_claim_output(self.chip, self._RESET_GPIO_PIN, 1)  # keep NRST high
+            print(f"SPIHandler: GPIO initialised (interrupt {self._INTERRUPT_PIN}, "
+                  f"reset {self._RESET_GPIO_PIN}).")
         except Exception as e:
             print(f"SPIHandler: Failed to initialise GPIO – {e}")
             self.chip = None
 
+        # Interrupt line: edge alerts if available, polling otherwise
+        self._edge_queue = queue.Queue()
+        self._echo_edges = 0                # edges still owed to calibration echoes
+        self._edge_lock = threading.Lock()
+        self._edge_cb = None
+        self.edges_seen = 0
+        self.interrupt_mode = "poll"
+        if interrupt_mode == "edge":
+            self._setup_edge_alerts()
+        if self.interrupt_mode == "poll":
+            try:
+                self.gpio.gpio_claim_input(self.chip, self._INTERRUPT_PIN)
+            except Exception as e:
+                print(f"SPIHandler: Failed to claim interrupt pin – {e}")
+
+        # Read phase: "adaptive" polls for readiness, "fixed" always waits
+        self.read_mode = read_mode
+        self.read_fallbacks = 0
+        self._turnarounds = collections.deque(maxlen=500)
+
+        # Drain mode: batch size → number of interrupts that read that many frames
+        self.drain = drain
+        self.drain_batches = collections.Counter()
+
+        # Framed protocol state: seq → [cmd, futures, sent_at, attempts]
+        self.protocol = protocol
+        self._unacked = {}
+        self._flight_cond = threading.Condition()
+        self._frame_seq = 0
+        self.retransmits = 0
+        self._last_frame_at = 0.0           # monotonic end of the last command frame
+
+        # Latency / error histograms
+        self.speed_hz = speed_hz
+        self.clock_mode = clock
+        self.clock_calibration = None       # {speed_hz: error_rate} of the last run
+        self._echo_seq = 0
+        self.echo_supported = None          # None until a calibration has probed it
+        self._recalibrate_after_reset = False
+        self.metrics = SpiMetrics()
+
+        # Optional binary capture of every transfer
+        self.capture = None
+        if capture_path:
+            self.start_capture(capture_path)
+
+        # Reset state machine: idle → pending → pulsing → booting → awaiting_resync
+        self.reset_state = "idle"
+        self.reset_count = 0
+        self._reset_cond = threading.Condition()
+        self._reset_timer = None
+
+        # Resync worker: requests merged until quiet for _RESYNC_DEBOUNCE_SEC
+        self._resync_cond = threading.Condition()
+        self._resync_pending = 0
+        self._resync_last = 0.0
+        self.resync_requests = 0
+        self.resync_runs = 0
+
         # Runtime flags -------------------------------------------
-        self.last_spi_time = time.time()
-        self.reset_attempted = False
-        self.alert_sent = False
+        self.frames_received = 0
+        self.health = SPIHealth(self._HEALTH_PATH, name)
+        self._watchdog_cond = threading.Condition()
+        self._silence_start = time.monotonic()
 
         # Thread‑safety
         self.lock = threading.Lock()
         self.running = True
 
-        # GPIO monitor thread
-        self.gpio_thread = threading.Thread(target=self._monitor_gpio, daemon=True)
+        # Writer queue + statistics
+        self._tx_queue = queue.PriorityQueue()
+        self._tx_seq = itertools.count()
+        self._stats_lock = threading.Lock()
+        self._sent_count = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+        self._wait_last = 0.0
+        self._pending = {}            # (opcode, locker) → newest queued _SpiCommand
+        self._pending_lock = threading.Lock()
+        self._superseded_in_queue = 0
+        self._in_flight_keys = set()  # keys of the frames the writer is sending
+        self.coalesced_count = 0
+        self._shadow = {}             # (opcode, locker) → data last written to STM32
+        self._shadow_lock = threading.Lock()
+        self.shadow_skipped = 0
+
+        # Preallocated transmit buffers, only touched with self.lock held
+        self.batch = batch and self.protocol == "framed"
+        self.batched_transfers = 0
+        self._cmd_buf = bytearray(6)
+        self._frame_buf = bytearray(9 * self._MAX_IN_FLIGHT)
+        self._frame_view = memoryview(self._frame_buf)
+
+        # Bulk upload: None = not known yet, True/False once known
+        self._bulk_auto = bulk_mode == "auto"
+        self.bulk_supported = None if self._bulk_auto else False
+        self._bulk_misses = 0         # probes in a row that got no ack
+        self._bulk_waiters = {}       # table → [[count, checksum, futures, timer]]
+        self._bulk_lock = threading.Lock()
+
+        # GPIO monitor thread (edge consumer or polling loop)
+        monitor = self._edge_reader if self.interrupt_mode == "edge" else self._monitor_gpio
+        self.gpio_thread = threading.Thread(target=monitor, daemon=True)
         self.gpio_thread.start()
+        # SPI writer thread
+        self.writer_thread = threading.Thread(target=self._spi_writer, daemon=True)
+        self.writer_thread.start()
+        # Retransmit thread (framed protocol only)
+        self.retransmit_thread = None
+        if self.protocol == "framed":
+            self.retransmit_thread = threading.Thread(target=self._retransmit_loop, daemon=True)
+            self.retransmit_thread.start()
+        # Resync worker thread
+        self.resync_thread = threading.Thread(target=self._resync_worker, daemon=True)
+        self.resync_thread.start()
         # Watchdog thread
         self.watchdog_thread = threading.Thread(target=self._spi_watchdog, daemon=True)
         self.watchdog_thread.start()
 
+        if self.clock_mode == "auto":
+            saved = self._load_clock()
+            if saved and saved.get("echo") == "unsupported":
+                self.echo_supported = False
+                print("SPIHandler: Firmware has no echo frames – "
+                      f"keeping {self.speed_hz / 1e6:.2f} MHz.")
+            elif saved:
+                with self.lock:
+                    self._set_clock(saved["speed_hz"])
+                print(f"SPIHandler: Using calibrated clock {self.speed_hz / 1e6:.2f} MHz.")
+            else:
+                self._start_calibration()
+
     # ------------------------------------------------------------------
     # Public high‑level helpers (kept from original code)
     # ------------------------------------------------------------------
-    def send_command(self, command, data):
-        """Thread‑safe generic SPI command sender."""
+    def send_command(self, command, data, priority=None, callback=None, force=False):
+        """
+        Queue a command for the writer thread and return immediately.
+
+        Returns a concurrent.futures.Future that resolves to None once the
+        frame is on the wire (or carries the exception).
+        With protocol="framed" it resolves to the STM32 status byte from the
+        acknowledgement instead (0 = applied), or TimeoutError after retries.
+        *callback*, if given, is attached with Future.add_done_callback().
+        LED / price / fan frames whose value matches the shadow copy resolve
+        to None without touching the bus unless *force* is set.
+        """
+        future = Future()
+        if callback:
+            future.add_done_callback(callback)
         if not self.spi:
             print("SPIHandler: SPI not initialised.")
+            future.set_result(None)
+            return future
+        if priority is None:
+            priority = self._OPCODE_PRIORITY.get(command, self.PRIORITY_DEFAULT)
+        key = self._coalesce_key(command, data)
+        cmd = _SpiCommand(command, list(data), priority, future, key)
+        with self._pending_lock:
+            if key is not None and not force and not self._key_busy(key):
+                with self._shadow_lock:
+                    unchanged = self._shadow.get(key) == tuple(data)
+                if unchanged:
+                    self.shadow_skipped += 1
+                    future.set_result(None)
+                    return future
+            if key is not None:
+                older = self._pending.get(key)
+                if older is not None:
+                    # Latest wins: the new frame takes the older one's Futures
+                    # and goes to the back of the queue in its place.
+                    older.superseded = True
+                    cmd.merged = older.futures()
+                    self._superseded_in_queue += 1
+                    self.coalesced_count += 1
+                self._pending[key] = cmd
+            future.add_done_callback(self._command_done_callback(cmd))
+            self._tx_queue.put((priority, next(self._tx_seq), cmd))
+        return future
+
+    def _coalesce_key(self, command, data):
+        if command not in self._COALESCE_OPCODES:
+            return None
+        if command == 0x04:             # fan mode is board‑wide
+            return (command, None)
+        return (command, data[0])
+
+    def set_led_color(self, locker_number, red, green, blue, mode=0xFF,
+                      callback=None, force=False):
+        return self.send_command(0x01, [locker_number, red, green, blue, mode],
+                                 callback=callback, force=force)
+
+    def _key_busy(self, key):
+        """Frame for *key* queued, on the wire or unacked (hold _pending_lock)."""
+        return key in self._pending or key in self._in_flight_keys or self._is_unacked(key)
+
+    def _is_unacked(self, key):
+        with self._flight_cond:
+            return any(entry[0].key == key for entry in self._unacked.values())
+
+    def open_locker(self, locker_number, callback=None):
+        return self.send_command(0x03, [locker_number, 0xFF, 0xFF, 0xFF, 0xFF],
+                                 callback=callback)
+
+    def set_price(self, locker_number, price, callback=None, force=False):
+        cents = int(price)
+        return self.send_command(
+            0x02, [locker_number, (cents >> 8) & 0xFF, cents & 0xFF, 0xFF, 0xFF],
+            callback=callback, force=force)
+
+    def set_fan_mode(self, mode, callback=None, force=False):
+        return self.send_command(0x04, [mode, 0xFF, 0xFF, 0xFF, 0xFF],
+                                 callback=callback, force=force)
+
+    # ------------------------------------------------------------------
+    # Lighting scenes
+    # ------------------------------------------------------------------
+    def apply_lighting_scene(self, colors=None, mode=None, force=False):
+        """
+        Apply or revert the LEDs of every locker in one call; returns a Future.
+
+        *mode* alone sends one all‑lockers (255) frame with that animation.
+        *colors* {locker: (r, g, b[, mode])} becomes one 255 frame if it
+        covers all locker_count lockers with the same value, otherwise an
+        upload_colors() table: one bulk transfer, or per‑locker frames
+        queued (and coalesced) by the writer on old firmware.
+        """
+        if colors is None:
+            return self.set_led_color(255, 0, 0, 0, mode if mode is not None else 0xFF,
+                                      force=force)
+        scene = {}
+        for locker, rgb in colors.items():
+            rgb = tuple(rgb)
+            scene[int(locker)] = rgb if len(rgb) > 3 else rgb + (0xFF,)
+        values = set(scene.values())
+        if (len(values) == 1 and self.locker_count
+                and set(scene) == set(range(1, self.locker_count + 1))):
+            red, green, blue, led_mode = values.pop()
+            return self.set_led_color(255, red, green, blue, led_mode, force=force)
+        return self.upload_colors(scene, force=force)
+
+    # ------------------------------------------------------------------
+    # Bulk table upload
+    # ------------------------------------------------------------------
+    def upload_prices(self, prices, force=False):
+        """
+        Upload {locker: price_cents} in one bulk transfer.
+        Returns a Future resolving to True if the STM32 acknowledged the
+        table, False if the per‑locker fallback was used instead.
+        """
+        records = {}
+        for locker, price in prices.items():
+            cents = int(price)
+            records[int(locker)] = [int(locker), (cents >> 8) & 0xFF, cents & 0xFF, 0xFF, 0xFF]
+        return self._upload_table(self.TABLE_PRICE, 0x02, records, force)
+
+    def upload_colors(self, colors, force=False):
+        """Upload {locker: (r, g, b[, mode])} in one bulk transfer (see upload_prices)."""
+        records = {}
+        for locker, rgb in colors.items():
+            mode = rgb[3] if len(rgb) > 3 else 0xFF
+            records[int(locker)] = [int(locker), rgb[0], rgb[1], rgb[2], mode]
+        return self._upload_table(self.TABLE_RGB, 0x01, records, force)
+
+    def _upload_table(self, table, opcode, records, force):
+        """records: {locker: per‑locker frame data} for *opcode*."""
+        result = Future()
+        if not force:
+            # Same rule as send_command(): a queued or unacked frame for the
+            # locker would land after the shadow value, so keep its record
+            with self._pending_lock:
+                broadcast = opcode == 0x01 and self._key_busy((0x01, 255))
+                busy = {locker for locker in records
+                        if broadcast or self._key_busy((opcode, locker))}
+                with self._shadow_lock:
+                    records = {locker: data for locker, data in records.items()
+                               if locker in busy
+                               or self._shadow.get((opcode, locker)) != tuple(data)}
+        if not records:
+            result.set_result(True)
+            return result
+
+        def fallback():
+            print(f"SPIHandler: Bulk table 0x{table:02X} not acknowledged – "
+                  "sending per‑locker frames.")
+            for data in records.values():
+                self.send_command(opcode, data, force=True)
+            result.set_result(False)
+
+        def send_bulk():
+            size = self._BULK_RECORD_SIZE[table]
+            flat = [table]
+            for data in records.values():
+                flat += data[:size]
+            bulk = self.send_command(self._BULK_OPCODE, flat,
+                                     priority=self._OPCODE_PRIORITY[opcode])
+
+            def on_ack(f):
+                if f.exception() is None and f.result():
+                    with self._shadow_lock:
+                        if opcode == 0x01:
+                            # Per‑locker colours replace any all‑lockers frame
+                            self._shadow.pop((0x01, 255), None)
+                        for locker, data in records.items():
+                            self._shadow[(opcode, locker)] = tuple(data)
+                    result.set_result(True)
+                else:
+                    fallback()
+            bulk.add_done_callback(on_ack)
+
+        if self.bulk_supported is False or not self.spi:
+            fallback()
+        elif self.bulk_supported is None:
+            self._probe_bulk(table).add_done_callback(
+                lambda f: send_bulk() if self.bulk_supported else fallback())
+        else:
+            send_bulk()
+        return result
+
+    def _probe_bulk(self, table):
+        """
+        Send an empty table header. It is exactly one legacy 6‑byte frame, so
+        old firmware just ignores an unknown opcode; new firmware acks it.
+        A missing ack leaves support unknown – the next upload probes again –
+        until _BULK_PROBE_TRIES probes in a row went unanswered.
+        """
+        probe = self.send_command(self._BULK_OPCODE, [table],
+                                  priority=self.PRIORITY_UNLOCK)
+
+        def on_probe(f):
+            if f.exception() is None and f.result():
+                self._bulk_misses = 0
+                self.bulk_supported = True
+            else:
+                self._bulk_misses += 1
+                if self._bulk_misses >= self._BULK_PROBE_TRIES:
+                    self.bulk_supported = False
+            print(f"SPIHandler: Bulk upload supported: "
+                  f"{'unknown' if self.bulk_supported is None else self.bulk_supported}")
+        probe.add_done_callback(on_probe)
+        return probe
+
+    def _bulk_chunks(self, table, records):
+        """Split *records* (flat list) into header‑prefixed xfer2 packets."""
+        size = self._BULK_RECORD_SIZE[table]
+        count = len(records) // size
+        per_chunk = max(1, (self._BULK_CHUNK_BYTES - 6) // size)
+        total = max(1, -(-count // per_chunk))
+        for index in range(total):
+            body = records[index * per_chunk * size:(index + 1) * per_chunk * size]
+            yield [self._BULK_OPCODE, table, (count >> 8) & 0xFF, count & 0xFF,
+                   index, total] + body
+
+    def _transmit_bulk(self, cmd, futures):
+        """Write every chunk, then wait (off‑thread) for the 0xF7 acknowledgement."""
+        table, records = cmd.data[0], cmd.data[1:]
+        count = len(records) // self._BULK_RECORD_SIZE[table]
+        checksum = sum(records) & 0xFF
+        timer = threading.Timer(self._BULK_ACK_TIMEOUT_SEC,
+                                self._bulk_timeout, args=(table, futures))
+        timer.daemon = True
+        with self._bulk_lock:
+            self._bulk_waiters.setdefault(table, []).append(
+                [count, checksum, futures, timer])
+        try:
+            with self._bus(command_label(self._BULK_OPCODE)):
+                for packet in self._bulk_chunks(table, records):
+                    print(f"SPIHandler: Bulk chunk {packet[4] + 1}/{packet[5]} "
+                          f"table 0x{table:02X} ({len(packet)} bytes)")
+                    self._xfer(packet)
+            timer.start()
+        except Exception as e:
+            print(f"SPIHandler: Error during bulk transfer – {e}")
+            self._bulk_timeout(table, futures, e)
+
+    def _bulk_timeout(self, table, futures, error=None):
+        with self._bulk_lock:
+            waiters = self._bulk_waiters.get(table, [])
+            for waiter in waiters:
+                if waiter[2] is futures:
+                    break
+            else:
+                return                  # already acknowledged
+            if error is None and not self._edge_queue.empty():
+                # The ack may be behind IRQ edges not read yet: the timeout
+                # only counts once the reader has caught up
+                waiter[3] = threading.Timer(self._BULK_ACK_TIMEOUT_SEC,
+                                            self._bulk_timeout, args=(table, futures))
+                waiter[3].daemon = True
+                waiter[3].start()
+                return
+            waiters.remove(waiter)
+        for f in futures:
+            if error is not None:
+                f.set_exception(error)
+            else:
+                f.set_result(False)
+
+    def _on_bulk_ack(self, response):
+        table = response[1]
+        count = (response[2] << 8) | response[3]
+        checksum, status = response[4], response[5]
+        with self._bulk_lock:
+            waiters = self._bulk_waiters.get(table, [])
+            match = next((w for w in waiters if w[0] == count), None)
+            if match is None:
+                print(f"SPIHandler: Unexpected bulk ack {response}")
+                return
+            waiters.remove(match)
+        _count, expected, futures, timer = match
+        timer.cancel()
+        ok = status == 0 and checksum == expected
+        if not ok:
+            print(f"SPIHandler: Bulk table 0x{table:02X} rejected "
+                  f"(status {status}, checksum {checksum:02X}≠{expected:02X}).")
+        for f in futures:
+            f.set_result(ok)
+
+    # ------------------------------------------------------------------
+    # Shadow registers
+    # ------------------------------------------------------------------
+    def shadow_state(self):
+        """Decoded view of the shadow copy: {locker: {...}, "fan_mode": m}."""
+        state = {"fan_mode": None}
+        with self._shadow_lock:
+            items = list(self._shadow.items())
+        for (opcode, locker), data in items:
+            if opcode == 0x04:
+                state["fan_mode"] = data[0]
+                continue
+            entry = state.setdefault(locker, {})
+            if opcode == 0x01:
+                entry["rgb"] = tuple(data[1:4])
+                entry["mode"] = data[4]
+            elif opcode == 0x02:
+                entry["price"] = (data[1] << 8) | data[2]
+        return state
+
+    def invalidate_shadow(self):
+        """Forget everything the STM32 is assumed to hold (after resync/reset)."""
+        with self._shadow_lock:
+            self._shadow.clear()
+        if self._bulk_auto and not self.bulk_supported:
+            self._bulk_misses = 0       # the board may run other firmware now
+            self.bulk_supported = None
+        print("SPIHandler: Shadow registers invalidated.")
+
+    def _update_shadow(self, cmd):
+        if cmd.key is None:
             return
+        with self._shadow_lock:
+            if cmd.command == 0x01:
+                if cmd.key[1] == 255:
+                    # An all‑lockers write overrides every per‑locker colour
+                    for key in [k for k in self._shadow if k[0] == 0x01]:
+                        del self._shadow[key]
+                else:
+                    self._shadow.pop((0x01, 255), None)
+            self._shadow[cmd.key] = tuple(cmd.data)
+
+    def queue_depth(self):
+        """Number of frames waiting for the writer thread."""
+        with self._pending_lock:
+            return self._tx_queue.qsize() - self._superseded_in_queue
+
+    def queue_stats(self):
+        """Snapshot of writer queue depth and time frames spent waiting (ms)."""
+        with self._stats_lock:
+            sent = self._sent_count
+            avg = (self._wait_total / sent) if sent else 0.0
+            return {
+                "depth": self.queue_depth(),
+                "sent": sent,
+                "coalesced": self.coalesced_count,
+                "avg_wait_ms": avg * 1000,
+                "max_wait_ms": self._wait_max * 1000,
+                "last_wait_ms": self._wait_last * 1000,
+            }
+
+    # ------------------------------------------------------------------
+    # Raw transfer + capture
+    # ------------------------------------------------------------------
+    @contextlib.contextmanager
+    def _bus(self, label):
+        """Hold self.lock, recording how long it took to get it."""
+        start = time.monotonic()
+        with self.lock:
+            self.metrics.observe("lock_wait", label, time.monotonic() - start)
+            yield
+
+    def _xfer(self, packet, direction=DIR_TX):
+        """
+        Single point where bytes hit the bus (caller holds self.lock). Only
+        reads (DIR_RX) need the reply; everything else is written with
+        writebytes2(), and None is returned.
+        """
+        label = self._xfer_label(packet, direction)
+        start = time.monotonic()
         try:
-            with self.lock:
-                packet = [command] + data
-                print(f"SPIHandler: Sending command {packet}")
+            if direction == DIR_RX:
+                response = self.spi.xfer2(packet)
+            elif self._writebytes2:
+                response = self._writebytes2(packet)
+            else:
                 self.spi.xfer2(packet)
+                response = None
+        except Exception:
+            self.metrics.error(label, "xfer")
+            raise
+        elapsed = time.monotonic() - start
+        self.metrics.observe("transfer", label, elapsed)
+        capture = self.capture
+        if capture:
+            capture.record(direction, packet, response, elapsed)
+        return response
+
+    def _xfer_label(self, packet, direction):
+        if direction == DIR_DUMMY:
+            return "dummy"
+        if direction == DIR_RX:
+            return "read"
+        if packet[0] == self._FRAME_START and len(packet) > 2:
+            return command_label(packet[2])
+        return command_label(packet[0])
+
+    def _command_done_callback(self, cmd):
+        """Future callback recording end‑to‑end latency and failures of *cmd*."""
+        label = command_label(cmd.command)
+        enqueued_at = cmd.enqueued_at
+
+        def done(future):
+            self.metrics.observe("latency", label, time.monotonic() - enqueued_at)
+            if future.cancelled() or future.exception() is not None:
+                self.metrics.error(label, "failed")
+            elif (self.protocol == "framed" and cmd.command != self._BULK_OPCODE
+                    and future.result()):
+                self.metrics.error(label, "rejected")
+        return done
+
+    def metrics_snapshot(self, reset=False):
+        """Histogram snapshot plus the bus settings they were measured with."""
+        return {
+            "speed_hz": self.speed_hz,
+            "frame_gap_ms": self._FRAME_GAP_SEC * 1000,
+            "commands": self.metrics.snapshot(reset),
+        }
+
+    def start_capture(self, path):
+        """Append every subsequent transfer to the capture file at *path*."""
+        self.stop_capture()
+        try:
+            self.capture = SpiCapture(path)
+            print(f"SPIHandler: Capturing SPI traffic to {path}.")
+        except Exception as e:
+            print(f"SPIHandler: Failed to open capture file – {e}")
+            self.capture = None
+
+    def stop_capture(self):
+        capture, self.capture = self.capture, None
+        if capture:
+            capture.close()
+
+    # ------------------------------------------------------------------
+    # Writer thread
+    # ------------------------------------------------------------------
+    def _spi_writer(self):
+        print("SPIHandler: Writer thread started.")
+        while self.running:
+            self._wait_until_board_ready()
+            try:
+                item = self._tx_queue.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            self._wait_until_board_ready()
+            if not self.running:
+                # Closed while held for a reset: close() fails it, nothing goes out
+                self._tx_queue.put(item)
+                break
+            cmd = item[2]
+            if not self._claim(cmd):
+                continue
+            cmds = [cmd]
+            if self.batch and cmd.command != self._BULK_OPCODE:
+                cmds += self._claim_batch()
+            self._wait_frame_gap()
+            if len(cmds) > 1:
+                self._transmit_batch(cmds)
+            else:
+                self._transmit(cmd)
+            self._last_frame_at = time.monotonic()
+            with self._pending_lock:
+                self._in_flight_keys.clear()
+            time.sleep(self._FRAME_GAP_SEC)
+
+    def _wait_frame_gap(self):
+        """Sleep until _FRAME_GAP_SEC has passed since the last command frame."""
+        delay = self._last_frame_at + self._FRAME_GAP_SEC - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+    def _claim(self, cmd):
+        """Take *cmd* off the pending map; False if a newer update replaced it."""
+        with self._pending_lock:
+            if cmd.superseded:
+                self._superseded_in_queue -= 1
+                return False
+            if cmd.key is not None and self._pending.get(cmd.key) is cmd:
+                del self._pending[cmd.key]
+            if cmd.key is not None:
+                self._in_flight_keys.add(cmd.key)
+            return True
+
+    def _claim_batch(self):
+        """More queued framed commands to share the current transfer."""
+        batch = []
+        while len(batch) < self._MAX_IN_FLIGHT - 1:
+            try:
+                item = self._tx_queue.get_nowait()
+            except queue.Empty:
+                break
+            if item[2].command == self._BULK_OPCODE:
+                self._tx_queue.put(item)    # same (priority, seq): keeps its place
+                break
+            if self._claim(item[2]):
+                batch.append(item[2])
+        return batch
+
+    def _start(self, cmd):
+        """Record queue wait and mark the Futures running; returns the live ones."""
+        waited = time.monotonic() - cmd.enqueued_at
+        with self._stats_lock:
+            self._sent_count += 1
+            self._wait_total += waited
+            self._wait_last = waited
+            self._wait_max = max(self._wait_max, waited)
+        return [f for f in cmd.futures() if f.set_running_or_notify_cancel()]
+
+    def _transmit_batch(self, cmds):
+        entries = [(cmd, futures) for cmd in cmds for futures in [self._start(cmd)] if futures]
+        if entries:
+            self._transmit_framed(entries)
+
+    def _transmit(self, cmd):
+        """Put one queued command on the wire and resolve its Future."""
+        futures = self._start(cmd)
+        if not futures:
+            return
+        if cmd.command == self._BULK_OPCODE:
+            self._transmit_bulk(cmd, futures)
+            return
+        if self.protocol == "framed":
+            self._transmit_framed([(cmd, futures)])
+            return
+        try:
+            with self._bus(command_label(cmd.command)):
+                if len(cmd.data) == 5:
+                    packet = self._cmd_buf
+                    packet[0] = cmd.command
+                    _fill(packet, 1, cmd.data)
+                else:
+                    packet = [cmd.command] + cmd.data
+                if self._LOG_FRAMES:
+                    print(f"SPIHandler: Sending command {list(packet)}")
+                response = self._xfer(packet)
+            self._update_shadow(cmd)
+            for f in futures:
+                f.set_result(response)
         except Exception as e:
             print(f"SPIHandler: Error during SPI transfer – {e}")
+            for f in futures:
+                f.set_exception(e)
 
-    def set_led_color(self, locker_number, red, green, blue, mode=0xFF):
-        self.send_command(0x01, [locker_number, red, green, blue, mode])
+    # ------------------------------------------------------------------
+    # Framed protocol
+    # ------------------------------------------------------------------
+    def _build_frame(self, seq, cmd):
+        body = [seq, cmd.command] + cmd.data[:5]
+        return [self._FRAME_START] + body + [crc8(body)]
 
-    def open_locker(self, locker_number):
-        self.send_command(0x03, [locker_number, 0xFF, 0xFF, 0xFF, 0xFF])
+    def _build_frame_into(self, offset, seq, cmd):
+        """Write one 9‑byte frame into self._frame_buf at *offset* (lock held)."""
+        buf = self._frame_buf
+        buf[offset] = self._FRAME_START
+        buf[offset + 1] = seq
+        buf[offset + 2] = cmd.command
+        _fill(buf, offset + 3, cmd.data)
+        buf[offset + 8] = crc8(self._frame_view[offset + 1:offset + 8])
+        return offset + 9
 
-    def set_price(self, locker_number, price):
-        cents = int(price)
-        self.send_command(0x02, [locker_number, (cents >> 8) & 0xFF, cents & 0xFF, 0xFF, 0xFF])
+    def _transmit_framed(self, entries):
+        """
+        Send [(cmd, futures), …] with sequence numbers in one transfer; the
+        Futures resolve on the 0xF8 acks.
+        """
+        with self._flight_cond:
+            while len(self._unacked) + len(entries) > self._MAX_IN_FLIGHT and self.running:
+                self._flight_cond.wait(0.1)
+            seqs = []
+            for cmd, futures in entries:
+                seq = self._frame_seq
+                while seq in self._unacked:
+                    seq = (seq + 1) & 0xFF
+                self._frame_seq = (seq + 1) & 0xFF
+                self._unacked[seq] = [cmd, futures, time.monotonic(), 1]
+                seqs.append(seq)
+        try:
+            with self._bus(command_label(entries[0][0].command)):
+                size = 0
+                for seq, (cmd, _futures) in zip(seqs, entries):
+                    size = self._build_frame_into(size, seq, cmd)
+                packet = self._frame_view[:size]
+                if len(seqs) > 1:
+                    self.batched_transfers += 1
+                if self._LOG_FRAMES:
+                    print(f"SPIHandler: Sending frames seq {seqs} {list(packet)}")
+                self._xfer(packet)
+        except Exception as e:
+            print(f"SPIHandler: Error during SPI transfer – {e}")
+            with self._flight_cond:
+                for seq in seqs:
+                    self._unacked.pop(seq, None)
+                self._flight_cond.notify_all()
+            for _cmd, futures in entries:
+                for f in futures:
+                    f.set_exception(e)
+
+    def _on_frame_ack(self, response):
+        if crc8(response[:5]) != response[5]:
+            print(f"SPIHandler: Ack CRC mismatch {response} – waiting for retransmit.")
+            return
+        seq, status = response[1], response[2]
+        with self._flight_cond:
+            entry = self._unacked.pop(seq, None)
+            self._flight_cond.notify_all()
+        if entry is None:
+            return                      # duplicate ack for a retransmitted frame
+        cmd, futures = entry[0], entry[1]
+        if status == 0:
+            self._update_shadow(cmd)
+        for f in futures:
+            f.set_result(status)
+
+    def _retransmit_loop(self):
+        """
+        Resend only the frames whose acknowledgement is overdue. Nothing is
+        resent or expired while an NRST reset is under way; the frames are
+        resent as soon as the board is back, each with a fresh retry budget.
+        """
+        print("SPIHandler: Retransmit thread started.")
+        while self.running:
+            time.sleep(self._ACK_TIMEOUT_SEC / 3)
+            now = time.monotonic()
+            resend, expired = [], []
+            with self._flight_cond:
+                if self.reset_state != "idle":
+                    for entry in self._unacked.values():
+                        entry[2] = now - self._ACK_TIMEOUT_SEC   # due once idle
+                        entry[3] = 1
+                    continue
+                for seq, entry in list(self._unacked.items()):
+                    if now - entry[2] < self._ACK_TIMEOUT_SEC:
+                        continue
+                    if entry[3] > self._MAX_RETRIES:
+                        expired.append(self._unacked.pop(seq))
+                    else:
+                        entry[2] = now
+                        entry[3] += 1
+                        resend.append((seq, entry[0]))
+                if expired:
+                    self._flight_cond.notify_all()
+            for seq, cmd in resend:
+                if self.reset_state != "idle":
+                    break               # the rest go out after the reset
+                self.retransmits += 1
+                self.metrics.error(command_label(cmd.command), "retransmit")
+                self._wait_frame_gap()
+                try:
+                    with self._bus(command_label(cmd.command)):
+                        print(f"SPIHandler: Retransmitting frame seq {seq}")
+                        self._xfer(self._build_frame(seq, cmd))
+                    self._last_frame_at = time.monotonic()
+                except Exception as e:
+                    print(f"SPIHandler: Error during SPI retransmit – {e}")
+            for cmd, futures, _sent, attempts in expired:
+                error = TimeoutError(
+                    f"No ack for command 0x{cmd.command:02X} after {attempts} attempts")
+                print(f"SPIHandler: {error}")
+                for f in futures:
+                    f.set_exception(error)
 
     # ------------------------------------------------------------------
     # GPIO interrupt monitoring
     # ------------------------------------------------------------------
+    def _setup_edge_alerts(self):
+        """Register an lgpio callback on both edges of the interrupt pin."""
+        try:
+            self.gpio.gpio_claim_alert(self.chip, self._INTERRUPT_PIN, self.gpio.BOTH_EDGES)
+            self._edge_cb = self.gpio.callback(
+                self.chip, self._INTERRUPT_PIN, self.gpio.BOTH_EDGES, self._on_edge)
+            self.interrupt_mode = "edge"
+            print(f"SPIHandler: Edge alerts enabled on GPIO {self._INTERRUPT_PIN}.")
+        except Exception as e:
+            print(f"SPIHandler: Edge alerts unavailable, polling instead – {e}")
+            self._edge_cb = None
+            self.interrupt_mode = "poll"
+
+    def _on_edge(self, chip, gpio, level, tick):
+        """lgpio callback: timestamp the edge and hand it to the reader thread."""
+        self.edges_seen += 1
+        self._edge_queue.put((time.monotonic(), level, tick))
+
+    def _edge_reader(self):
+        print("SPIHandler: GPIO edge reader thread started.")
+        while self.running:
+            try:
+                edge_ts, level, _tick = self._edge_queue.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            if self._echo_edge():
+                continue
+            print(f"GPIO {self._INTERRUPT_PIN} edge (level {level}) – reading SPI.")
+            self._send_dummy_and_read(edge_ts)
+
     def _monitor_gpio(self):
         print("SPIHandler: GPIO monitor thread started.")
-        last_state = lgpio.gpio_read(self.chip, self._INTERRUPT_PIN)
+        last_state = self.gpio.gpio_read(self.chip, self._INTERRUPT_PIN)
         while self.running:
-            state = lgpio.gpio_read(self.chip, self._INTERRUPT_PIN)
-            if state != last_state:
+            state = self.gpio.gpio_read(self.chip, self._INTERRUPT_PIN)
+            if state != last_state and not self._echo_edge():
                 print(f"GPIO {self._INTERRUPT_PIN} toggled – reading SPI.")
                 self._send_dummy_and_read()
-                last_state = state
-            time.sleep(0.1)
+            last_state = state
+            time.sleep(self._POLL_INTERVAL_SEC)
 
     # ------------------------------------------------------------------
     # Dummy exchange (triggered by interrupt)
     # ------------------------------------------------------------------
-    def _send_dummy_and_read(self):
+    def _send_dummy_and_read(self, edge_ts=None):
         if not self.spi:
             return
-        dummy = [0xFF] * 6
+        edge_ts = edge_ts if edge_ts is not None else time.monotonic()
         try:
-            with self.lock:
-                self.spi.xfer2(dummy)            # phase‑1 (don’t care)
-                time.sleep(0.1)
-                response = self.spi.xfer2([0x00] * 6)  # phase‑2 (read)
-            print(f"SPIHandler: SPI response {response}")
+            with self._bus("read"):
+                self._xfer(self._DUMMY_FRAME, DIR_DUMMY)     # phase‑1 (don’t care)
+                response = self._read_response()  # phase‑2 (read)
+                frames = [response]
+                if self.drain:
+                    frames = self._drain_frames(response)
+            EVENT_JOURNAL.record("read", edge_ts)
+            for response in frames:
+                print(f"SPIHandler: SPI response {response}")
+                self._dispatch_frame(response, edge_ts)
+        except Exception as e:
+            print(f"SPIHandler: Error during SPI communication – {e}")
+
+    def _drain_frames(self, first):
+        """
+        Keep reading (lock already held) until the empty marker, an idle
+        read or _DRAIN_MAX_FRAMES. Returns the frames to dispatch, in order.
+        """
+        frames = []
+        response = first
+        while len(frames) < self._DRAIN_MAX_FRAMES:
+            if not response or response[0] == self._DRAIN_EMPTY or response[0] in self._IDLE_BYTES:
+                break
+            frames.append(response)
+            response = self._read_response()
+        if response and response[0] == self._DRAIN_EMPTY:
+            self._note_frame()          # the board answered, just had nothing queued
+        self.drain_batches[len(frames)] += 1
+        return frames
+
+    def _read_response(self, delay=None):
+        """
+        Phase‑2 read, called with self.lock held.
+
+        In adaptive mode the 6‑byte read is repeated every few ms until the
+        first byte is no longer an idle byte, up to *delay* (default
+        _READ_DELAY_SEC). Only if that deadline passes (or in fixed mode) is
+        the classic single read after the full delay used.
+        """
+        delay = self._READ_DELAY_SEC if delay is None else delay
+        start = time.monotonic()
+        if self.read_mode == "adaptive":
+            deadline = start + delay
+            while True:
+                response = self._xfer(self._READ_FRAME, DIR_RX)
+                if response and response[0] not in self._IDLE_BYTES:
+                    self._turnarounds.append(time.monotonic() - start)
+                    return response
+                if time.monotonic() >= deadline:
+                    break
+                time.sleep(self._READY_POLL_SEC)
+            self.read_fallbacks += 1
+        remaining = delay - (time.monotonic() - start)
+        if remaining > 0:
+            time.sleep(remaining)
+        response = self._xfer(self._READ_FRAME, DIR_RX)
+        self._turnarounds.append(time.monotonic() - start)
+        return response
+
+    def read_turnaround_stats(self):
+        """Observed dummy→response time (ms) over the last reads."""
+        samples = sorted(self._turnarounds)
+        if not samples:
+            return {"count": 0, "fallbacks": self.read_fallbacks}
+        return {
+            "count": len(samples),
+            "fallbacks": self.read_fallbacks,
+            "min_ms": samples[0] * 1000,
+            "avg_ms": sum(samples) / len(samples) * 1000,
+            "p95_ms": samples[int(0.95 * (len(samples) - 1))] * 1000,
+            "max_ms": samples[-1] * 1000,
+        }
+
+    def _dispatch_frame(self, response, edge_ts=None):
+        """Handle one 6‑byte frame read from the STM32 (*edge_ts*: its IRQ edge)."""
+        self.frames_received += 1
+        if response and response[0] == self._BULK_ACK:
+            self._on_bulk_ack(response)
+        elif response and response[0] == self._FRAME_ACK:
+            self._on_frame_ack(response)
+        elif response and response[0] in (self._DRAIN_EMPTY, self._ECHO_REPLY):
+            pass                        # nothing queued / late calibration echo
+        else:
+            if response and response[0] == 0xF5:
+                self.invalidate_shadow()
 
             if response and response[0] == 0xF2:
                 print("SPIHandler: Reset command (0xF2) detected – "
-                    "waiting 2s then resetting STM32.")
-                time.sleep(2)
-                self._reset_stm32()
-            interpret_and_notify(self.app, response, self.bot_queue)
-            # activity bookkeeping
-            self.last_spi_time = time.time()
-            if self.reset_attempted:
-                self.reset_attempted = False
-                self.alert_sent = False
-        except Exception as e:
-            print(f"SPIHandler: Error during SPI communication – {e}")
+                    "resetting STM32 in 2s.")
+                self._reset_stm32(delay=self._F2_RESET_DELAY_SEC)
+            interpret_and_notify(self.app, response, self.bot_queue,
+                                 locker_offset=self.locker_offset, edge_ts=edge_ts)
+        if self.reset_state in ("booting", "awaiting_resync"):
+            self._reset_finished("board answered")
+        self._note_frame()
+
+    # ------------------------------------------------------------------
+    # Clock calibration
+    # ------------------------------------------------------------------
+    def calibrate_clock(self, speeds=None, trials=None):
+        """
+        Step the clock up through *speeds*, *trials* echo round trips each,
+        stopping at the first speed with an error. The fastest error‑free
+        speed sits right at that edge, so the clock is set one step below it.
+        Each trial takes the bus on its own, once no command is queued, and
+        puts the working clock back afterwards; frames read in the meantime
+        are dispatched at the end. Returns {speed_hz: error_rate}, or None if
+        the firmware does not answer echoes (clock unchanged).
+        """
+        if not self.spi:
+            return None
+        speeds = sorted(speeds or self._CALIBRATION_SPEEDS)
+        trials = trials or self._CALIBRATION_TRIALS
+        results = {}
+        backlog = []                    # (speed, frame) read between echoes
+        if not any(self._echo_trial(speeds[0], backlog) for _ in range(3)):
+            results = None
+        else:
+            clean = []
+            for speed in speeds:
+                errors = sum(not self._echo_trial(speed, backlog) for _ in range(trials))
+                results[speed] = errors / trials
+                print(f"SPIHandler: Clock {speed / 1e6:.2f} MHz – "
+                      f"{errors}/{trials} echo errors.")
+                if errors:
+                    if len(clean) > 1:
+                        clean.pop()             # safety margin below the edge
+                    break
+                clean.append(speed)
+            with self._bus("calibrate"):
+                self._set_clock(clean[-1] if clean else speeds[0])
+        self._end_echo_edges()
+        if results is None:
+            print("SPIHandler: Firmware does not answer echo frames – "
+                  f"keeping {self.speed_hz / 1e6:.2f} MHz.")
+            if self.health.frames:
+                # The board talks but ignores 0x3C: legacy firmware, stop probing
+                self.echo_supported = False
+                self._save_clock(None)
+        else:
+            print(f"SPIHandler: Calibrated SPI clock: {self.speed_hz / 1e6:.2f} MHz.")
+            self.echo_supported = True
+            self.clock_calibration = results
+            self._save_clock(results)
+        for speed, frame in backlog:
+            if not results or not results.get(speed):  # read at a failing speed: suspect
+                self._dispatch_frame(frame)
+        return results
+
+    def _start_calibration(self):
+        threading.Thread(target=self.calibrate_clock, daemon=True).start()
+
+    def _set_clock(self, speed_hz):
+        """Caller holds self.lock."""
+        self.spi.max_speed_hz = speed_hz
+        self.speed_hz = speed_hz
+
+    def _echo_trial(self, speed, backlog):
+        """
+        One echo round trip at *speed*; True if it came back intact. Waits
+        for the command queue to empty and holds the bus only for the trial.
+        """
+        while not self._tx_queue.empty() and self.running:
+            time.sleep(self._FRAME_GAP_SEC)
+        self._echo_seq = (self._echo_seq + 1) & 0xFF
+        seq = self._echo_seq
+        body = [self._ECHO_OPCODE, seq] + list(self._ECHO_PATTERNS[seq % len(self._ECHO_PATTERNS)])
+        expected = [self._ECHO_REPLY] + body[1:]
+        with self._bus("calibrate"):
+            working = self.speed_hz
+            self._set_clock(speed)
+            try:
+                with self._edge_lock:
+                    self._echo_edges += 1       # the IRQ edge of the reply
+                self._xfer(body + [crc8(body)])
+                for _ in range(self._DRAIN_MAX_FRAMES):  # events queued ahead of the echo
+                    self._xfer(self._DUMMY_FRAME, DIR_DUMMY)
+                    response = self._read_response(self._ECHO_READ_SEC)
+                    if (not response or response[0] in self._IDLE_BYTES
+                            or response[0] == self._DRAIN_EMPTY):
+                        return False
+                    if response[0] == self._ECHO_REPLY:
+                        self._note_frame()      # any echo proves the board is alive
+                        return list(response[:5]) == expected and response[5] == crc8(expected)
+                    backlog.append((speed, response))
+            except Exception as e:
+                print(f"SPIHandler: Error during echo transfer – {e}")
+            finally:
+                self._set_clock(working)
+        return False
+
+    def _echo_edge(self):
+        """True if the next IRQ edge belongs to a frame a calibration trial read."""
+        with self._edge_lock:
+            if self._echo_edges:
+                self._echo_edges -= 1
+                return True
+        return False
+
+    def _end_echo_edges(self):
+        """
+        Stop skipping edges after calibration. An echo that never came back
+        leaves its count unused, and a skipped edge may have been a real
+        event, so one read picks up whatever the board still has queued.
+        """
+        time.sleep(self._ECHO_READ_SEC)
+        with self._edge_lock:
+            self._echo_edges = 0
+        self._send_dummy_and_read()
+
+    def _clock_key(self):
+        return self.name or "default"
+
+    def _load_clock(self):
+        try:
+            with open(self._CLOCK_PATH, "r", encoding="utf-8") as f:
+                return json.load(f).get(self._clock_key())
+        except (OSError, ValueError):
+            return None
+
+    def _save_clock(self, results):
+        with _CLOCK_FILE_LOCK:
+            try:
+                with open(self._CLOCK_PATH, "r", encoding="utf-8") as f:
+                    data = json.load(f)
+            except (OSError, ValueError):
+                data = {}
+            now = datetime.datetime.now().isoformat(timespec="seconds")
+            if results is None:
+                data[self._clock_key()] = {"echo": "unsupported", "checked_at": now}
+            else:
+                data[self._clock_key()] = {
+                    "speed_hz": self.speed_hz,
+                    "calibrated_at": now,
+                    "error_rates": {str(speed): rate for speed, rate in results.items()},
+                }
+            try:
+                os.makedirs(os.path.dirname(self._CLOCK_PATH) or ".", exist_ok=True)
+                with open(self._CLOCK_PATH, "w", encoding="utf-8") as f:
+                    json.dump(data, f, indent=2)
+            except Exception as e:
+                print(f"SPIHandler: Failed to write {self._CLOCK_PATH} – {e}")
+
+    # ------------------------------------------------------------------
+    # Resync worker
+    # ------------------------------------------------------------------
+    def request_resync(self):
+        """Schedule app.resync_stm32(); repeated requests collapse into one run."""
+        with self._resync_cond:
+            self._resync_pending += 1
+            self.resync_requests += 1
+            self._resync_last = time.monotonic()
+            self._resync_cond.notify()
+
+    def _resync_worker(self):
+        print("SPIHandler: Resync worker thread started.")
+        while self.running:
+            with self._resync_cond:
+                while self.running and not self._resync_pending:
+                    self._resync_cond.wait(0.5)
+                if not self.running:
+                    return
+                # Debounce: wait until no new request arrived for a while
+                while True:
+                    quiet = self._resync_last + self._RESYNC_DEBOUNCE_SEC - time.monotonic()
+                    if quiet <= 0:
+                        break
+                    self._resync_cond.wait(quiet)
+                merged, self._resync_pending = self._resync_pending, 0
+            print(f"SPIHandler: Running STM32 resync ({merged} request(s) merged).")
+            self.resync_runs += 1
+            try:
+                self.app.resync_stm32()
+            except Exception as e:
+                print(f"SPIHandler: Resync failed – {e}")
 
     # ------------------------------------------------------------------
     # Watchdog thread
     # ------------------------------------------------------------------
+    def _note_frame(self):
+        """A valid frame arrived: push the silence deadline back."""
+        with self._watchdog_cond:
+            self._silence_start = time.monotonic()
+        if self.health.note_frame():
+            with self._watchdog_cond:
+                self._watchdog_cond.notify()
+
+    def _watchdog_deadline(self, state):
+        """Monotonic time at which *state* escalates, or None if it never does."""
+        offsets = {
+            SPIHealth.HEALTHY: self._SILENT_SEC,
+            SPIHealth.SILENT: self._TIMEOUT_SEC,
+            SPIHealth.RESET_PENDING: 2 * self._TIMEOUT_SEC,
+        }
+        if state not in offsets:
+            return None
+        return self._silence_start + offsets[state]
+
     def _spi_watchdog(self):
+        """
+        Sleep until the current silence deadline. Frames only move the
+        deadline; on wake‑up it is re‑read, and the state escalates only if
+        it really passed.
+        """
         print("SPIHandler: Watchdog thread started.")
         while self.running:
-            time.sleep(self._CHECK_EVERY_SEC)
-            silent_for = time.time() - self.last_spi_time
-            if silent_for > self._TIMEOUT_SEC:
-                if not self.reset_attempted:
-                    self._log_reset_event()
-                    self._reset_stm32()
-                    self.reset_attempted = True
-                    continue  # allow another timeout period before alerting
-                if self.reset_attempted and not self.alert_sent:
-                    self._send_stm32_silent_alert()
-                    self.alert_sent = True
+            with self._watchdog_cond:
+                state = self.health.state
+                deadline = self._watchdog_deadline(state)
+                if deadline is None:
+                    self._watchdog_cond.wait()      # alert sent: wait for a frame
+                    continue
+                remaining = deadline - time.monotonic()
+                if remaining > 0:
+                    self._watchdog_cond.wait(remaining)
+                    continue
+            if state == SPIHealth.HEALTHY:
+                self.health.transition(SPIHealth.SILENT)
+            elif state == SPIHealth.SILENT:
+                self._log_reset_event()
+                self.health.transition(SPIHealth.RESET_PENDING)
+                self._recalibrate_after_reset = (self.clock_mode == "auto"
+                                                 and self.echo_supported is not False)
+                self._reset_stm32()
+            elif state == SPIHealth.RESET_PENDING:
+                self._send_stm32_silent_alert()
+                self.health.transition(SPIHealth.ALERT_SENT)
 
     # ------------------------- reset helpers -------------------
-    def _reset_stm32(self):
+    def _reset_stm32(self, delay=0):
+        """
+        Start a reset without blocking the caller. Timers drive the states:
+        pending (optional delay) → pulsing (NRST low) → booting (NRST high)
+        → awaiting_resync (until the board sends a frame) → idle.
+        Ignored while a reset is already in progress.
+        """
+        with self._reset_cond:
+            if self.reset_state != "idle":
+                print(f"SPIHandler: Reset already in progress ({self.reset_state}).")
+                return
+            self.reset_count += 1
+            if delay > 0:
+                self._set_reset_state("pending")
+                self._start_reset_timer(delay, self._begin_pulse)
+                return
+        self._begin_pulse()
+
+    def _begin_pulse(self):
         print("SPIHandler: Pulsing NRST low for reset.")
+        self.invalidate_shadow()
+        with self._reset_cond:
+            self._set_reset_state("pulsing")
         try:
-            lgpio.gpio_write(self.chip, self._RESET_GPIO_PIN, 0)
-            time.sleep(self._RESET_PULSE_SEC)
-            lgpio.gpio_write(self.chip, self._RESET_GPIO_PIN, 1)
+            self.gpio.gpio_write(self.chip, self._RESET_GPIO_PIN, 0)
         except Exception as e:
             print(f"SPIHandler: Failed to pulse reset pin – {e}")
+        self._start_reset_timer(self._RESET_PULSE_SEC, self._end_pulse)
+
+    def _end_pulse(self):
+        try:
+            self.gpio.gpio_write(self.chip, self._RESET_GPIO_PIN, 1)
+        except Exception as e:
+            print(f"SPIHandler: Failed to release reset pin – {e}")
+        with self._reset_cond:
+            self._set_reset_state("booting")
+        self._start_reset_timer(self._BOOT_SEC, self._await_resync)
+
+    def _await_resync(self):
+        with self._reset_cond:
+            if self.reset_state != "booting":
+                return
+            self._set_reset_state("awaiting_resync")
+        self._start_reset_timer(self._RESYNC_WAIT_SEC, self._resync_timeout)
+
+    def _resync_timeout(self):
+        if self.reset_state == "awaiting_resync":
+            # The board never asked for its tables – push them anyway
+            self.request_resync()
+            self._reset_finished("no frame after boot")
+
+    def _reset_finished(self, reason):
+        with self._reset_cond:
+            if self.reset_state == "idle":
+                return
+            if self._reset_timer:
+                self._reset_timer.cancel()
+                self._reset_timer = None
+            self._set_reset_state("idle")
+        print(f"SPIHandler: Reset complete ({reason}) – releasing held commands.")
+        if self._recalibrate_after_reset:
+            self._recalibrate_after_reset = False
+            self._start_calibration()
+
+    def _set_reset_state(self, state):
+        """Caller holds self._reset_cond."""
+        self.reset_state = state
+        self._reset_cond.notify_all()
+
+    def _start_reset_timer(self, delay, func):
+        timer = threading.Timer(delay, func)
+        timer.daemon = True
+        self._reset_timer = timer
+        timer.start()
+
+    def _wait_until_board_ready(self):
+        """Writer side: hold commands while the STM32 is being reset."""
+        with self._reset_cond:
+            while self.running and self.reset_state not in ("idle", "pending"):
+                self._reset_cond.wait(0.5)
 
     def _log_reset_event(self):
         try:
             ts = datetime.datetime.now().isoformat(sep=" ", timespec="seconds")
-            line = f"{ts} – Watchdog reset: no SPI for {self._TIMEOUT_SEC}s\n"
+            board = f" (board {self.name})" if self.name else ""
+            line = f"{ts} – Watchdog reset{board}: no SPI for {self._TIMEOUT_SEC}s\n"
             with open(self._BLACKBOX_PATH, "a", encoding="utf-8") as f:
                 f.write(line)
             print(f"SPIHandler: Logged reset event to {self._BLACKBOX_PATH}.")
@@ -230,16 +1675,39 @@ class SPIHandler:
     # ------------------------- teardown -----------------------
     def close(self):
         self.running = False
+        with self._watchdog_cond:
+            self._watchdog_cond.notify_all()
+        if self._edge_cb:
+            try:
+                self._edge_cb.cancel()
+            except Exception as e:
+                print(f"SPIHandler: Failed to cancel edge callback – {e}")
         try:
             self.gpio_thread.join()
+            self.writer_thread.join()
+            self.resync_thread.join()
+            if self.retransmit_thread:
+                self.retransmit_thread.join()
             self.watchdog_thread.join()
         except RuntimeError:
             pass
+        # Fail whatever never made it onto the wire
+        while True:
+            try:
+                _prio, _seq, cmd = self._tx_queue.get_nowait()
+            except queue.Empty:
+                break
+            if cmd.superseded:
+                continue
+            for f in cmd.futures():
+                if f.set_running_or_notify_cancel():
+                    f.set_exception(RuntimeError("SPIHandler closed"))
         try:
             if self.spi:
                 self.spi.close()
             if self.chip:
-                lgpio.gpiochip_close(self.chip)
+                self.gpio.gpiochip_close(self.chip)
+            self.stop_capture()
             print("SPIHandler: Cleaned up resources.")
         except Exception as e:
             print(f"SPIHandler: Cleanup failed – {e}")
@@ -0,0 +1,198 @@
+# spi_metrics.py
+#
+# Low‑overhead latency histograms for the Pi ↔ STM32 SPI link
+# -----------------------------------------------------------------------------
+# SPIHandler keeps one SpiMetrics instance (handler.metrics) and records, per
+# command label ("0x01" … "0x10", "read", "dummy"):
+#   • lock_wait – time spent waiting for SPIHandler.lock
+#   • transfer  – duration of each xfer2() call
+#   • latency   – send_command() → Future resolved (queue + wire + ack)
+#   • errors    – xfer2 exceptions, failed Futures, rejected framed commands
+#
+# Each histogram is a fixed array of 1‑2‑5 buckets (10 µs … 10 s), so one
+# observation is a bisect + two additions under a lock – cheap enough to
+# leave on in production.
+#
+# EVENT_JOURNAL follows STM32 events instead: every IRQ edge is stamped
+# with time.monotonic() and each stage records its delay from that edge
+# (read → decode → db / notify → handled) in a rolling window.
+#
+# Usage:
+#   snap = handler.metrics_snapshot()            # or (reset=True)
+#   print(format_snapshot(snap))
+#   print(format_journal(EVENT_JOURNAL.snapshot()))
+# -----------------------------------------------------------------------------
+
+import bisect
+import collections
+import threading
+import time
+
+# Bucket upper bounds in seconds: 10 µs, 20 µs, 50 µs, … 10 s (+ overflow)
+_BOUNDS = [m * 10.0 ** e for e in range(-5, 1) for m in (1, 2, 5)] + [10.0]
+
+
+class LatencyHistogram:
+    """Fixed‑bucket histogram of durations in seconds (not thread‑safe)."""
+
+    __slots__ = ("counts", "count", "total", "max")
+
+    def __init__(self):
+        self.counts = [0] * (len(_BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(_BOUNDS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, p):
+        """Upper bound of the bucket holding the p‑th percentile (seconds)."""
+        if not self.count:
+            return 0.0
+        target = p / 100.0 * self.count
+        running = 0
+        for index, n in enumerate(self.counts):
+            running += n
+            if running >= target:
+                return min(_BOUNDS[index], self.max) if index < len(_BOUNDS) else self.max
+        return self.max
+
+    def snapshot(self):
+        if not self.count:
+            return {"count": 0}
+        return {
+            "count": self.count,
+            "avg_ms": self.total / self.count * 1000,
+            "p50_ms": self.percentile(50) * 1000,
+            "p95_ms": self.percentile(95) * 1000,
+            "p99_ms": self.percentile(99) * 1000,
+            "max_ms": self.max * 1000,
+            "buckets": [((_BOUNDS[i] * 1000) if i < len(_BOUNDS) else None, n)
+                        for i, n in enumerate(self.counts) if n],
+        }
+
+
+class SpiMetrics:
+    """Thread‑safe per‑label histograms and error counters."""
+
+    STAGES = ("lock_wait", "transfer", "latency")
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._hist = {}                 # (stage, label) → LatencyHistogram
+        self._errors = collections.Counter()   # (label, kind) → count
+
+    def observe(self, stage, label, seconds):
+        key = (stage, label)
+        with self._lock:
+            hist = self._hist.get(key)
+            if hist is None:
+                hist = self._hist[key] = LatencyHistogram()
+            hist.observe(seconds)
+
+    def error(self, label, kind):
+        with self._lock:
+            self._errors[(label, kind)] += 1
+
+    def snapshot(self, reset=False):
+        """{label: {stage: {...}, "errors": {kind: n}}}; optionally clears."""
+        with self._lock:
+            result = {}
+            for (stage, label), hist in self._hist.items():
+                result.setdefault(label, {})[stage] = hist.snapshot()
+            for (label, kind), n in self._errors.items():
+                result.setdefault(label, {}).setdefault("errors", {})[kind] = n
+            if reset:
+                self._hist.clear()
+                self._errors.clear()
+        return result
+
+    def reset(self):
+        self.snapshot(reset=True)
+
+
+class LatencyJournal:
+    """Rolling window of IRQ edge → stage delays (seconds) per stage."""
+
+    STAGES = ("read", "decode", "db", "notify", "handled")
+
+    def __init__(self, window=1000):
+        self.window = window
+        self._lock = threading.Lock()
+        self._samples = {}              # stage → deque of seconds
+
+    def record(self, stage, edge_ts, now=None):
+        """Note that *stage* was reached for the event stamped *edge_ts*."""
+        if edge_ts is None:
+            return
+        elapsed = (now if now is not None else time.monotonic()) - edge_ts
+        with self._lock:
+            samples = self._samples.get(stage)
+            if samples is None:
+                samples = self._samples[stage] = collections.deque(maxlen=self.window)
+            samples.append(elapsed)
+
+    def snapshot(self):
+        """{stage: {"count", "p50_ms", "p95_ms", "p99_ms", "max_ms"}} over the window."""
+        with self._lock:
+            copies = {stage: sorted(s) for stage, s in self._samples.items()}
+        result = {}
+        for stage, samples in copies.items():
+            if not samples:
+                continue
+            last = len(samples) - 1
+            result[stage] = {
+                "count": len(samples),
+                "p50_ms": samples[int(0.50 * last)] * 1000,
+                "p95_ms": samples[int(0.95 * last)] * 1000,
+                "p99_ms": samples[int(0.99 * last)] * 1000,
+                "max_ms": samples[-1] * 1000,
+            }
+        return result
+
+    def reset(self):
+        with self._lock:
+            self._samples.clear()
+
+
+EVENT_JOURNAL = LatencyJournal()
+
+
+def command_label(opcode):
+    return f"0x{opcode:02X}"
+
+
+def format_journal(snap):
+    """Render LatencyJournal.snapshot() as a plain‑text table (ms from the edge)."""
+    lines = [f"{'stage':8} {'count':>7} {'p50':>8} {'p95':>8} {'p99':>8} {'max':>8}  (ms from IRQ edge)"]
+    for stage in LatencyJournal.STAGES:
+        s = snap.get(stage)
+        if s:
+            lines.append(f"{stage:8} {s['count']:7d} {s['p50_ms']:8.3f} {s['p95_ms']:8.3f} "
+                         f"{s['p99_ms']:8.3f} {s['max_ms']:8.3f}")
+    return "\n".join(lines)
+
+
+def format_snapshot(snap):
+    """Render SPIHandler.metrics_snapshot() as a plain‑text table."""
+    lines = [f"SPI clock {snap.get('speed_hz', 0) / 1e6:.2f} MHz, "
+             f"inter‑frame gap {snap.get('frame_gap_ms', 0):.0f} ms"]
+    lines.append(f"{'label':7} {'stage':10} {'count':>7} {'avg':>8} {'p50':>8} "
+                 f"{'p95':>8} {'p99':>8} {'max':>8}  (ms)")
+    for label, stages in sorted(snap.get("commands", {}).items()):
+        for stage in SpiMetrics.STAGES:
+            h = stages.get(stage)
+            if not h or not h["count"]:
+                continue
+            lines.append(f"{label:7} {stage:10} {h['count']:7d} {h['avg_ms']:8.3f} "
+                         f"{h['p50_ms']:8.3f} {h['p95_ms']:8.3f} {h['p99_ms']:8.3f} "
+                         f"{h['max_ms']:8.3f}")
+        if stages.get("errors"):
+            errors = ", ".join(f"{k}={v}" for k, v in sorted(stages["errors"].items()))
+            lines.append(f"{label:7} errors     {errors}")
+    return "\n".join(lines)
@@ -0,0 +1,469 @@
+# stm32_simulator.py
+#
+# Software stand‑in for the STM32 locker controller
+# -----------------------------------------------------------------------------
+# Implements the same surface SPIHandler uses from spidev and lgpio, backed by
+# a model of the controller:
+#   • Registers for locker prices, LED colours/modes, fan mode and unlocks
+#   • Legacy 6‑byte commands, bulk tables (0x10 → 0xF7 ack) and the framed
+#     protocol (0xA5 … CRC‑8 → 0xF8 ack), several frames per chip‑select;
+#     a retransmitted seq is re‑acked without running the command again
+#   • Event generator emitting 0xF1–0xF6 frames at configurable rates, with
+#     bursts, and silence periods to exercise the watchdog
+#   • NRST on GPIO 14: pulling it low wipes the registers, releasing it
+#     boots the model and requests a resync (0xF5)
+#   • Echo frames (0x3C → 0xF9) for clock calibration, and bit‑error
+#     injection that can grow above a given SPI clock (clock_limit_hz)
+#
+# Usage (load test on any Linux box):
+#   python stm32_simulator.py --rate 300 --seconds 10
+#   python stm32_simulator.py --clock-limit 2000000 --seconds 2   # + calibration
+# -----------------------------------------------------------------------------
+
+import argparse
+import collections
+import os
+import queue
+import random
+import tempfile
+import threading
+import time
+
+from spi_handler import crc8
+
+
+class STM32Simulator:
+    """Register model plus the outgoing frame queue the Pi reads from."""
+
+    IRQ_PIN = 17
+    RESET_PIN = 14
+    BOOT_SEC = 0.2                # NRST release → 0xF5 resync request
+    SEQ_WINDOW = 16               # recent framed seqs remembered for dedupe
+
+    def __init__(self, lockers=14, sensors=3, ready_delay=0.0, drain=True,
+                 bulk=True, framed=True, ack_drop_rate=0.0, seed=None,
+                 echo=True, bit_error_rate=0.0, clock_limit_hz=None,
+                 clock_error_rate=0.3):
+        self.lockers = lockers
+        self.sensors = sensors
+        self.ready_delay = ready_delay      # dummy phase → response loaded
+        self.drain = drain                  # answer 0xFE when nothing is queued
+        self.bulk = bulk                    # understand 0x10 bulk tables
+        self.framed = framed                # understand 0xA5 framed commands
+        self.ack_drop_rate = ack_drop_rate  # fraction of acks silently lost
+        self.echo = echo                    # answer 0x3C calibration echoes
+        self.bit_error_rate = bit_error_rate        # per transfer, any clock
+        self.clock_limit_hz = clock_limit_hz        # above this the link degrades
+        self.clock_error_rate = clock_error_rate    # per transfer, above the limit
+        self.random = random.Random(seed)
+
+        self.lock = threading.RLock()
+        self.prices = {}
+        self.colors = {}
+        self.fan_mode = None
+        self.unlocks = collections.Counter()
+        self.commands_seen = collections.Counter()
+        self.crc_errors = 0
+        self.bit_errors = 0
+        self.duplicates = 0
+        self._applied_seqs = collections.OrderedDict()     # seq → (body, status)
+
+        self._outbox = collections.deque()
+        self._armed_at = None               # time of the last dummy phase
+        self._bulk_records = []
+        self.in_reset = False
+        self.silent_until = 0.0
+
+        self.frames_emitted = 0
+        self.gpio = SimulatedLgpio(self)
+        self._event_thread = None
+        self._running = False
+
+    # ------------------------------------------------------------------
+    # SPI side
+    # ------------------------------------------------------------------
+    def transfer(self, data):
+        """One chip‑select cycle: returns what the Pi clocks back in."""
+        data = list(data)
+        with self.lock:
+            if self.in_reset:
+                return [0x00] * len(data)
+            if data == [0xFF] * len(data):
+                self._armed_at = time.monotonic()
+                return [0x00] * len(data)
+            if data == [0x00] * len(data):
+                return self._read_frame(len(data))
+            self._handle_command(data)
+            return [0x00] * len(data)
+
+    def _read_frame(self, length):
+        if self._armed_at is None or time.monotonic() - self._armed_at < self.ready_delay:
+            return [0x00] * length
+        if self._outbox:
+            frame = self._outbox.popleft()
+        else:
+            self._armed_at = None
+            frame = [0xFE, 0, 0, 0, 0, 0] if self.drain else [0x00] * 6
+        return (frame + [0x00] * length)[:length]
+
+    def _handle_command(self, data):
+        opcode = data[0]
+        self.commands_seen[opcode] += 1
+        if opcode == 0xA5 and self.framed:
+            # Several frames may share one chip‑select (SPIHandler batch=True)
+            for start in range(0, len(data), 9):
+                if data[start] != 0xA5 or not self._handle_frame(data[start:start + 9]):
+                    break
+        elif opcode == 0x10 and self.bulk:
+            self._handle_bulk(data)
+        elif opcode == 0x3C and self.echo:
+            if len(data) < 6 or crc8(data[:5]) != data[5]:
+                self.crc_errors += 1
+                return
+            reply = [0xF9] + data[1:5]
+            self._emit(reply + [crc8(reply)])
+        else:
+            self._apply(opcode, data[1:6])
+
+    def _handle_frame(self, frame):
+        body, crc = frame[1:8], frame[8] if len(frame) > 8 else None
+        if crc is None or crc8(body) != crc:
+            self.crc_errors += 1
+            return False
+        seq = body[0]
+        seen = self._applied_seqs.get(seq)
+        if seen is not None and seen[0] == body:
+            # Retransmit whose ack was lost: ack again, don't unlock twice
+            self.duplicates += 1
+            status = seen[1]
+        else:
+            status = self._apply(body[1], body[2:7])
+            self._applied_seqs.pop(seq, None)
+            self._applied_seqs[seq] = (body, status)
+            if len(self._applied_seqs) > self.SEQ_WINDOW:
+                self._applied_seqs.popitem(last=False)
+        if self.random.random() >= self.ack_drop_rate:
+            ack = [0xF8, seq, status, 0, 0]
+            self._emit(ack + [crc8(ack)])
+        return True
+
+    def _apply(self, opcode, data):
+        """Apply one command to the registers; returns a status byte."""
+        locker = data[0]
+        if opcode == 0x01:
+            targets = range(1, self.lockers + 1) if locker == 255 else [locker]
+            for lid in targets:
+                self.colors[lid] = tuple(data[1:5])
+        elif opcode == 0x02:
+            self.prices[locker] = (data[1] << 8) | data[2]
+        elif opcode == 0x03:
+            if not 1 <= locker <= self.lockers:
+                return 1
+            self.unlocks[locker] += 1
+        elif opcode == 0x04:
+            self.fan_mode = locker
+        else:
+            return 2
+        return 0
+
+    def _handle_bulk(self, data):
+        table, count = data[1], (data[2] << 8) | data[3]
+        index, total = data[4], data[5]
+        size = {0x01: 5, 0x02: 3}.get(table)
+        if size is None:
+            return
+        if index == 0:
+            self._bulk_records = []
+        self._bulk_records += data[6:]
+        if index + 1 < total:
+            return
+        records = self._bulk_records
+        for i in range(0, count * size, size):
+            rec = records[i:i + size]
+            if table == 0x01:
+                self._apply(0x01, rec)
+            else:
+                self._apply(0x02, rec + [0xFF, 0xFF])
+        self._emit([0xF7, table, (count >> 8) & 0xFF, count & 0xFF,
+                    sum(records[:count * size]) & 0xFF, 0])
+
+    # ------------------------------------------------------------------
+    # Outgoing events
+    # ------------------------------------------------------------------
+    def _emit(self, frame):
+        """Queue a frame for the Pi and toggle the IRQ line."""
+        with self.lock:
+            if self.in_reset or time.monotonic() < self.silent_until:
+                return
+            self._outbox.append(list(frame))
+            self.frames_emitted += 1
+        self.gpio.toggle(self.IRQ_PIN)
+
+    def locker_alert(self, locker=None, code=None):
+        locker = locker or self.random.randint(1, self.lockers)
+        self._emit([0xF1, locker, code or self.random.choice((50, 100)), 0, 0, 0])
+
+    def i2c_alert(self, locker=None, code=None):
+        locker = locker or self.random.randint(1, self.lockers)
+        self._emit([0xF2, locker, code or self.random.choice((50, 100)), 0, 0, 0])
+
+    def climate_alert(self, sensor=None, code=None):
+        sensor = sensor or self.random.randint(1, self.sensors)
+        self._emit([0xF3, sensor, code or self.random.choice((50, 100)), 0, 0, 0])
+
+    def climate_sample(self, sensor=None):
+        sensor = sensor or self.random.randint(1, self.sensors)
+        temp = int(self.random.uniform(2.0, 30.0) * 100)
+        hum = int(self.random.uniform(20.0, 80.0) * 100)
+        self._emit([0xF4, sensor, temp >> 8, temp & 0xFF, hum >> 8, hum & 0xFF])
+
+    def request_resync(self):
+        self._emit([0xF5, 0, 0, 0, 0, 0])
+
+    def black_box(self, code=None, value=None):
+        code = code or self.random.randint(1, 8)
+        value = value if value is not None else self.random.randint(1, self.lockers)
+        self._emit([0xF6, value, code, 0, 0, 0])
+
+    def burst(self):
+        """Climate samples from every sensor plus a locker alert, back to back."""
+        for sensor in range(1, self.sensors + 1):
+            self.climate_sample(sensor)
+        self.locker_alert()
+
+    def silence(self, seconds):
+        """Stop emitting anything for *seconds* (watchdog testing)."""
+        self.silent_until = time.monotonic() + seconds
+
+    # ------------------------------------------------------------------
+    # Event generator
+    # ------------------------------------------------------------------
+    def start_events(self, rate=5.0, burst_every=0.0, mix=None):
+        """
+        Emit frames at *rate* per second (exponential gaps). *mix* weights the
+        event types; 0xF2 is left out by default because SPIHandler answers
+        it with an NRST reset. A burst() is added every *burst_every* seconds.
+        """
+        mix = mix or {"climate_sample": 6, "locker_alert": 1, "climate_alert": 1,
+                      "black_box": 1, "request_resync": 0.1}
+        kinds = list(mix)
+        weights = [mix[k] for k in kinds]
+        self._running = True
+
+        def run():
+            next_burst = time.monotonic() + burst_every if burst_every else None
+            while self._running:
+                time.sleep(self.random.expovariate(rate))
+                getattr(self, self.random.choices(kinds, weights)[0])()
+                if next_burst and time.monotonic() >= next_burst:
+                    self.burst()
+                    next_burst += burst_every
+
+        self._event_thread = threading.Thread(target=run, daemon=True)
+        self._event_thread.start()
+
+    def stop_events(self):
+        self._running = False
+        if self._event_thread:
+            self._event_thread.join()
+
+    # ------------------------------------------------------------------
+    # Reset line
+    # ------------------------------------------------------------------
+    def set_reset(self, level):
+        with self.lock:
+            if level == 0:
+                self.in_reset = True
+                self.prices.clear()
+                self.colors.clear()
+                self.fan_mode = None
+                self._outbox.clear()
+                self._applied_seqs.clear()
+                self._armed_at = None
+                return
+            if not self.in_reset:
+                return
+        timer = threading.Timer(self.BOOT_SEC, self._boot)
+        timer.daemon = True
+        timer.start()
+
+    def _boot(self):
+        with self.lock:
+            self.in_reset = False
+        self.request_resync()
+
+    def spidev(self):
+        return SimulatedSpiDev(self)
+
+    def error_rate(self, speed_hz):
+        """Probability that one transfer direction gets a flipped bit."""
+        rate = self.bit_error_rate
+        if self.clock_limit_hz and speed_hz > self.clock_limit_hz:
+            rate += self.clock_error_rate
+        return rate
+
+    def corrupt(self, data, speed_hz):
+        """Flip one random bit of *data* with probability error_rate()."""
+        rate = self.error_rate(speed_hz)
+        if not data or not rate or self.random.random() >= rate:
+            return data
+        data = list(data)
+        index = self.random.randrange(len(data))
+        data[index] ^= 1 << self.random.randrange(8)
+        self.bit_errors += 1
+        return data
+
+
+class SimulatedSpiDev:
+    """spidev.SpiDev look‑alike wired to an STM32Simulator."""
+
+    def __init__(self, sim):
+        self.sim = sim
+        self.max_speed_hz = 0
+        self.mode = 0
+        self.transfers = 0
+
+    def open(self, bus, device):
+        self.bus, self.device = bus, device
+
+    def xfer2(self, data):
+        self.transfers += 1
+        data = self.sim.corrupt(data, self.max_speed_hz)
+        return self.sim.corrupt(self.sim.transfer(data), self.max_speed_hz)
+
+    def writebytes2(self, data):
+        self.transfers += 1
+        self.sim.transfer(self.sim.corrupt(data, self.max_speed_hz))
+
+    def close(self):
+        pass
+
+
+class _SimCallback:
+    def __init__(self, owner, gpio, func):
+        self.owner = owner
+        self.gpio = gpio
+        self.func = func
+
+    def cancel(self):
+        if self in self.owner.callbacks:
+            self.owner.callbacks.remove(self)
+
+
+class SimulatedLgpio:
+    """lgpio look‑alike: the IRQ pin is driven by the simulator, NRST drives it."""
+
+    RISING_EDGE = 1
+    FALLING_EDGE = 2
+    BOTH_EDGES = 3
+
+    def __init__(self, sim):
+        self.sim = sim
+        self.levels = collections.defaultdict(int)
+        self.callbacks = []
+        self._level_lock = threading.Lock()
+
+    def gpiochip_open(self, chip):
+        return chip
+
+    def gpiochip_close(self, handle):
+        pass
+
+    def gpio_claim_input(self, handle, gpio):
+        pass
+
+    def gpio_claim_output(self, handle, gpio, level):
+        self.levels[gpio] = level
+
+    def gpio_claim_alert(self, handle, gpio, edge, flags=0):
+        pass
+
+    def callback(self, handle, gpio, edge=BOTH_EDGES, func=None):
+        cb = _SimCallback(self, gpio, func)
+        self.callbacks.append(cb)
+        return cb
+
+    def gpio_read(self, handle, gpio):
+        return self.levels[gpio]
+
+    def gpio_write(self, handle, gpio, level):
+        self.levels[gpio] = level
+        if gpio == self.sim.RESET_PIN:
+            self.sim.set_reset(level)
+
+    def toggle(self, gpio):
+        with self._level_lock:
+            level = self.levels[gpio] = 1 - self.levels[gpio]
+        tick = time.monotonic_ns()
+        for cb in list(self.callbacks):
+            if cb.gpio == gpio and cb.func:
+                cb.func(0, gpio, level, tick)
+
+
+# -----------------------------------------------------------------------------
+#  Load test
+# -----------------------------------------------------------------------------
+class _LoadTestApp:
+    """Just enough of VendingMachineApp for interpret_and_notify."""
+
+    class _Frame:
+        def show(self):
+            pass
+
+    def __init__(self):
+        self.information_frame = self._Frame()
+        self.spi_handler = None
+
+    def resync_stm32(self, force=False):
+        if self.spi_handler:
+            self.spi_handler.upload_prices({i: 500 for i in range(1, 15)}, force=force)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load-test SPIHandler against the STM32 simulator")
+    parser.add_argument("--rate", type=float, default=200.0, help="events per second")
+    parser.add_argument("--seconds", type=float, default=10.0)
+    parser.add_argument("--burst-every", type=float, default=1.0)
+    parser.add_argument("--ready-delay", type=float, default=0.001)
+    parser.add_argument("--drain", action="store_true", help="enable SPIHandler drain mode")
+    parser.add_argument("--clock-limit", type=int, default=None,
+                        help="inject bit errors above this SPI clock and calibrate first")
+    args = parser.parse_args()
+
+    from spi_handler import SPIHandler
+    from spi_metrics import EVENT_JOURNAL, format_journal, format_snapshot
+
+    # interpret_and_notify writes into ./logs – keep that out of the repo
+    os.chdir(tempfile.mkdtemp(prefix="stm32sim_"))
+    os.makedirs("logs", exist_ok=True)
+
+    sim = STM32Simulator(ready_delay=args.ready_delay, clock_limit_hz=args.clock_limit)
+    app = _LoadTestApp()
+    bot_queue = queue.Queue()
+    handler = SPIHandler(app, bot_queue, spi_dev=sim.spidev(), gpio=sim.gpio,
+                         drain=args.drain, read_mode="adaptive")
+    app.spi_handler = handler
+    if args.clock_limit:
+        rates = handler.calibrate_clock()
+        print(f"calibration: {rates} → {handler.speed_hz / 1e6:.2f} MHz")
+
+    start = time.monotonic()
+    sim.start_events(rate=args.rate, burst_every=args.burst_every)
+    time.sleep(args.seconds)
+    sim.stop_events()
+    time.sleep(0.5)                     # let the reader catch up
+    elapsed = time.monotonic() - start
+    handler.close()
+
+    print("\n=== STM32 simulator load test ===")
+    print(f"emitted  : {sim.frames_emitted} frames ({sim.frames_emitted / elapsed:.1f}/s)")
+    print(f"handled  : {handler.frames_received} frames ({handler.frames_received / elapsed:.1f}/s)")
+    print(f"telegram : {bot_queue.qsize()} queued messages")
+    print(f"drain    : {dict(handler.drain_batches)}")
+    print(f"turnaround: {handler.read_turnaround_stats()}")
+    print(format_snapshot(handler.metrics_snapshot()))
+    print(format_journal(EVENT_JOURNAL.snapshot()))
+
+
+if __name__ == "__main__":
+    main()
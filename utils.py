@@ -7,6 +7,9 @@ from datetime import datetime, timedelta
 from collections import Counter
 import matplotlib.pyplot as plt
 import time
+import struct
+import threading
+from spi_metrics import EVENT_JOURNAL
 
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
@@ -730,103 +733,212 @@ def generate_locker_info():
                 # Locker is empty
                 lines.append(f"🔴 Locker {locker_id_str}: {price}€ (Empty)")
 
+    boards = load_spi_health()
+    if boards:
+        lines.append("")
+    for health in boards:
+        since = datetime.fromtimestamp(health["since"]).strftime("%Y-%m-%d %H:%M")
+        board = f" {health['board']}" if health.get("board") else ""
+        lines.append(f"📡 STM32{board} link: {health['state']} since {since} "
+                     f"(resets: {health['resets']}, alerts: {health['alerts']})")
+
+    reader = load_mdb_health()
+    if reader:
+        state = "ready" if reader["ready"] else "not ready"
+        if reader["ready"] and reader.get("since"):
+            state += " since " + datetime.fromtimestamp(reader["since"]).strftime("%Y-%m-%d %H:%M")
+        lines.append(f"💳 Card reader: {state} (resets: {reader['resets']}, "
+                     f"reinits: {reader['reinits']}, failures: {reader['failures']})")
+
     return "\n".join(lines)
 
 
+# ---------------------------------------------------------------------------
+#  Health snapshots shared with the bot process
+# ---------------------------------------------------------------------------
+# SPIHealth and ReaderSupervisor mirror their state into logs/*.json on every
+# change; the bot only ever reads those files. Writes go through a temp file
+# and os.replace() so a reader never sees half a file.
 
+def save_snapshot(path, data, owner):
+    """Atomically write *data* as JSON to *path*; errors are logged as *owner*."""
+    if not path:
+        return
+    try:
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        tmp = path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(data, f)
+        os.replace(tmp, path)
+    except Exception as e:
+        print(f"{owner}: Failed to write {path} – {e}")
 
 
-def interpret_and_notify(app, data, bot_queue):
-    # Updated validation to expect 6 bytes
-    if not isinstance(bytes(data), (bytes, bytearray)) or len(data) != 6:
-        print("Invalid input: Expected a 6-byte sequence.")
-        return  # Exit if input is invalid
-    
-    # Extract bytes
-    command = data[0]
-    byte1 = data[1]
-    byte2 = data[2]
-    byte3 = data[3]
-    byte4 = data[4]
-    byte5 = data[5]  # leftover or status code if needed
-
-    if command == 0xF1:  # Problems with lockers
-        locker_id = byte1
-        subject = '❗️"Problems with Locker"❗️'
-        if byte2 == 50:
-            body = f"Locker {locker_id}: Has been opened for 1 minute."
-        elif byte2 == 100:
-            body = f"Locker {locker_id}: Free space."
-        elif byte2 == 150:
-            body = f"Locker {locker_id}: Jammed. Customer has been informed to call support."
-            app.information_frame.show()
-        else:
-            body = f"Locker {locker_id}: Unknown issue (code {byte2})."
+def load_snapshot(path):
+    """Dict written by save_snapshot(), or None if missing or unreadable."""
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
 
-        message = {
-            "chat_id": None,  # Broadcast to all
-            "text": f"{subject}\n{body}"
-        }
-        bot_queue.put(message)
-
-    elif command == 0xF2:  # Problems with I2C devices
-        locker_id = byte1
-        subject = '❗️"Problems with I2C Devices"❗️'
-        if byte2 == 50:
-            body = f"Locker {locker_id}: Issue with price tag display."
-        elif byte2 == 100:
-            body = f"Locker {locker_id}: Issue with LED stripe driver."
-        else:
-            body = f"Locker {locker_id}: Unknown issue (code {byte2})."
 
-        message = {
-            "chat_id": None,  
-            "text": f"{subject}\n{body}"
-        }
-        bot_queue.put(message)
-
-    elif command == 0xF3:  # Problems in ventilation system
-        ventilation_object = byte1
-        subject = '❗️"Problems with Climate"❗️'
-        if byte2 == 50:
-            body = f"Temperature below zero! Sensor {ventilation_object}!"
-        elif byte2 == 100:
-            body = f"Sensor is disconnected! Sensor {ventilation_object}!"
-        else:
-            body = f"Ventilation object {ventilation_object}: Unknown issue (code {byte2})."
+def load_spi_health():
+    """Last SPI link health written by each SPIHandler (one dict per board)."""
+    try:
+        names = sorted(n for n in os.listdir(LOG_FOLDER)
+                       if n.startswith("spi_health") and n.endswith(".json"))
+    except OSError:
+        return []
+    boards = (load_snapshot(os.path.join(LOG_FOLDER, name)) for name in names)
+    return [board for board in boards if board is not None]
 
-        message = {
-            "chat_id": None,  
-            "text": f"{subject}\n{body}"
-        }
-        bot_queue.put(message)
-
-    elif command == 0xF4:
-        """
-        If command 0xF4 is received:
-        - byte[1] => sensor_number
-        - byte[2..3] => temperature * 100
-        - byte[4..5] => humidity * 100
-
-        Then log date/time, sensor_number, temperature, and humidity in logs/climate.db
-        """
-        sensor_number = byte1
-        
-        # Construct 16-bit integers from two bytes each for temp & humidity
-        temp_raw = (byte2 << 8) | byte3
-        hum_raw  = (byte4 << 8) | byte5
-        
-        # Convert to float with 2 decimals
-        temperature = temp_raw / 100.0
-        humidity    = hum_raw / 100.0
-        
-        # Create logs/climate.db if not exist, ensure climate table includes 'sensor'
-        climate_db_path = "logs/climate.db"
-        conn = sqlite3.connect(climate_db_path)
-        cursor = conn.cursor()
-        
-        # Attempt to add a 'sensor' column if it doesn't exist
-        # (If the table is brand-new, it will have it. If existing, we add safely.)
+
+def load_mdb_health():
+    """Last card reader state written by ReaderSupervisor, or None."""
+    return load_snapshot(os.path.join(LOG_FOLDER, "mdb_health.json"))
+
+
+
+
+# ---------------------------------------------------------------------------
+#  STM32 frame decoding
+# ---------------------------------------------------------------------------
+# Every STM32 frame is 6 bytes: [opcode, payload(5)]. Each opcode has one
+# handler registered with the struct format of its payload, so decoding is a
+# single dict lookup + struct.unpack_from per frame.
+
+_FRAME_HANDLERS = {}        # opcode → (struct.Struct, handler, locker_field)
+_FRAME_STATS = {}           # opcode → [count, total_sec, max_sec]
+_FRAME_STATS_LOCK = threading.Lock()
+_frame_context = threading.local()  # .edge_ts / .locker_offset of the frame being handled
+
+
+def register_frame_handler(opcode, fmt, locker_field=None):
+    """
+    Decorator registering handler(app, bot_queue, data, *fields) for *opcode*.
+    *fmt* is a struct format describing the 5 payload bytes; *locker_field*
+    is the index of the field holding a board‑local locker number, shifted
+    by the board's locker_offset before the handler sees it.
+    """
+    layout = struct.Struct(fmt)
+    if layout.size != 5:
+        raise ValueError(f"Payload format {fmt!r} must describe 5 bytes")
+
+    def decorator(handler):
+        _FRAME_HANDLERS[opcode] = (layout, handler, locker_field)
+        return handler
+    return decorator
+
+
+def get_frame_stats():
+    """Per-opcode frame counts and handler time: {0xF4: {"count", "avg_ms", "max_ms"}}."""
+    with _FRAME_STATS_LOCK:
+        items = [(op, list(v)) for op, v in _FRAME_STATS.items()]
+    return {
+        op: {"count": count, "avg_ms": total / count * 1000 if count else 0.0, "max_ms": peak * 1000}
+        for op, (count, total, peak) in items
+    }
+
+
+def reset_frame_stats():
+    with _FRAME_STATS_LOCK:
+        _FRAME_STATS.clear()
+
+
+def _edge_ts():
+    """IRQ edge timestamp of the frame being handled, or None."""
+    return getattr(_frame_context, "edge_ts", None)
+
+
+def _notify(bot_queue, subject, body):
+    message = {
+        "chat_id": None,  # Broadcast to all
+        "text": f"{subject}\n{body}"
+    }
+    edge_ts = _edge_ts()
+    if edge_ts is not None:
+        message["edge_ts"] = edge_ts    # time.monotonic() of the IRQ edge
+    bot_queue.put(message)
+    EVENT_JOURNAL.record("notify", edge_ts)
+
+
+_LOCKER_PROBLEMS = {
+    50: "Has been opened for 1 minute.",
+    100: "Free space.",
+    150: "Jammed. Customer has been informed to call support.",
+}
+
+_I2C_PROBLEMS = {
+    50: "Issue with price tag display.",
+    100: "Issue with LED stripe driver.",
+}
+
+_CLIMATE_PROBLEMS = {
+    50: "Temperature below zero! Sensor %d!",
+    100: "Sensor is disconnected! Sensor %d!",
+}
+
+# Map STM32 error codes ➜ human‑readable messages (0xF6 black-box frames)
+_BLACK_BOX_ERRORS = {
+    1: "Failed to read data from sensor %d.",
+    2: "Mode in setFanMode() in climate.c: %d",
+    3: "Send_RGB (!= HAL_OK) device:  %d",
+    4: "Send_Price (!= HAL_OK) device:  %d",
+    5: "Response checksum error. locker: %d",
+    6: "Unexpected response when opening locker %d.",
+    7: "No response received when opening the cabinet  locker: %d",
+    8: "Failed to determine the status of locker %d. Aborting open operation."
+}
+_BLACK_BOX_LOCKER_CODES = (5, 6, 7, 8)     # codes whose value is a board‑local locker
+
+_CLIMATE_DB_PATH = "logs/climate.db"
+_climate_schema_ready = False
+
+
+@register_frame_handler(0xF1, ">BB3x", locker_field=0)
+def _on_locker_problem(app, bot_queue, data, locker_id, code):
+    """Problems with lockers."""
+    text = _LOCKER_PROBLEMS.get(code)
+    body = f"Locker {locker_id}: {text}" if text else f"Locker {locker_id}: Unknown issue (code {code})."
+    if code == 150:
+        app.information_frame.show()
+    _notify(bot_queue, '❗️"Problems with Locker"❗️', body)
+
+
+@register_frame_handler(0xF2, ">BB3x", locker_field=0)
+def _on_i2c_problem(app, bot_queue, data, locker_id, code):
+    """Problems with I2C devices."""
+    text = _I2C_PROBLEMS.get(code)
+    body = f"Locker {locker_id}: {text}" if text else f"Locker {locker_id}: Unknown issue (code {code})."
+    _notify(bot_queue, '❗️"Problems with I2C Devices"❗️', body)
+
+
+@register_frame_handler(0xF3, ">BB3x")
+def _on_climate_problem(app, bot_queue, data, ventilation_object, code):
+    """Problems in ventilation system."""
+    text = _CLIMATE_PROBLEMS.get(code)
+    if text:
+        body = text % ventilation_object
+    else:
+        body = f"Ventilation object {ventilation_object}: Unknown issue (code {code})."
+    _notify(bot_queue, '❗️"Problems with Climate"❗️', body)
+
+
+@register_frame_handler(0xF4, ">BHH")
+def _on_climate_sample(app, bot_queue, data, sensor_number, temp_raw, hum_raw):
+    """
+    byte[1] => sensor_number, byte[2..3] => temperature * 100,
+    byte[4..5] => humidity * 100. Logged to logs/climate.db.
+    """
+    global _climate_schema_ready
+    temperature = temp_raw / 100.0
+    humidity = hum_raw / 100.0
+
+    conn = sqlite3.connect(_CLIMATE_DB_PATH)
+    cursor = conn.cursor()
+
+    if not _climate_schema_ready:
         cursor.execute("""
             CREATE TABLE IF NOT EXISTS climate (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -841,76 +953,105 @@ def interpret_and_notify(app, data, bot_queue):
         try:
             cursor.execute("ALTER TABLE climate ADD COLUMN sensor INTEGER NOT NULL DEFAULT 0")
         except sqlite3.OperationalError:
-            pass  # Means column already exists, ignore 
+            pass  # Means column already exists, ignore
+        _climate_schema_ready = True
 
-        # Insert the climate data
-        now = datetime.now()
-        date_str = now.strftime("%Y-%m-%d")
-        time_str = now.strftime("%H:%M:%S")
-        cursor.execute("""
-            INSERT INTO climate (date, time, sensor, temperature, humidity)
-            VALUES (?, ?, ?, ?, ?)
-        """, (date_str, time_str, sensor_number, temperature, humidity))
+    now = datetime.now()
+    date_str = now.strftime("%Y-%m-%d")
+    time_str = now.strftime("%H:%M:%S")
+    cursor.execute("""
+        INSERT INTO climate (date, time, sensor, temperature, humidity)
+        VALUES (?, ?, ?, ?, ?)
+    """, (date_str, time_str, sensor_number, temperature, humidity))
 
-        conn.commit()
-        conn.close()
+    conn.commit()
+    conn.close()
+    EVENT_JOURNAL.record("db", _edge_ts())
 
-        print(f"[interpret_and_notify] Logged climate data (sensor {sensor_number}): "
-            f"{date_str} {time_str}, {temperature:.2f}°C, {humidity:.2f}%")
-        
-
-    elif command == 0xF5:
-        """
-        If command 0xF5 is received:
-          - We want to call three methods from app.py:
-                1) transfer_prices_to_stm32()
-                2) transfer_rgb_to_stm32()
-                3) transfer_fan_mode_from_file()
-        """
-        print("[interpret_and_notify] Received 0xF5 -> triggering re-sync to STM32")
-        time.sleep(0.05)
-        app.transfer_prices_to_stm32()
-        app.transfer_rgb_to_stm32()
-        app.transfer_fan_mode_from_file()
-        
-
-    elif command == 0xF6:                                  # “black‑box” error frame
-        error_code = byte2          # selects the text template (1‥8)
-        value      = byte1          # substituted for %d in the template
-
-        # Map STM32 error codes ➜ human‑readable messages
-        error_map = {
-            1: "Failed to read data from sensor %d.",
-            2: "Mode in setFanMode() in climate.c: %d",
-            3: "Send_RGB (!= HAL_OK) device:  %d",
-            4: "Send_Price (!= HAL_OK) device:  %d",
-            5: "Response checksum error. locker: %d",
-            6: "Unexpected response when opening locker %d.",
-            7: "No response received when opening the cabinet  locker: %d",
-            8: "Failed to determine the status of locker %d. Aborting open operation."
-        }
+    print(f"[interpret_and_notify] Logged climate data (sensor {sensor_number}): "
+        f"{date_str} {time_str}, {temperature:.2f}°C, {humidity:.2f}%")
 
-        # Resolve template → final message, fall back to generic text
-        message_txt = error_map.get(
-            error_code,
-            f"Unknown error code {error_code} (value {value})."
-        ) % value
 
-        # Assemble one plain‑text log line:   YYYY‑MM‑DD HH:MM:SS, 00 FF …,  message
-        timestamp  = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        raw_hex    = " ".join(f"{b:02X}" for b in data)        # e.g. "F6 05 01 00 00 00"
-        log_line   = f"{timestamp}, {raw_hex}, {message_txt}\n"
+@register_frame_handler(0xF5, "5x")
+def _on_resync_request(app, bot_queue, data):
+    """
+    Push prices, RGB colours and the fan mode back to the STM32. The SPI
+    handler's resync worker runs it (debounced), not the GPIO monitor thread.
+    """
+    print("[interpret_and_notify] Received 0xF5 -> triggering re-sync to STM32")
+    spi_handler = getattr(app, "spi_handler", None)
+    if spi_handler is not None and hasattr(spi_handler, "request_resync"):
+        spi_handler.request_resync()
+    else:
+        app.resync_stm32()
 
-        # Ensure logs/ exists, then append
-        os.makedirs("logs", exist_ok=True)
-        with open("logs/BLACK_BOX_UART.txt", "a", encoding="utf-8") as f:
-            f.write(log_line)
 
-        print(f"[interpret_and_notify] BLACK_BOX_UART → {log_line.strip()}")
+@register_frame_handler(0xF6, ">BB3x")
+def _on_black_box_error(app, bot_queue, data, value, error_code):
+    """
+    “black‑box” error frame: byte1 is substituted into the byte2 template.
+    For the locker codes byte1 is shifted by the board's locker_offset.
+    """
+    if error_code in _BLACK_BOX_LOCKER_CODES:
+        value += getattr(_frame_context, "locker_offset", 0)
+    template = _BLACK_BOX_ERRORS.get(error_code)
+    if template:
+        message_txt = template % value
+    else:
+        message_txt = f"Unknown error code {error_code} (value {value})."
 
+    # Assemble one plain‑text log line:   YYYY‑MM‑DD HH:MM:SS, 00 FF …,  message
+    timestamp  = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    raw_hex    = data.hex(" ").upper()                      # e.g. "F6 05 01 00 00 00"
+    log_line   = f"{timestamp}, {raw_hex}, {message_txt}\n"
 
-    else:
-        print(f"Unknown command (0x{command:02X}).")
+    # Ensure logs/ exists, then append
+    os.makedirs("logs", exist_ok=True)
+    with open("logs/BLACK_BOX_UART.txt", "a", encoding="utf-8") as f:
+        f.write(log_line)
 
-        
+    print(f"[interpret_and_notify] BLACK_BOX_UART → {log_line.strip()}")
 
+
+def interpret_and_notify(app, data, bot_queue, locker_offset=0, edge_ts=None):
+    """
+    Decode one 6-byte STM32 frame and run the handler registered for its
+    opcode. *locker_offset* maps the board's local locker numbers to global ids.
+    *edge_ts* (time.monotonic() of the IRQ edge) is kept for the handler's DB
+    insert / bot message, which record their delay in EVENT_JOURNAL.
+    """
+    if len(data) != 6:
+        print("Invalid input: Expected a 6-byte sequence.")
+        return  # Exit if input is invalid
+    data = bytes(data)
+    command = data[0]
+
+    entry = _FRAME_HANDLERS.get(command)
+    EVENT_JOURNAL.record("decode", edge_ts)
+    start = time.perf_counter()
+    if entry is None:
+        print(f"Unknown command (0x{command:02X}).")
+    else:
+        layout, handler, locker_field = entry
+        fields = layout.unpack_from(data, 1)
+        if locker_offset and locker_field is not None:
+            fields = list(fields)
+            fields[locker_field] += locker_offset
+        _frame_context.edge_ts = edge_ts
+        _frame_context.locker_offset = locker_offset
+        try:
+            handler(app, bot_queue, data, *fields)
+        finally:
+            _frame_context.edge_ts = None
+            _frame_context.locker_offset = 0
+    elapsed = time.perf_counter() - start
+    EVENT_JOURNAL.record("handled", edge_ts)
+
+    with _FRAME_STATS_LOCK:
+        stats = _FRAME_STATS.get(command)
+        if stats is None:
+            stats = _FRAME_STATS[command] = [0, 0.0, 0.0]
+        stats[0] += 1
+        stats[1] += elapsed
+        if elapsed > stats[2]:
+            stats[2] = elapsed